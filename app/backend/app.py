@@ -1,14 +1,16 @@
-import io
+import asyncio
+import hmac
 import json
 import logging
 import mimetypes
 import os
-import time
+import threading
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Optional
 
 import aiohttp
 import openai
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
@@ -20,31 +22,77 @@ from quart import (
     Quart,
     abort,
     current_app,
+    g,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
+from quart.wrappers.response import ResponseBody
 from quart_cors import cors
-import sqlite3
+from werkzeug.datastructures import ContentRange
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
+from core.admission import AdmissionController, AdmissionRejectedError
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.blobbody import BlobBody, CachedBlobBody
+from core.blobcache import BlobCache, CachedBlob
+from core.cache import LRUCache
+from core.cacheinvalidation import CacheInvalidator
+from core.coalesce import RequestCoalescer
+from core.embeddingcache import EmbeddingCache
+from core.logexport import EXPORT_FORMATS, export_logs_as
+from core.logstore import LOG_FIELDS, LogQueueFullError, LogStore
+from core.looplag import LoopLagMonitor
+from core.memory import (
+    TRACEMALLOC_GROUPS,
+    MemorySnapshots,
+    gc_stats,
+    peak_rss_bytes,
+    rss_bytes,
+)
+from core.metrics import REQUESTS, observe_stage, render_metrics
+from core.profiler import (
+    DEFAULT_INTERVAL,
+    PROFILE_FORMATS,
+    ProfilerBusyError,
+    SamplingProfiler,
+)
+from core.rewritecache import QueryRewriteCache
+from core.searchcache import SearchCache
+from core.servertiming import server_timing_header
+from core.tokenrefresher import TokenRefresher
+from core.tokenusage import TokenUsageStats
 
-
-CONFIG_OPENAI_TOKEN = "openai_token"
+CONFIG_OPENAI_TOKEN_REFRESHER = "openai_token_refresher"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_OPENAI_SESSION = "openai_session"
+CONFIG_OPENAI_WARMUP_TASK = "openai_warmup_task"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_LOG_STORE = "log_store"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_CACHE_INVALIDATOR = "cache_invalidator"
+CONFIG_QUERY_REWRITE_CACHE = "query_rewrite_cache"
+CONFIG_REQUEST_COALESCER = "request_coalescer"
+CONFIG_ADMISSION_CONTROLLER = "admission_controller"
+CONFIG_TOKEN_USAGE_STATS = "token_usage_stats"
+CONFIG_ADMIN_KEY = "admin_key"
+CONFIG_PROFILER = "profiler"
+CONFIG_LOOP_LAG_MONITOR = "loop_lag_monitor"
+CONFIG_MEMORY_SNAPSHOTS = "memory_snapshots"
 CONFIG_DB_NAME = "app.db"
 
 
-bp = Blueprint("routes", __name__, static_folder="static")
+bp = Blueprint("routes", __name__, static_folder="static", cli_group=None)
 
 
 @bp.route("/")
@@ -71,20 +119,50 @@ async def assets(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. The blob is streamed chunk by chunk, and Range and If-None-Match requests
+# are answered with partial downloads and 304s so the PDF viewer can fetch parts and revalidate cheaply.
+# Blobs that are small enough are kept in a local cache, since the same pages are cited over and over.
 @bp.route("/content/<path>")
 async def content_file(path):
     blob_container_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
-    blob = await blob_container_client.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+    blob_client = blob_container_client.get_blob_client(path)
+    content_cache = current_app.config[CONFIG_CONTENT_CACHE]
+    try:
+        # Only the lookup, the download of a blob that is not cached is the blob_download stage of its BlobBody
+        with observe_stage("/content", "blob_fetch"):
+            if content_cache:
+                blob = await content_cache.get(blob_client)
+            else:
+                blob = CachedBlob.from_properties(await blob_client.get_blob_properties())
+    except ResourceNotFoundError:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
+    mime_type = blob.content_type or "application/octet-stream"
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    body: ResponseBody
+    if blob.data is not None:
+        body = CachedBlobBody(blob.size, data=blob.data)
+    elif content_cache and (file := await content_cache.open(blob)):
+        body = CachedBlobBody(blob.size, file=file)
+    else:
+        # Also for a blob whose cached file was removed since it was looked up
+        body = BlobBody(blob_client, blob.size, blob.etag, endpoint="/content")
+    response = current_app.response_class(body, mimetype=mime_type)
+    response.content_length = blob.size
+    if blob.etag:
+        response.set_etag(blob.etag.strip('"'))
+    if blob.last_modified:
+        response.last_modified = blob.last_modified
+    response.headers["Accept-Ranges"] = "bytes"
+    response.timeout = None  # type: ignore
+    await response.make_conditional(request, accept_ranges=True, complete_length=blob.size)
+    if isinstance(body, CachedBlobBody) and response.response is not body:
+        # A 304 response replaces the body, which is then never sent
+        body.close()
+    if response.status_code == 206:
+        # Quart passes an inclusive end to werkzeug's ContentRange, which expects an exclusive one
+        response.content_range = ContentRange("bytes", body.begin, body.end, body.size)  # type: ignore
+    return response
 
 
 @bp.route("/ask", methods=["POST"])
@@ -94,16 +172,55 @@ async def ask():
     request_json = await request.get_json()
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    admission = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    slot = await admission.acquire()
     try:
         impl = current_app.config[CONFIG_ASK_APPROACH]
         # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await impl.run(request_json["question"], request_json.get("overrides") or {}, auth_claims)
-        return jsonify(r)
+        openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
+        r = await impl.run(request_json["question"], request_json.get("overrides") or {}, auth_claims)
+        return add_server_timing(jsonify(r), r)
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
+    finally:
+        admission.release(slot)
+
+
+@bp.route("/ask_stream", methods=["POST"])
+async def ask_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    admission = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    slot = await admission.acquire()
+    # Should the stream never start, the slot is released once the response was sent or abandoned
+    admission.release_when_done(slot)
+    handed_over = False
+    try:
+        impl = current_app.config[CONFIG_ASK_APPROACH]
+        # The generator runs in this request's context, so the OpenAI calls it makes reuse the pooled session
+        openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
+        response_generator = impl.run_with_streaming(
+            request_json["question"], request_json.get("overrides") or {}, auth_claims
+        )
+        # The stages before the answer run before the headers are sent, so that Server-Timing can report them
+        first_event = await response_generator.__anext__()
+        response = await make_response(
+            format_as_ndjson(admission.hold(slot, prepend_event(first_event, response_generator)))
+        )
+        handed_over = True
+        response.timeout = None  # type: ignore
+        return add_server_timing(response, first_event)
+    except Exception as e:
+        logging.exception("Exception in /ask_stream")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        # Until the stream holds the slot, it is released here, also when a client that disconnects cancels the request
+        if not handed_over:
+            admission.release(slot)
 
 
 @bp.route("/chat", methods=["POST"])
@@ -113,18 +230,19 @@ async def chat():
     request_json = await request.get_json()
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    admission = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    slot = await admission.acquire()
     try:
         impl = current_app.config[CONFIG_CHAT_APPROACH]
         # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await impl.run_without_streaming(
-                request_json["history"], request_json.get("overrides", {}), auth_claims
-            )
-        return jsonify(r)
+        openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
+        r = await impl.run_without_streaming(request_json["history"], request_json.get("overrides", {}), auth_claims)
+        return add_server_timing(jsonify(r), r)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
+    finally:
+        admission.release(slot)
 
 
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
@@ -132,6 +250,20 @@ async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str,
         yield json.dumps(event, ensure_ascii=False) + "\n"
 
 
+async def prepend_event(first_event: dict, r: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    yield first_event
+    async for event in r:
+        yield event
+
+
+def add_server_timing(response, completion: dict[str, Any]):
+    # The durations of the stages are in the extra_args of a completion and of the first chunk of a streamed one
+    timings = completion["choices"][0].get("extra_args", {}).get("timings")
+    if timings:
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+
 @bp.route("/chat_stream", methods=["POST"])
 async def chat_stream():
     if not request.is_json:
@@ -139,75 +271,365 @@ async def chat_stream():
     request_json = await request.get_json()
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    admission = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    slot = await admission.acquire()
+    # Should the stream never start, the slot is released once the response was sent or abandoned
+    admission.release_when_done(slot)
+    handed_over = False
     try:
         impl = current_app.config[CONFIG_CHAT_APPROACH]
+        # The generator runs in this request's context, so the OpenAI calls it makes reuse the pooled session
+        openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
         response_generator = impl.run_with_streaming(
             request_json["history"], request_json.get("overrides", {}), auth_claims
         )
-        response = await make_response(format_as_ndjson(response_generator))
+        # The stages before the answer run before the headers are sent, so that Server-Timing can report them
+        first_event = await response_generator.__anext__()
+        response = await make_response(
+            format_as_ndjson(admission.hold(slot, prepend_event(first_event, response_generator)))
+        )
+        handed_over = True
         response.timeout = None  # type: ignore
-        return response
+        return add_server_timing(response, first_event)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
+    finally:
+        # Until the stream holds the slot, it is released here, also when a client that disconnects cancels the request
+        if not handed_over:
+            admission.release(slot)
+
+
+@bp.errorhandler(AdmissionRejectedError)
+async def handle_admission_rejected(e: AdmissionRejectedError):
+    logging.warning("Rejected request to %s: %s", request.path, e)
+    return jsonify({"error": str(e)}), e.status_code, {"Retry-After": str(e.retry_after)}
+
+
+# Metrics of all the workers in the Prometheus text format, for scraping
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    data, content_type = render_metrics()
+    return data, 200, {"Content-Type": content_type}
+
+
+@bp.after_request
+async def count_request(response):
+    # Labelled by route rather than by path, so that e.g. every content file shares a label
+    endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    REQUESTS.labels(endpoint, str(response.status_code)).inc()
+    return response
+
+
+# Load of this worker, for load balancer probes and autoscaling. Returns 503 while requests are being turned away.
+@bp.route("/load", methods=["GET"])
+async def load():
+    admission = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    return jsonify(admission.stats()), 503 if admission.saturated() else 200
 
 
+# Pages through the feedback log, newest first. Pass the returned next_cursor as cursor to get the next page.
 @bp.route("/logs", methods=["GET"])
 async def get_logs():
-    conn = sqlite3.connect(CONFIG_DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='logs'")
-    table_exists = c.fetchone() is not None
-
-    # If the logs table does not exist, create it
-    if not table_exists:
-        return {"error": "logs table does not exist"}
-
-    c.execute("SELECT * FROM logs")
-    rows = c.fetchall()
-
-    logs = []
-    for row in rows:
-        log = {
-            "id": row[0],
-            "uuid": row[1],
-            "feedback": row[2],
-            "timestamp": row[3],
-            "thought_process": row[4],
-        }
-        logs.append(log)
+    log_store = current_app.config[CONFIG_LOG_STORE]
+    try:
+        logs, next_cursor = await log_store.get_logs(
+            limit=request.args.get("limit", 50, type=int),
+            cursor=request.args.get("cursor"),
+            feedback=request.args.get("feedback"),
+            uuid=request.args.get("uuid"),
+            since=request.args.get("since", type=float),
+            until=request.args.get("until", type=float),
+            fields=request.args["fields"].split(",") if request.args.get("fields") else None,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"logs": logs, "next_cursor": next_cursor})
+
+
+# Streams the whole feedback log, or a time range of it, oldest first as NDJSON or CSV, optionally gzipped
+@bp.route("/logs/export", methods=["GET"])
+async def export_logs():
+    log_store = current_app.config[CONFIG_LOG_STORE]
+    format = request.args.get("format", "ndjson")
+    compress = request.args.get("compress") == "gzip"
+    fields = request.args["fields"].split(",") if request.args.get("fields") else LOG_FIELDS
+    try:
+        chunks = log_store.export_logs(
+            feedback=request.args.get("feedback"),
+            uuid=request.args.get("uuid"),
+            since=request.args.get("since", type=float),
+            until=request.args.get("until", type=float),
+            fields=fields,
+        )
+        body = export_logs_as(format, chunks, fields, compress)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    filename = f"logs.{format}.gz" if compress else f"logs.{format}"
+    response = await make_response(body)
+    response.content_type = "application/gzip" if compress else EXPORT_FORMATS[format]
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.timeout = None  # type: ignore
+    return response
+
+
+# Counts of logs per feedback value in each hour or day, for dashboards
+@bp.route("/logs/stats", methods=["GET"])
+async def get_log_stats():
+    log_store = current_app.config[CONFIG_LOG_STORE]
+    period = request.args.get("period", "day")
+    try:
+        stats = await log_store.get_stats(
+            period, since=request.args.get("since", type=float), until=request.args.get("until", type=float)
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"period": period, "stats": stats})
+
+
+# Recomputes the feedback counts behind /logs/stats from the logs, e.g. after logs were changed by hand:
+#   quart --app main rebuild-log-stats
+@bp.cli.command("rebuild-log-stats")
+def rebuild_log_stats():
+    async def rebuild():
+        log_store = LogStore(os.getenv("LOGS_DB_PATH", CONFIG_DB_NAME))
+        await log_store.open()
+        try:
+            await log_store.rebuild_stats()
+        finally:
+            await log_store.close()
+
+    asyncio.run(rebuild())
+
 
-    return jsonify(logs)
+@bp.route("/logs/<int:log_id>", methods=["GET"])
+async def get_log(log_id: int):
+    log_store = current_app.config[CONFIG_LOG_STORE]
+    if log := await log_store.get_log(log_id):
+        return jsonify(log)
+    abort(404)
 
 
 @bp.route("/logs/add", methods=["POST"])
 async def add_log():
     data = await request.get_json()
-    uuid = data.get("uuid")
-    feedback = data.get("feedback")
-    timestamp = data.get("timestamp")
-    thought_process = data.get("thought_process")
-
-    conn = sqlite3.connect(CONFIG_DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='logs'")
-    table_exists = c.fetchone() is not None
-
-    # If the logs table does not exist, create it
-    if not table_exists:
-        c.execute(
-            """CREATE TABLE logs
-                    (id INTEGER PRIMARY KEY, uuid TEXT, feedback TEXT, timestamp NUMERIC, thought_process TEXT)"""
+    log_store = current_app.config[CONFIG_LOG_STORE]
+    try:
+        await log_store.add_log(
+            data.get("uuid"),
+            data.get("feedback"),
+            data.get("timestamp"),
+            data.get("thought_process"),
+            comment=data.get("comment"),
         )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LogQueueFullError as e:
+        logging.warning("Rejected log: %s", e)
+        return jsonify({"error": "too many logs waiting to be written"}), 503, {"Retry-After": "1"}
+    # The log is written in the background, shortly after this returns
+    return "log added successfully"
+
 
-    c.execute(
-        "INSERT INTO logs (uuid, feedback, timestamp, thought_process) VALUES (?, ?, ?, ?)",
-        (uuid, feedback, timestamp, thought_process),
+# Counters of the in-process caches and queues of this worker, for sizing them
+@bp.route("/stats", methods=["GET"])
+async def stats():
+    content_cache = current_app.config[CONFIG_CONTENT_CACHE]
+    openai_token_refresher = current_app.config.get(CONFIG_OPENAI_TOKEN_REFRESHER)
+    answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+    embedding_cache = current_app.config[CONFIG_EMBEDDING_CACHE]
+    search_cache = current_app.config[CONFIG_SEARCH_CACHE]
+    rewrite_cache = current_app.config[CONFIG_QUERY_REWRITE_CACHE]
+    chat_approach = current_app.config[CONFIG_CHAT_APPROACH]
+    request_coalescer = current_app.config[CONFIG_REQUEST_COALESCER]
+    loop_lag_monitor = current_app.config[CONFIG_LOOP_LAG_MONITOR]
+    cache_invalidator = current_app.config[CONFIG_CACHE_INVALIDATOR]
+    return jsonify(
+        {
+            "admission": current_app.config[CONFIG_ADMISSION_CONTROLLER].stats(),
+            "loop_lag": loop_lag_monitor.stats() if loop_lag_monitor else None,
+            "token_usage": current_app.config[CONFIG_TOKEN_USAGE_STATS].stats(),
+            "request_coalescing": request_coalescer.stats() if request_coalescer else None,
+            "query_rewrite": chat_approach.rewrite_stats(),
+            "speculative_retrieval": (
+                chat_approach.speculation_stats() if chat_approach.speculative_retrieval else None
+            ),
+            "query_rewrite_cache": rewrite_cache.stats() if rewrite_cache else None,
+            "search_cache": search_cache.stats() if search_cache else None,
+            "answer_cache": answer_cache.stats() if answer_cache else None,
+            "cache_invalidation": cache_invalidator.stats() if cache_invalidator else None,
+            "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+            "openai_token": openai_token_refresher.stats() if openai_token_refresher else None,
+            "content_cache": content_cache.stats() if content_cache else None,
+            "log_store": current_app.config[CONFIG_LOG_STORE].stats(),
+        }
     )
-    conn.commit()
-    conn.close()
 
-    return "log added successfully"
+
+def check_admin_key():
+    admin_key = current_app.config[CONFIG_ADMIN_KEY]
+    if not admin_key:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("X-Admin-Key", ""), admin_key):
+        abort(403)
+
+
+# Drops cached search results and answers after documents were re-indexed or their access control changed. With a
+# source, only the search results citing a source page that starts with it are dropped. The worker that handles the
+# request drops them before returning, and the other workers that share the log database within
+# CACHE_INVALIDATION_INTERVAL seconds. Instances with a database of their own keep serving them until they expire.
+@bp.route("/cache/invalidate", methods=["POST"])
+async def invalidate_cache():
+    check_admin_key()
+    data = await request.get_json(silent=True) or {}
+    if cache_invalidator := current_app.config[CONFIG_CACHE_INVALIDATOR]:
+        await cache_invalidator.invalidate(data.get("source"))
+    return jsonify({"invalidated": True})
+
+
+# Token usage totals of the users who used the most tokens, by Azure AD object ID
+@bp.route("/stats/token_usage/users", methods=["GET"])
+async def token_usage_users():
+    check_admin_key()
+    return jsonify(current_app.config[CONFIG_TOKEN_USAGE_STATS].user_stats())
+
+
+# Longer profiles would outlast the request timeout of gunicorn.conf.py
+MAX_PROFILE_SECONDS = 60
+
+
+def start_profiler(interval: float) -> SamplingProfiler:
+    # Samples of two profiles taken at once would be of the same loop, so one is taken at a time per worker
+    if current_app.config[CONFIG_PROFILER]:
+        raise ProfilerBusyError("A profile is already being taken in this worker")
+    profiler = SamplingProfiler(threading.get_ident(), interval)
+    current_app.config[CONFIG_PROFILER] = profiler
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler: SamplingProfiler):
+    profiler.stop()
+    current_app.config[CONFIG_PROFILER] = None
+    logging.info("Profiled this worker: %s", json.dumps(profiler.stats()))
+
+
+async def profile_response(profiler: SamplingProfiler, format: str):
+    if format == "speedscope":
+        body = json.dumps(profiler.speedscope())
+        response = await make_response(body)
+        response.headers["Content-Disposition"] = "attachment; filename=profile.speedscope.json"
+    else:
+        response = await make_response(profiler.collapsed())
+    response.content_type = PROFILE_FORMATS[format]
+    return response
+
+
+# Samples the stacks of the event loop of the worker that handles the request for the given seconds, and returns
+# them as collapsed stacks for flamegraph.pl or as a file for https://www.speedscope.app
+@bp.route("/debug/profile", methods=["GET"])
+async def debug_profile():
+    check_admin_key()
+    seconds = request.args.get("seconds", 10, type=float)
+    format = request.args.get("format", "collapsed")
+    interval_ms = request.args.get("interval_ms", DEFAULT_INTERVAL * 1000, type=float)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return jsonify({"error": f"seconds must be more than 0 and at most {MAX_PROFILE_SECONDS}"}), 400
+    if format not in PROFILE_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(PROFILE_FORMATS)}"}), 400
+    if interval_ms <= 0:
+        return jsonify({"error": "interval_ms must be more than 0"}), 400
+    profiler = start_profiler(interval_ms / 1000)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop_profiler(profiler)
+    return await profile_response(profiler, format)
+
+
+# A /chat request with an X-Profile header of "collapsed" or "speedscope" is profiled from start to end, and answered
+# with the profile instead of the answer
+@bp.before_request
+async def start_request_profile():
+    if request.endpoint != "routes.chat" or (format := request.headers.get("X-Profile")) is None:
+        return None
+    check_admin_key()
+    if format not in PROFILE_FORMATS:
+        return jsonify({"error": f"X-Profile must be one of {', '.join(PROFILE_FORMATS)}"}), 400
+    g.profiler = start_profiler(DEFAULT_INTERVAL)
+    return None
+
+
+@bp.after_request
+async def finish_request_profile(response):
+    if (profiler := g.pop("profiler", None)) is None:
+        return response
+    stop_profiler(profiler)
+    return await profile_response(profiler, request.headers["X-Profile"])
+
+
+@bp.teardown_request
+async def abandon_request_profile(exc):
+    # A request that failed before its response was made still stops its profile
+    if profiler := g.pop("profiler", None):
+        stop_profiler(profiler)
+
+
+@bp.errorhandler(ProfilerBusyError)
+async def handle_profiler_busy(e: ProfilerBusyError):
+    return jsonify({"error": str(e)}), 409
+
+
+def cache_size(cache: Optional[LRUCache]) -> Optional[dict[str, int]]:
+    return {"entries": len(cache), "size": cache.size} if cache is not None else None
+
+
+# Memory of the worker that handles the request: its RSS, the sizes of its caches and queues, its garbage collector
+# and a tracemalloc snapshot, diffed with the one the previous call took. The first call starts tracing, which slows
+# the worker down until it is stopped with DELETE, and taking a snapshot blocks the worker for a moment.
+@bp.route("/debug/memory", methods=["GET"])
+async def debug_memory():
+    check_admin_key()
+    group_by = request.args.get("group_by", "lineno")
+    top = request.args.get("top", 20, type=int)
+    if group_by not in TRACEMALLOC_GROUPS:
+        return jsonify({"error": f"group_by must be one of {', '.join(TRACEMALLOC_GROUPS)}"}), 400
+    if top <= 0:
+        return jsonify({"error": "top must be more than 0"}), 400
+    answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+    embedding_cache = current_app.config[CONFIG_EMBEDDING_CACHE]
+    search_cache = current_app.config[CONFIG_SEARCH_CACHE]
+    rewrite_cache = current_app.config[CONFIG_QUERY_REWRITE_CACHE]
+    content_cache = current_app.config[CONFIG_CONTENT_CACHE]
+    request_coalescer = current_app.config[CONFIG_REQUEST_COALESCER]
+    openai_session = current_app.config[CONFIG_OPENAI_SESSION]
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "rss_bytes": rss_bytes(),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "structures": {
+                "answer_cache": cache_size(answer_cache.answers if answer_cache else None),
+                "embedding_cache": cache_size(embedding_cache.embeddings if embedding_cache else None),
+                "search_cache": cache_size(search_cache.results if search_cache else None),
+                "query_rewrite_cache": cache_size(rewrite_cache.queries if rewrite_cache else None),
+                "content_cache": cache_size(content_cache.memory if content_cache else None),
+                "token_usage_users": len(current_app.config[CONFIG_TOKEN_USAGE_STATS].users),
+                "request_coalescing": request_coalescer.stats() if request_coalescer else None,
+                "log_queue_depth": current_app.config[CONFIG_LOG_STORE].stats()["queue_depth"],
+                "openai_session": {"closed": openai_session.closed, "connection_limit": openai_session.connector.limit},
+            },
+            "gc": gc_stats(),
+            "tracemalloc": current_app.config[CONFIG_MEMORY_SNAPSHOTS].snapshot(group_by, top),
+        }
+    )
+
+
+@bp.route("/debug/memory", methods=["DELETE"])
+async def stop_memory_tracing():
+    check_admin_key()
+    current_app.config[CONFIG_MEMORY_SNAPSHOTS].stop()
+    return jsonify({"tracing": False})
 
 
 # Send MSAL.js settings to the client UI
@@ -221,13 +643,21 @@ def auth_setup():
 async def ensure_openai_token():
     if openai.api_type != "azure_ad":
         return
-    openai_token = current_app.config[CONFIG_OPENAI_TOKEN]
-    if openai_token.expires_on < time.time() + 60:
-        openai_token = await current_app.config[CONFIG_CREDENTIAL].get_token(
-            "https://cognitiveservices.azure.com/.default"
-        )
-        current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
-        openai.api_key = openai_token.token
+    # The token is refreshed in the background, so this only waits if that refresh is late or has failed
+    await current_app.config[CONFIG_OPENAI_TOKEN_REFRESHER].get_token()
+
+
+async def warm_up_openai_session(session: aiohttp.ClientSession, url: str, connections: int):
+    # Open a few keep-alive connections concurrently so the first requests don't pay for DNS, TCP and TLS setup.
+    # The response status doesn't matter, only that the connection goes back into the pool.
+    async def open_connection():
+        async with session.head(url) as resp:
+            await resp.read()
+
+    results = await asyncio.gather(*[open_connection() for _ in range(connections)], return_exceptions=True)
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if failures:
+        logging.warning("Failed to warm up %d of %d OpenAI connections: %s", len(failures), connections, failures[0])
 
 
 @bp.before_app_serving
@@ -254,6 +684,67 @@ async def setup_clients():
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
     TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH")
+    # Seconds before expiry at which the Azure AD token for OpenAI is refreshed in the background
+    OPENAI_TOKEN_REFRESH_MARGIN = float(os.getenv("OPENAI_TOKEN_REFRESH_MARGIN", "300"))
+
+    # Connection pool shared by all OpenAI calls made by this worker
+    OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "100"))
+    OPENAI_KEEPALIVE_TIMEOUT = float(os.getenv("OPENAI_KEEPALIVE_TIMEOUT", "60"))
+    OPENAI_POOL_WARMUP = int(os.getenv("OPENAI_POOL_WARMUP", "2"))
+    # Bytes fetched per request when streaming content files, which bounds the memory held per download
+    CONTENT_CHUNK_SIZE = int(os.getenv("CONTENT_CHUNK_SIZE", str(1024 * 1024)))
+    # Cache of content files: small blobs in memory, larger ones on local disk. Set both sizes to 0 to disable it.
+    CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", "300"))
+    CONTENT_CACHE_MEMORY_SIZE = int(os.getenv("CONTENT_CACHE_MEMORY_SIZE", str(32 * 1024 * 1024)))
+    CONTENT_CACHE_MEMORY_MAX_ENTRY_SIZE = int(os.getenv("CONTENT_CACHE_MEMORY_MAX_ENTRY_SIZE", str(1024 * 1024)))
+    CONTENT_CACHE_DISK_SIZE = int(os.getenv("CONTENT_CACHE_DISK_SIZE", str(512 * 1024 * 1024)))
+    CONTENT_CACHE_DISK_MAX_ENTRY_SIZE = int(os.getenv("CONTENT_CACHE_DISK_MAX_ENTRY_SIZE", str(32 * 1024 * 1024)))
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR")
+    # SQLite database of the feedback log
+    LOGS_DB_PATH = os.getenv("LOGS_DB_PATH", CONFIG_DB_NAME)
+    # Feedback logs are queued and written in batches of up to LOGS_BATCH_SIZE, at least every LOGS_FLUSH_INTERVAL seconds
+    LOGS_BATCH_SIZE = int(os.getenv("LOGS_BATCH_SIZE", "100"))
+    LOGS_FLUSH_INTERVAL = float(os.getenv("LOGS_FLUSH_INTERVAL", "1"))
+    LOGS_MAX_QUEUE_SIZE = int(os.getenv("LOGS_MAX_QUEUE_SIZE", "10000"))
+
+    # Cache of answers to repeated questions, bounded by the characters of the cached answers. Set the size to 0 to
+    # disable it.
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", str(32 * 1024 * 1024)))
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "900"))
+    # Cache of query embeddings, bounded by the bytes of the cached vectors. Set the size to 0 to disable it.
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", str(16 * 1024 * 1024)))
+    EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+    # Short-lived cache of search results, bounded by the characters of the cached results. Set the size to 0 to
+    # disable it.
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", str(16 * 1024 * 1024)))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+    # Seconds within which a worker applies the cache invalidations that another worker recorded
+    CACHE_INVALIDATION_INTERVAL = float(os.getenv("CACHE_INVALIDATION_INTERVAL", "1"))
+    # Cache of the search queries the chat approach generates from the conversation. Set the size to 0 to disable it.
+    QUERY_REWRITE_CACHE_ENTRIES = int(os.getenv("QUERY_REWRITE_CACHE_ENTRIES", "10000"))
+    QUERY_REWRITE_CACHE_TTL = float(os.getenv("QUERY_REWRITE_CACHE_TTL", "3600"))
+    # Start retrieval for the question as asked alongside the chat query rewrite, and keep it if the rewritten query
+    # has at least SPECULATIVE_RETRIEVAL_MIN_SIMILARITY of its terms in common with the question
+    SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    SPECULATIVE_RETRIEVAL_MIN_SIMILARITY = float(os.getenv("SPECULATIVE_RETRIEVAL_MIN_SIMILARITY", "0.8"))
+    # Turn the first question of a chat into a search query locally instead of with a completion. Requests can
+    # override this with the rewrite_fast_path override.
+    QUERY_REWRITE_FAST_PATH = os.getenv("QUERY_REWRITE_FAST_PATH", "").lower() == "true"
+    # Let identical ask and chat requests that arrive while one of them is being answered share its answer
+    REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+    # Each worker answers at most ADMISSION_MAX_CONCURRENCY ask and chat requests at once (0 for no limit). Up to
+    # ADMISSION_MAX_QUEUE_SIZE more wait for up to ADMISSION_MAX_QUEUE_TIME seconds, and the rest are turned away.
+    ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+    ADMISSION_MAX_QUEUE_SIZE = int(os.getenv("ADMISSION_MAX_QUEUE_SIZE", "64"))
+    ADMISSION_MAX_QUEUE_TIME = float(os.getenv("ADMISSION_MAX_QUEUE_TIME", "10"))
+    # Number of users whose token usage totals are kept, the least recently active ones are dropped first
+    TOKEN_USAGE_MAX_USERS = int(os.getenv("TOKEN_USAGE_MAX_USERS", "10000"))
+    # Measure how late the event loop runs every LOOP_LAG_INTERVAL seconds (0 to disable it), and log the stack of
+    # the loop when it is blocked for longer than LOOP_LAG_THRESHOLD seconds
+    LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+    LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+    # Key expected in the X-Admin-Key header of the admin endpoints, which are disabled when it is not set
+    ADMIN_KEY = os.getenv("ADMIN_KEY")
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
@@ -281,29 +772,102 @@ async def setup_clients():
         credential=azure_credential,
     )
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+    content_cache = None
+    if CONTENT_CACHE_MEMORY_SIZE > 0 or CONTENT_CACHE_DISK_SIZE > 0:
+        content_cache = BlobCache(
+            memory_max_size=CONTENT_CACHE_MEMORY_SIZE,
+            memory_max_entry_size=CONTENT_CACHE_MEMORY_MAX_ENTRY_SIZE,
+            disk_max_size=CONTENT_CACHE_DISK_SIZE,
+            disk_max_entry_size=CONTENT_CACHE_DISK_MAX_ENTRY_SIZE,
+            ttl=CONTENT_CACHE_TTL,
+            directory=CONTENT_CACHE_DIR,
+        )
 
     # Used by the OpenAI SDK
     if OPENAI_HOST == "azure":
         openai.api_type = "azure_ad"
         openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
         openai.api_version = "2023-07-01-preview"
-        openai_token = await azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-        openai.api_key = openai_token.token
+        openai_token_refresher = TokenRefresher(
+            azure_credential,
+            "https://cognitiveservices.azure.com/.default",
+            refresh_margin=OPENAI_TOKEN_REFRESH_MARGIN,
+            on_refresh=lambda token: setattr(openai, "api_key", token.token),
+        )
+        await openai_token_refresher.start()
         # Store on app.config for later use inside requests
-        current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
+        current_app.config[CONFIG_OPENAI_TOKEN_REFRESHER] = openai_token_refresher
     else:
         openai.api_type = "openai"
         openai.api_key = OPENAI_API_KEY
         openai.organization = OPENAI_ORGANIZATION
 
+    # One long-lived session per worker, so requests reuse pooled keep-alive connections to OpenAI
+    openai_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=OPENAI_POOL_SIZE, keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT)
+    )
+    current_app.config[CONFIG_OPENAI_SESSION] = openai_session
+    if OPENAI_POOL_WARMUP > 0:
+        current_app.config[CONFIG_OPENAI_WARMUP_TASK] = asyncio.create_task(
+            warm_up_openai_session(openai_session, openai.api_base, min(OPENAI_POOL_WARMUP, OPENAI_POOL_SIZE))
+        )
+
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
+    current_app.config[CONFIG_CONTENT_CACHE] = content_cache
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
 
+    log_store = LogStore(
+        LOGS_DB_PATH,
+        batch_size=LOGS_BATCH_SIZE,
+        flush_interval=LOGS_FLUSH_INTERVAL,
+        max_queue_size=LOGS_MAX_QUEUE_SIZE,
+    )
+    await log_store.open()
+    current_app.config[CONFIG_LOG_STORE] = log_store
+
+    answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL) if ANSWER_CACHE_SIZE > 0 else None
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL) if EMBEDDING_CACHE_SIZE > 0 else None
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL) if SEARCH_CACHE_SIZE > 0 else None
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+    cache_invalidator = (
+        CacheInvalidator(log_store, search_cache, answer_cache, CACHE_INVALIDATION_INTERVAL)
+        if search_cache or answer_cache
+        else None
+    )
+    if cache_invalidator:
+        await cache_invalidator.start()
+    current_app.config[CONFIG_CACHE_INVALIDATOR] = cache_invalidator
+    rewrite_cache = (
+        QueryRewriteCache(QUERY_REWRITE_CACHE_ENTRIES, QUERY_REWRITE_CACHE_TTL)
+        if QUERY_REWRITE_CACHE_ENTRIES > 0
+        else None
+    )
+    current_app.config[CONFIG_QUERY_REWRITE_CACHE] = rewrite_cache
+    request_coalescer = RequestCoalescer() if REQUEST_COALESCING else None
+    current_app.config[CONFIG_REQUEST_COALESCER] = request_coalescer
+    current_app.config[CONFIG_ADMISSION_CONTROLLER] = AdmissionController(
+        ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE_SIZE, ADMISSION_MAX_QUEUE_TIME
+    )
+    token_usage_stats = TokenUsageStats(TOKEN_USAGE_MAX_USERS)
+    current_app.config[CONFIG_TOKEN_USAGE_STATS] = token_usage_stats
+    current_app.config[CONFIG_ADMIN_KEY] = ADMIN_KEY
+    current_app.config[CONFIG_PROFILER] = None
+    loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD) if LOOP_LAG_INTERVAL > 0 else None
+    if loop_lag_monitor:
+        loop_lag_monitor.start()
+    current_app.config[CONFIG_LOOP_LAG_MONITOR] = loop_lag_monitor
+    current_app.config[CONFIG_MEMORY_SNAPSHOTS] = MemorySnapshots()
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -315,6 +879,11 @@ async def setup_clients():
         OPENAI_EMB_MODEL,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        answer_cache=answer_cache,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        request_coalescer=request_coalescer,
+        token_usage_stats=token_usage_stats,
     )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -326,9 +895,36 @@ async def setup_clients():
         OPENAI_EMB_MODEL,
         KB_FIELDS_SOURCEPAGE,
         KB_FIELDS_CONTENT,
+        answer_cache=answer_cache,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        rewrite_cache=rewrite_cache,
+        speculative_retrieval=SPECULATIVE_RETRIEVAL,
+        speculation_min_similarity=SPECULATIVE_RETRIEVAL_MIN_SIMILARITY,
+        rewrite_fast_path=QUERY_REWRITE_FAST_PATH,
+        request_coalescer=request_coalescer,
+        token_usage_stats=token_usage_stats,
     )
 
 
+@bp.after_app_serving
+async def close_clients():
+    if openai_token_refresher := current_app.config.get(CONFIG_OPENAI_TOKEN_REFRESHER):
+        openai_token_refresher.stop()
+    if warmup_task := current_app.config.get(CONFIG_OPENAI_WARMUP_TASK):
+        warmup_task.cancel()
+    if loop_lag_monitor := current_app.config.get(CONFIG_LOOP_LAG_MONITOR):
+        loop_lag_monitor.stop()
+    if cache_invalidator := current_app.config.get(CONFIG_CACHE_INVALIDATOR):
+        cache_invalidator.stop()
+    if openai_session := current_app.config.get(CONFIG_OPENAI_SESSION):
+        await openai_session.close()
+    if content_cache := current_app.config.get(CONFIG_CONTENT_CACHE):
+        content_cache.close()
+    if log_store := current_app.config.get(CONFIG_LOG_STORE):
+        await log_store.close()
+
+
 def create_app():
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
         configure_azure_monitor()
@@ -1,10 +1,47 @@
+import time
 from abc import ABC
-from typing import Any, Optional
+from contextlib import contextmanager
+from typing import Any, AsyncGenerator, Awaitable, Callable, Iterator, Optional
 
+import openai
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryType
+from opentelemetry import trace
+
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.coalesce import RequestCoalescer
+from core.embeddingcache import EmbeddingCache
+from core.metrics import STAGE_SECONDS, TOKENS, observe_stage
+from core.searchcache import SearchCache
+from core.servertiming import ServerTiming
+from core.tokenusage import (
+    TokenUsage,
+    TokenUsageStats,
+    count_completion_tokens,
+    count_tokens,
+)
+from text import nonewlines
+
+tracer = trace.get_tracer(__name__)
 
 
 class Approach(ABC):
+    # The endpoint that the token usage of the approach is recorded for, with "_stream" appended for streamed answers
+    endpoint: str
+    search_client: SearchClient
+    openai_host: str
+    chatgpt_model: str
+    embedding_deployment: Optional[str]
+    embedding_model: str
+    sourcepage_field: str
+    content_field: str
+    answer_cache: Optional[AnswerCache] = None
+    embedding_cache: Optional[EmbeddingCache] = None
+    search_cache: Optional[SearchCache] = None
+    request_coalescer: Optional[RequestCoalescer] = None
+    token_usage_stats: Optional[TokenUsageStats] = None
+
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category") or None
         security_filter = AuthenticationHelper.build_security_filters(overrides, auth_claims)
@@ -14,3 +51,262 @@ class Approach(ABC):
         if security_filter:
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
+
+    async def compute_embedding(self, text: str, usage: Optional[TokenUsage] = None) -> list[float]:
+        embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
+
+        span = trace.get_current_span()
+        span.set_attribute("app.cache_hit", True)
+
+        async def embed(text: str) -> list[float]:
+            span.set_attribute("app.cache_hit", False)
+            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=text)
+            # An embedding found in the cache, or computed for a concurrent request, uses no tokens of this request
+            reported = embedding.get("usage") or {}
+            prompt_tokens = reported.get("prompt_tokens") or count_tokens(text, self.embedding_model)
+            span.set_attribute("app.prompt_tokens", prompt_tokens)
+            if usage is not None:
+                usage.add("embedding", prompt_tokens)
+            return embedding["data"][0]["embedding"]
+
+        if self.embedding_cache:
+            return await self.embedding_cache.get(self.embedding_model, text, embed)
+        return await embed(text)
+
+    async def search(
+        self,
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        filter: Optional[str],
+        top: int,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+    ) -> list[str]:
+        if self.search_cache:
+            cache_key = self.search_cache.key(
+                query_text,
+                query_vector,
+                filter,
+                top,
+                use_semantic_ranker,
+                use_semantic_captions,
+                (self.sourcepage_field, self.content_field),
+            )
+            if (results := self.search_cache.get(cache_key, use_semantic_ranker)) is not None:
+                trace.get_current_span().set_attribute("app.cache_hit", True)
+                return results
+        trace.get_current_span().set_attribute("app.cache_hit", False)
+
+        # A vector-only search has no search text, which the SDK accepts despite its annotation
+        if use_semantic_ranker:
+            r = await self.search_client.search(
+                query_text,  # type: ignore[arg-type]
+                filter=filter,
+                query_type=QueryType.SEMANTIC,
+                query_language="en-us",
+                query_speller="lexicon",
+                semantic_configuration_name="default",
+                top=top,
+                query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                vector=query_vector,
+                top_k=50 if query_vector else None,
+                vector_fields="embedding" if query_vector else None,
+            )
+        else:
+            r = await self.search_client.search(
+                query_text,  # type: ignore[arg-type]
+                filter=filter,
+                top=top,
+                vector=query_vector,
+                top_k=50 if query_vector else None,
+                vector_fields="embedding" if query_vector else None,
+            )
+        if use_semantic_captions:
+            results = [
+                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
+                async for doc in r
+            ]
+        else:
+            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+
+        if self.search_cache:
+            self.search_cache.set(cache_key, results)
+        return results
+
+    def span_attributes(self, overrides: dict[str, Any], **attributes: Any) -> dict[str, Any]:
+        return {
+            "app.endpoint": self.endpoint,
+            "app.retrieval_mode": overrides.get("retrieval_mode") or "hybrid",
+            **{f"app.{key}": value for key, value in attributes.items()},
+        }
+
+    @contextmanager
+    def span(self, name: str, overrides: dict[str, Any], **attributes: Any) -> Iterator[trace.Span]:
+        with tracer.start_as_current_span(name, attributes=self.span_attributes(overrides, **attributes)) as span:
+            yield span
+
+    def set_usage_attributes(self, span: trace.Span, usage: TokenUsage, stage: str):
+        if stage_usage := usage.stages.get(stage):
+            span.set_attribute("app.prompt_tokens", stage_usage["prompt_tokens"])
+            span.set_attribute("app.completion_tokens", stage_usage["completion_tokens"])
+
+    def stage_labels(self, stage: str, overrides: dict[str, Any], streaming: bool = False) -> tuple[str, str, str]:
+        endpoint = f"{self.endpoint}_stream" if streaming else self.endpoint
+        return (endpoint, stage, overrides.get("retrieval_mode") or "hybrid")
+
+    @contextmanager
+    def observe(
+        self, stage: str, overrides: dict[str, Any], streaming: bool = False, timing: Optional[ServerTiming] = None
+    ) -> Iterator[None]:
+        # The stage is timed for the Server-Timing of the request as well as for the metrics
+        with observe_stage(*self.stage_labels(stage, overrides, streaming)):
+            if timing is None:
+                yield
+            else:
+                with timing.measure(stage):
+                    yield
+
+    def record_usage(self, endpoint: str, auth_claims: dict[str, Any], usage: TokenUsage):
+        for stage, stage_usage in usage.stages.items():
+            for kind, tokens in stage_usage.items():
+                TOKENS.labels(endpoint, stage, kind).inc(tokens)
+        if self.token_usage_stats:
+            self.token_usage_stats.record(endpoint, auth_claims.get("oid"), usage)
+
+    async def complete(
+        self,
+        request_key: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        final_call: Callable[[bool], Awaitable[tuple]],
+    ) -> dict[str, Any]:
+        # Repeated questions are answered from the cache, which only matches the same overrides and filter
+        if self.answer_cache and (answer := self.answer_cache.get(request_key)):
+            completion = self.answer_cache.as_completion(answer)
+            completion["choices"][0]["extra_args"]["token_usage"] = TokenUsage().as_dict()
+            completion["choices"][0]["extra_args"]["timings"] = ServerTiming().as_dict()
+            return completion
+        # Identical requests arriving while one is being answered wait for its answer
+        if self.request_coalescer:
+            return await self.request_coalescer.run(
+                request_key, lambda: self.complete_uncached(request_key, overrides, auth_claims, final_call)
+            )
+        return await self.complete_uncached(request_key, overrides, auth_claims, final_call)
+
+    async def complete_uncached(
+        self,
+        request_key: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        final_call: Callable[[bool], Awaitable[tuple]],
+    ) -> dict[str, Any]:
+        extra_info, chat_coroutine, usage, timing = await final_call(False)
+        with self.observe("answer", overrides, timing=timing), self.span("answer_completion", overrides) as span:
+            chat_completion = await chat_coroutine
+            choice = chat_completion.choices[0]
+            # The answer prompt was counted when it was built, the usage reported by OpenAI replaces that count
+            if reported := chat_completion.get("usage"):
+                usage.set("answer", reported["prompt_tokens"], reported["completion_tokens"])
+            else:
+                usage.add("answer", 0, count_completion_tokens(choice["message"], self.chatgpt_model))
+            self.set_usage_attributes(span, usage, "answer")
+        self.record_usage(self.endpoint, auth_claims, usage)
+        choice["extra_args"] = {**extra_info, "token_usage": usage.as_dict(), "timings": timing.as_dict()}
+        if self.answer_cache:
+            self.answer_cache.set(request_key, choice["message"], extra_info, choice.get("finish_reason"))
+        return chat_completion
+
+    async def complete_with_streaming(
+        self,
+        request_key: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        final_call: Callable[[bool], Awaitable[tuple]],
+    ) -> AsyncGenerator[dict, None]:
+        if self.answer_cache and (answer := self.answer_cache.get(request_key)):
+            answer["extra_args"]["timings"] = ServerTiming().as_dict()
+            for event in self.answer_cache.as_completion_chunks(answer):
+                yield event
+            yield self.usage_chunk(TokenUsage())
+            return
+        # Identical requests arriving while one is being streamed receive its chunks from the start
+        if self.request_coalescer:
+            events = self.request_coalescer.stream(
+                request_key, lambda: self.stream_completion(request_key, overrides, auth_claims, final_call)
+            )
+        else:
+            events = self.stream_completion(request_key, overrides, auth_claims, final_call)
+        async for event in events:
+            yield event
+
+    async def stream_completion(
+        self,
+        request_key: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        final_call: Callable[[bool], Awaitable[tuple]],
+    ) -> AsyncGenerator[dict, None]:
+        started = time.monotonic()
+        extra_info, chat_coroutine, usage, timing = await final_call(True)
+
+        content = []
+        finish_reason = None
+        # The spans are not made current, since the context of a generator cannot be kept across its yields
+        attributes = self.span_attributes(overrides, streaming=True)
+        answer_span = tracer.start_span("answer_completion", attributes=attributes)
+        first_token_span: Optional[trace.Span] = tracer.start_span("stream_first_token", attributes=attributes)
+        try:
+            with self.observe("answer", overrides, streaming=True):
+                # The stream is opened before the first chunk is sent, so that the first chunk carries the durations
+                # of all the stages that come before the answer
+                with timing.measure("answer_setup"):
+                    chat_stream = await chat_coroutine
+                yield {
+                    "choices": [
+                        {
+                            "delta": {"role": "assistant"},
+                            "extra_args": {**extra_info, "timings": timing.as_dict()},
+                            "finish_reason": None,
+                            "index": 0,
+                        }
+                    ],
+                    "object": "chat.completion.chunk",
+                }
+                async for event in chat_stream:
+                    # "2023-07-01-preview" API version has a bug where first response has empty choices
+                    if event["choices"]:
+                        choice = event["choices"][0]
+                        if first_token_span and choice["delta"].get("content"):
+                            first_token_span.end()
+                            first_token_span = None
+                            # Measured from the start of the pipeline, as it is what the user waits for
+                            STAGE_SECONDS.labels(*self.stage_labels("first_token", overrides, streaming=True)).observe(
+                                time.monotonic() - started
+                            )
+                        content.append(choice["delta"].get("content") or "")
+                        finish_reason = choice.get("finish_reason") or finish_reason
+                        yield event
+
+            # Streamed completions report no usage, so the tokens of the answer are counted locally
+            usage.add("answer", 0, count_tokens("".join(content), self.chatgpt_model))
+            self.set_usage_attributes(answer_span, usage, "answer")
+        finally:
+            if first_token_span:
+                first_token_span.end()
+            answer_span.end()
+        self.record_usage(f"{self.endpoint}_stream", auth_claims, usage)
+        yield self.usage_chunk(usage)
+
+        # Only an answer that was streamed to the end is cached
+        if self.answer_cache:
+            message = {"role": "assistant", "content": "".join(content)}
+            self.answer_cache.set(request_key, message, extra_info, finish_reason)
+
+    def usage_chunk(self, usage: TokenUsage) -> dict[str, Any]:
+        # The tokens used are only known once the answer has been streamed, so they follow it in a chunk of their own
+        return {
+            "choices": [
+                {"delta": {}, "extra_args": {"token_usage": usage.as_dict()}, "finish_reason": None, "index": 0}
+            ],
+            "object": "chat.completion.chunk",
+        }
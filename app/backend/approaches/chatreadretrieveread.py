@@ -1,14 +1,24 @@
+import asyncio
 import json
+import logging
+import time
 from typing import Any, AsyncGenerator, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
+from core.answercache import AnswerCache, normalize_question
+from core.cache import make_key
+from core.coalesce import RequestCoalescer
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
 from core.modelhelper import get_token_limit
-from text import nonewlines
+from core.querytext import normalize_search_query, query_similarity
+from core.rewritecache import QueryRewriteCache
+from core.searchcache import SearchCache
+from core.servertiming import ServerTiming
+from core.tokenusage import TokenUsage, TokenUsageStats, count_prompt_tokens
 
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -19,6 +29,8 @@ class ChatReadRetrieveReadApproach(Approach):
 
     NO_RESPONSE = "0"
 
+    endpoint = "/chat"
+
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
     top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion
@@ -62,6 +74,15 @@ If you cannot generate a search query, return just the number 0.
         embedding_model: str,
         sourcepage_field: str,
         content_field: str,
+        answer_cache: Optional[AnswerCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        rewrite_cache: Optional[QueryRewriteCache] = None,
+        speculative_retrieval: bool = False,
+        speculation_min_similarity: float = 0.8,
+        rewrite_fast_path: bool = False,
+        request_coalescer: Optional[RequestCoalescer] = None,
+        token_usage_stats: Optional[TokenUsageStats] = None,
     ):
         self.search_client = search_client
         self.openai_host = openai_host
@@ -72,6 +93,19 @@ If you cannot generate a search query, return just the number 0.
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.answer_cache = answer_cache
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.rewrite_cache = rewrite_cache
+        self.speculative_retrieval = speculative_retrieval
+        self.speculation_min_similarity = speculation_min_similarity
+        self.speculations = 0
+        self.speculation_wins = 0
+        self.speculation_wasted = 0
+        self.rewrite_fast_path = rewrite_fast_path
+        self.rewrite_timings: dict[str, tuple[int, float]] = {}
+        self.request_coalescer = request_coalescer
+        self.token_usage_stats = token_usage_stats
 
     async def run_until_final_call(
         self,
@@ -81,10 +115,9 @@ If you cannot generate a search query, return just the number 0.
         should_stream: bool = False,
     ) -> tuple:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
+        usage = TokenUsage()
+        timing = ServerTiming()
 
         user_query_request = "Generate search query for: " + history[-1]["user"]
 
@@ -116,92 +149,96 @@ If you cannot generate a search query, return just the number 0.
         )
 
         chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=messages,
-            temperature=0.0,
-            max_tokens=32,
-            n=1,
-            functions=functions,
-            function_call="auto",
-        )
-
-        query_text = self.get_search_query(chat_completion, history[-1]["user"])
+        original_query = history[-1]["user"]
+        speculation: Optional[asyncio.Task] = None
+        with self.span("query_rewrite", overrides) as span:
+            rewrite_started = time.monotonic()
+            query_text = None
+            # A first question can be turned into a keyword query locally instead of by a completion
+            if len(history) == 1 and overrides.get("rewrite_fast_path", self.rewrite_fast_path):
+                rewrite_method = "fast_path"
+                query_text = normalize_search_query(original_query) or original_query
+            # The same messages are rewritten into the same query, so a cached query skips the completion
+            elif self.rewrite_cache:
+                rewrite_method = "cache"
+                rewrite_key = self.rewrite_cache.key(f"{self.chatgpt_deployment}/{self.chatgpt_model}", messages)
+                query_text = self.rewrite_cache.get(rewrite_key)
+            if query_text is None:
+                rewrite_method = "completion"
+                # Retrieval for the question as asked starts alongside the rewrite, in case the rewrite barely changes it
+                if self.speculative_retrieval:
+                    speculation = asyncio.create_task(
+                        self.retrieve(original_query, overrides, filter, usage, timing, stage_prefix="speculative_")
+                    )
+                try:
+                    with self.observe("rewrite", overrides, timing=timing):
+                        chat_completion = await openai.ChatCompletion.acreate(
+                            **chatgpt_args,
+                            model=self.chatgpt_model,
+                            messages=messages,
+                            temperature=0.0,
+                            max_tokens=32,
+                            n=1,
+                            functions=functions,
+                            function_call="auto",
+                        )
+                except BaseException:
+                    if speculation:
+                        self.discard_speculation(speculation)
+                    raise
+                usage.add_completion("rewrite", chat_completion, messages, self.chatgpt_model)
+                query_text = self.get_search_query(chat_completion, original_query)
+                if self.rewrite_cache:
+                    self.rewrite_cache.set(rewrite_key, query_text)
+            self.record_rewrite(rewrite_method, time.monotonic() - rewrite_started, original_query, query_text)
+            span.set_attribute("app.rewrite_method", rewrite_method)
+            span.set_attribute("app.cache_hit", rewrite_method == "cache")
+            self.set_usage_attributes(span, usage, "rewrite")
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=query_text)
-            query_vector = embedding["data"][0]["embedding"]
-        else:
-            query_vector = None
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        results = None
+        if speculation:
+            results = await self.use_speculation(speculation, query_text, original_query)
+            if results is not None:
+                query_text = original_query
+        if results is None:
+            results = await self.retrieve(query_text, overrides, filter, usage, timing)
+
+        # Only show the text query if the retrieval mode uses text
         if not has_text:
             query_text = None
 
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="en-us",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
         content = "\n".join(results)
 
-        follow_up_questions_prompt = (
-            self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
-        )
-
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-
-        # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
-        prompt_override = overrides.get("prompt_template")
-        if prompt_override is None:
-            system_message = self.system_message_chat_conversation.format(
-                injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
-            )
-        elif prompt_override.startswith(">>>"):
-            system_message = self.system_message_chat_conversation.format(
-                injected_prompt=prompt_override[3:] + "\n", follow_up_questions_prompt=follow_up_questions_prompt
+        with self.span("build_prompt", overrides) as span:
+            follow_up_questions_prompt = (
+                self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
             )
-        else:
-            system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
-        messages = self.get_messages_from_history(
-            system_message,
-            self.chatgpt_model,
-            history,
-            history[-1]["user"] + "\n\nSources:\n" + content,
-            max_tokens=self.chatgpt_token_limit,  # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-        )
+            # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+
+            # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
+            prompt_override = overrides.get("prompt_template")
+            if prompt_override is None:
+                system_message = self.system_message_chat_conversation.format(
+                    injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
+                )
+            elif prompt_override.startswith(">>>"):
+                system_message = self.system_message_chat_conversation.format(
+                    injected_prompt=prompt_override[3:] + "\n", follow_up_questions_prompt=follow_up_questions_prompt
+                )
+            else:
+                system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
+
+            messages = self.get_messages_from_history(
+                system_message,
+                self.chatgpt_model,
+                history,
+                history[-1]["user"] + "\n\nSources:\n" + content,
+                max_tokens=self.chatgpt_token_limit,  # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
+            )
+            usage.add("answer", count_prompt_tokens(messages, self.chatgpt_model))
+            self.set_usage_attributes(span, usage, "answer")
         msg_to_display = "\n\n".join([str(message) for message in messages])
 
         extra_info = {
@@ -219,35 +256,130 @@ If you cannot generate a search query, return just the number 0.
             n=1,
             stream=should_stream,
         )
-        return (extra_info, chat_coroutine)
+        return (extra_info, chat_coroutine, usage, timing)
+
+    async def retrieve(
+        self,
+        query_text: str,
+        overrides: dict[str, Any],
+        filter: Optional[str],
+        usage: Optional[TokenUsage] = None,
+        timing: Optional[ServerTiming] = None,
+        stage_prefix: str = "",
+    ) -> list[str]:
+        # A speculative retrieval is timed under stages of its own, as a discarded one is cut short and runs alongside
+        # the rewrite, so that the timings of the embedding and search stages only include retrievals that were used
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+
+        # If retrieval mode includes vectors, compute an embedding for the query
+        if has_vector:
+            with self.observe(f"{stage_prefix}embedding", overrides, timing=timing), self.span(
+                "embed_query", overrides
+            ):
+                query_vector = await self.compute_embedding(query_text, usage)
+        else:
+            query_vector = None
+
+        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text), and only keep
+        # the text query if the retrieval mode uses text
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
+        top = overrides.get("top", 3)
+        search_stage = f"{stage_prefix}semantic_search" if use_semantic_ranker else f"{stage_prefix}search"
+        with self.observe(search_stage, overrides, timing=timing), self.span(
+            "search", overrides, top=top, semantic_ranker=use_semantic_ranker
+        ) as span:
+            results = await self.search(
+                query_text if has_text else None,
+                query_vector,
+                filter,
+                top,
+                use_semantic_ranker=use_semantic_ranker,
+                use_semantic_captions=use_semantic_captions,
+            )
+            span.set_attribute("app.result_count", len(results))
+            return results
+
+    def record_rewrite(self, method: str, duration: float, original_query: str, query_text: str):
+        count, total = self.rewrite_timings.get(method, (0, 0.0))
+        self.rewrite_timings[method] = (count + 1, total + duration)
+        # Logged per request, so the queries of the fast path can be compared with those of the completion
+        logging.info("Query rewrite by %s took %.3fs: %r -> %r", method, duration, original_query, query_text)
+
+    def rewrite_stats(self) -> dict[str, Any]:
+        return {
+            method: {"count": count, "total_seconds": total, "mean_seconds": total / count}
+            for method, (count, total) in self.rewrite_timings.items()
+        }
+
+    async def use_speculation(
+        self, speculation: asyncio.Task, query_text: str, original_query: str
+    ) -> Optional[list[str]]:
+        """
+        Returns the results of the speculative retrieval if the rewritten query is close enough to the question as
+        asked, or None after cancelling it if the rewritten query has to be retrieved instead.
+        """
+        self.speculations += 1
+        if query_similarity(query_text, original_query) >= self.speculation_min_similarity:
+            try:
+                results = await speculation
+                self.speculation_wins += 1
+                return results
+            except Exception:
+                logging.exception("Speculative retrieval failed")
+        else:
+            self.discard_speculation(speculation)
+        self.speculation_wasted += 1
+        return None
+
+    def discard_speculation(self, speculation: asyncio.Task):
+        # A speculation can still fail with another exception than the cancellation, e.g. while its clients clean up,
+        # which asyncio would log as never retrieved since nothing awaits it, so its outcome is consumed when it ends
+        speculation.cancel()
+        speculation.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def speculation_stats(self) -> dict[str, Any]:
+        return {
+            "speculations": self.speculations,
+            "wins": self.speculation_wins,
+            "wasted": self.speculation_wasted,
+            "win_rate": self.speculation_wins / self.speculations if self.speculations else 0.0,
+        }
+
+    def get_request_key(
+        self, history: list[dict[str, str]], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> str:
+        return make_key(
+            "chat",
+            self.chatgpt_deployment,
+            self.chatgpt_model,
+            normalize_question(history[-1]["user"]),
+            history[:-1],
+            overrides,
+            self.build_filter(overrides, auth_claims),
+        )
 
     async def run_without_streaming(
         self, history: list[dict[str, str]], overrides: dict[str, Any], auth_claims: dict[str, Any]
     ) -> dict[str, Any]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=False
+        return await self.complete(
+            self.get_request_key(history, overrides, auth_claims),
+            overrides,
+            auth_claims,
+            lambda should_stream: self.run_until_final_call(history, overrides, auth_claims, should_stream),
         )
-        chat_resp = await chat_coroutine
-        chat_resp.choices[0]["extra_args"] = extra_info
-        return chat_resp
 
     async def run_with_streaming(
         self, history: list[dict[str, str]], overrides: dict[str, Any], auth_claims: dict[str, Any]
     ) -> AsyncGenerator[dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=True
-        )
-        yield {
-            "choices": [
-                {"delta": {"role": self.ASSISTANT}, "extra_args": extra_info, "finish_reason": None, "index": 0}
-            ],
-            "object": "chat.completion.chunk",
-        }
-
-        async for event in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            if event["choices"]:
-                yield event
+        async for event in self.complete_with_streaming(
+            self.get_request_key(history, overrides, auth_claims),
+            overrides,
+            auth_claims,
+            lambda should_stream: self.run_until_final_call(history, overrides, auth_claims, should_stream),
+        ):
+            yield event
 
     def get_messages_from_history(
         self,
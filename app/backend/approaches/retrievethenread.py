@@ -1,12 +1,17 @@
-from typing import Any, Optional
+from typing import Any, AsyncGenerator, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
+from core.answercache import AnswerCache, normalize_question
+from core.cache import make_key
+from core.coalesce import RequestCoalescer
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
-from text import nonewlines
+from core.searchcache import SearchCache
+from core.servertiming import ServerTiming
+from core.tokenusage import TokenUsage, TokenUsageStats
 
 
 class RetrieveThenReadApproach(Approach):
@@ -16,6 +21,8 @@ class RetrieveThenReadApproach(Approach):
     (answer) with that prompt.
     """
 
+    endpoint = "/ask"
+
     system_chat_template = (
         "You are an intelligent assistant helping Contoso Inc employees with their healthcare plan questions and employee handbook questions. "
         + "Use 'you' to refer to the individual asking the questions even if they ask with 'I'. "
@@ -47,6 +54,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         embedding_model: str,
         sourcepage_field: str,
         content_field: str,
+        answer_cache: Optional[AnswerCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        request_coalescer: Optional[RequestCoalescer] = None,
+        token_usage_stats: Optional[TokenUsageStats] = None,
     ):
         self.search_client = search_client
         self.openai_host = openai_host
@@ -56,19 +68,37 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.answer_cache = answer_cache
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.request_coalescer = request_coalescer
+        self.token_usage_stats = token_usage_stats
+
+    def get_request_key(self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> str:
+        return make_key(
+            "ask",
+            self.chatgpt_deployment,
+            self.chatgpt_model,
+            normalize_question(q),
+            overrides,
+            self.build_filter(overrides, auth_claims),
+        )
 
-    async def run(self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> dict[str, Any]:
+    async def run_until_final_call(
+        self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any], should_stream: bool = False
+    ) -> tuple:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
+        usage = TokenUsage()
+        timing = ServerTiming()
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=q)
-            query_vector = embedding["data"][0]["embedding"]
+            with self.observe("embedding", overrides, timing=timing), self.span("embed_query", overrides):
+                query_vector = await self.compute_embedding(q, usage)
         else:
             query_vector = None
 
@@ -76,59 +106,47 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         query_text = q if has_text else ""
 
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
+        with self.observe("semantic_search" if use_semantic_ranker else "search", overrides, timing=timing), self.span(
+            "search", overrides, top=top, semantic_ranker=use_semantic_ranker
+        ) as span:
+            results = await self.search(
                 query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="en-us",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
+                query_vector,
+                filter,
+                top,
+                use_semantic_ranker=use_semantic_ranker,
+                use_semantic_captions=use_semantic_captions,
             )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+            span.set_attribute("app.result_count", len(results))
         content = "\n".join(results)
 
-        message_builder = MessageBuilder(
-            overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
-        )
+        with self.span("build_prompt", overrides) as span:
+            message_builder = MessageBuilder(
+                overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
+            )
 
-        # add user question
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.append_message("user", user_content)
+            # add user question
+            user_content = q + "\n" + f"Sources:\n {content}"
+            message_builder.append_message("user", user_content)
 
-        # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
-        message_builder.append_message("assistant", self.answer)
-        message_builder.append_message("user", self.question)
+            # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
+            message_builder.append_message("assistant", self.answer)
+            message_builder.append_message("user", self.question)
+
+            messages = message_builder.messages
+            usage.add("answer", message_builder.token_length)
+            self.set_usage_attributes(span, usage, "answer")
 
-        messages = message_builder.messages
         chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
+        chat_coroutine = openai.ChatCompletion.acreate(
             **chatgpt_args,
             model=self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.3,
             max_tokens=1024,
             n=1,
+            stream=should_stream,
         )
 
         extra_info = {
@@ -136,5 +154,23 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>"
             + "\n\n".join([str(message) for message in messages]),
         }
-        chat_completion.choices[0]["extra_args"] = extra_info
-        return chat_completion
+        return (extra_info, chat_coroutine, usage, timing)
+
+    async def run(self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> dict[str, Any]:
+        return await self.complete(
+            self.get_request_key(q, overrides, auth_claims),
+            overrides,
+            auth_claims,
+            lambda should_stream: self.run_until_final_call(q, overrides, auth_claims, should_stream),
+        )
+
+    async def run_with_streaming(
+        self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> AsyncGenerator[dict, None]:
+        async for event in self.complete_with_streaming(
+            self.get_request_key(q, overrides, auth_claims),
+            overrides,
+            auth_claims,
+            lambda should_stream: self.run_until_final_call(q, overrides, auth_claims, should_stream),
+        ):
+            yield event
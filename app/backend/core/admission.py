@@ -0,0 +1,115 @@
+import asyncio
+import math
+import time
+from typing import Any, AsyncGenerator, Optional
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionSlot:
+    """
+    A slot that a request holds while it is answered. Releasing it again has no effect, so that whichever of the
+    places that release it comes first releases it.
+    """
+
+    def __init__(self, acquired_at: float):
+        self.acquired_at = acquired_at
+        self.released = False
+
+
+class AdmissionController:
+    """
+    Limits the number of requests a worker answers at once. Requests beyond the limit wait in a bounded queue, and are
+    rejected right away with 429 when the queue is full, or with 503 when they waited longer than max_queue_time.
+    Rejections suggest retrying after the mean time a request holds its slot, so clients back off longer the slower
+    the answers are.
+    Attributes:
+        max_concurrency (int): The maximum number of requests answered at once, or 0 for no limit.
+        max_queue_size (int): The maximum number of requests waiting for a slot.
+        max_queue_time (float): Seconds a request waits for a slot before it is rejected.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_size: int, max_queue_time: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_queue_time = max_queue_time
+        self.slots: Optional[asyncio.Semaphore] = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.inflight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        # Exponentially weighted mean of the seconds a request holds its slot
+        self.mean_hold_seconds = 0.0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.mean_hold_seconds))
+
+    def saturated(self) -> bool:
+        return self.slots is not None and self.slots.locked() and self.queued >= self.max_queue_size
+
+    async def acquire(self) -> AdmissionSlot:
+        """
+        Waits for a slot and returns it, to be passed to release.
+        Raises AdmissionRejectedError if the queue is full or the wait takes longer than max_queue_time.
+        """
+        if self.slots and not self.slots.locked():
+            await self.slots.acquire()
+        elif self.slots:
+            if self.saturated():
+                self.rejected_queue_full += 1
+                raise AdmissionRejectedError("too many requests waiting", 429, self.retry_after())
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.max_queue_time)
+            except asyncio.TimeoutError:
+                self.rejected_timeout += 1
+                raise AdmissionRejectedError("timed out waiting for capacity", 503, self.retry_after())
+            finally:
+                self.queued -= 1
+        self.inflight += 1
+        self.admitted += 1
+        return AdmissionSlot(time.monotonic())
+
+    def release(self, slot: AdmissionSlot):
+        if slot.released:
+            return
+        slot.released = True
+        self.inflight -= 1
+        if self.slots:
+            self.slots.release()
+        self.mean_hold_seconds += 0.1 * (time.monotonic() - slot.acquired_at - self.mean_hold_seconds)
+
+    def release_when_done(self, slot: AdmissionSlot):
+        """
+        Releases the slot when the current task ends, however it ends. The task that handles a request also sends its
+        response, so this releases the slot of a streamed response whose stream never started, e.g. because the client
+        disconnected before the body was sent.
+        """
+        if task := asyncio.current_task():
+            task.add_done_callback(lambda task: self.release(slot))
+
+    async def hold(self, slot: AdmissionSlot, events: AsyncGenerator[Any, None]) -> AsyncGenerator[Any, None]:
+        # Keeps the slot of a streamed response until the stream ends or the client disconnects
+        try:
+            async for event in events:
+                yield event
+        finally:
+            self.release(slot)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_size": self.max_queue_size,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "mean_hold_seconds": self.mean_hold_seconds,
+        }
@@ -0,0 +1,89 @@
+import json
+from typing import Any, Iterator, Optional
+
+from .cache import LRUCache, make_key
+
+# Answers cut short by the token limit or by the content filter are not worth repeating
+UNCACHEABLE_FINISH_REASONS = ["length", "content_filter"]
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.casefold().split())
+
+
+class AnswerCache:
+    """
+    An exact-match cache of answers, keyed by everything that determines an answer: the approach, the normalized
+    question, the earlier conversation, the overrides and the search filter. Including the filter means that users
+    whose documents are trimmed by access control never share answers.
+    An answer is stored as the message, the extra_args with the data points and thoughts, and the finish reason,
+    so that an answer generated with or without streaming can be returned either way.
+    Attributes:
+        max_size (int): The maximum total size of the cached answers, in characters of their JSON.
+        ttl (float): Seconds after which a cached answer expires.
+    """
+
+    replay_chunk_size = 64
+
+    def __init__(self, max_size: int, ttl: float):
+        self.answers: LRUCache[str, str] = LRUCache(max_size, ttl=ttl, sizeof=len)
+
+    def key(self, *parts: Any) -> str:
+        return make_key(*parts)
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        answer = self.answers.get(key)
+        return json.loads(answer) if answer is not None else None
+
+    def set(self, key: str, message: dict[str, Any], extra_args: dict[str, Any], finish_reason: Optional[str]):
+        if finish_reason in UNCACHEABLE_FINISH_REASONS:
+            return
+        answer = {"message": message, "extra_args": extra_args, "finish_reason": finish_reason}
+        self.answers.set(key, json.dumps(answer, ensure_ascii=False))
+
+    def clear(self):
+        self.answers.clear()
+
+    def as_completion(self, answer: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": answer["message"],
+                    "finish_reason": answer["finish_reason"],
+                    "extra_args": answer["extra_args"],
+                }
+            ],
+        }
+
+    def as_completion_chunks(self, answer: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        # Replays the answer in the shape of a streamed completion, with the extra_args in the first chunk
+        message = answer["message"]
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": message["role"]},
+                    "extra_args": answer["extra_args"],
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+        content = message.get("content") or ""
+        for i in range(0, len(content), self.replay_chunk_size):
+            yield {
+                "choices": [{"delta": {"content": content[i : i + self.replay_chunk_size]}, "index": 0}],
+                "object": "chat.completion.chunk",
+            }
+        yield {
+            "choices": [{"delta": {}, "finish_reason": answer["finish_reason"], "index": 0}],
+            "object": "chat.completion.chunk",
+        }
+
+    def stats(self) -> dict[str, Any]:
+        stats = self.answers.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
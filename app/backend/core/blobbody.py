@@ -0,0 +1,146 @@
+import asyncio
+from types import TracebackType
+from typing import IO, Any, AsyncIterator, ContextManager, Optional
+
+from azure.core import MatchConditions
+from azure.storage.blob.aio import BlobClient
+from quart.wrappers.response import ResponseBody
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+from .metrics import observe_stage
+
+
+def resolve_range(begin: int, end: Optional[int], size: int) -> tuple[int, int]:
+    # Suffix ranges (bytes=-500) arrive as a negative begin
+    if begin < 0:
+        begin = max(size + begin, 0)
+    end = size if end is None else min(size, end)
+    if begin >= end:
+        raise RequestedRangeNotSatisfiable(length=size)
+    return begin, end
+
+
+class BlobBody(ResponseBody):
+    """
+    A Quart response body that streams a blob from Azure Storage chunk by chunk instead of buffering it in memory.
+    Quart sets the byte range to send when answering a Range request, which is mapped onto an offset/length download.
+    Attributes:
+        blob_client (BlobClient): The client of the blob to stream.
+        size (int): The size of the whole blob in bytes.
+        etag (str): The ETag of the blob the response headers were built from, so a blob that changes
+            mid-response fails the download instead of mixing two versions.
+        endpoint (Optional[str]): The endpoint whose blob_download stage times the download, from requesting the
+            blob until its last chunk was sent or the response was abandoned.
+    """
+
+    def __init__(self, blob_client: BlobClient, size: int, etag: Optional[str] = None, endpoint: Optional[str] = None):
+        self.blob_client = blob_client
+        self.size = size
+        self.etag = etag
+        self.endpoint = endpoint
+        self.begin = 0
+        self.end = size
+        self.chunks: Optional[AsyncIterator[bytes]] = None
+        self.download_stage: Optional[ContextManager[None]] = None
+
+    async def __aenter__(self) -> "BlobBody":
+        if self.endpoint:
+            self.download_stage = observe_stage(self.endpoint, "blob_download")
+            self.download_stage.__enter__()
+        try:
+            await self.start_download()
+        except BaseException as e:
+            # The body is not exited when entering it fails, which would leave the stage open
+            self.end_download_stage(type(e), e, e.__traceback__)
+            raise
+        return self
+
+    async def start_download(self):
+        if self.end > self.begin:
+            conditions: dict[str, Any] = (
+                {"etag": self.etag, "match_condition": MatchConditions.IfNotModified} if self.etag else {}
+            )
+            if self.begin == 0 and self.end == self.size:
+                downloader = await self.blob_client.download_blob(**conditions)
+            else:
+                downloader = await self.blob_client.download_blob(
+                    offset=self.begin, length=self.end - self.begin, **conditions
+                )
+            self.chunks = downloader.chunks()
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        self.chunks = None
+        self.end_download_stage(exc_type, exc_value, tb)
+
+    def end_download_stage(
+        self, exc_type: Optional[type], exc_value: Optional[BaseException], tb: Optional[TracebackType]
+    ):
+        if self.download_stage:
+            self.download_stage.__exit__(exc_type, exc_value, tb)
+            self.download_stage = None
+
+    def __aiter__(self) -> "BlobBody":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.chunks is None:
+            raise StopAsyncIteration()
+        return await self.chunks.__anext__()
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        self.begin, self.end = resolve_range(begin, end, self.size)
+        return self.size
+
+
+class CachedBlobBody(ResponseBody):
+    """
+    A Quart response body for a blob from the content cache, read either from memory or from its file in the
+    cache directory. The file is opened before the response is returned, so that the cache removing it meanwhile
+    does not cut the response short. Like BlobBody it supports a byte range being set.
+    """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, size: int, data: Optional[bytes] = None, file: Optional[IO[bytes]] = None):
+        self.size = size
+        self.data = data
+        self.file = file
+        self.begin = 0
+        self.end = size
+        self.position = 0
+
+    async def __aenter__(self) -> "CachedBlobBody":
+        self.position = self.begin
+        if self.file:
+            await asyncio.to_thread(self.file.seek, self.begin)
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __aiter__(self) -> "CachedBlobBody":
+        return self
+
+    async def __anext__(self) -> bytes:
+        read_size = min(self.buffer_size, self.end - self.position)
+        if read_size <= 0:
+            raise StopAsyncIteration()
+        if self.data is not None:
+            chunk = self.data[self.position : self.position + read_size]
+        elif self.file is not None:
+            chunk = await asyncio.to_thread(self.file.read, read_size)
+        else:
+            chunk = b""
+        if not chunk:
+            raise StopAsyncIteration()
+        self.position += len(chunk)
+        return chunk
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        self.begin, self.end = resolve_range(begin, end, self.size)
+        return self.size
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Any, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.storage.blob import BlobProperties
+from azure.storage.blob.aio import BlobClient
+
+from .cache import LRUCache, SingleFlight
+
+
+class CachedBlob:
+    """
+    A blob served by /content, with either its content held in memory, its content stored in the cache
+    directory, or neither if the blob is too large to be cached.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        etag: str,
+        size: int,
+        content_type: Optional[str],
+        last_modified: Optional[datetime],
+        data: Optional[bytes] = None,
+        path: Optional[Path] = None,
+    ):
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.data = data
+        self.path = path
+        self.validated_at = time.monotonic()
+
+    @classmethod
+    def from_properties(cls, properties: BlobProperties) -> "CachedBlob":
+        return cls(
+            properties.name,
+            properties.etag,
+            properties.size,
+            properties.content_settings.content_type,
+            properties.last_modified,
+        )
+
+    @property
+    def is_cached(self) -> bool:
+        return self.data is not None or self.path is not None
+
+
+class BlobCache:
+    """
+    A two-tier cache for the blobs served by /content. Small blobs are kept in an in-memory LRU, larger ones are
+    written to a cache directory that is evicted by total size, and blobs too large for either are not cached.
+    Entries are stored per blob name and ETag, and are revalidated with a conditional request to Blob Storage once
+    they are older than the ttl. Concurrent misses for the same blob share a single download.
+    """
+
+    def __init__(
+        self,
+        memory_max_size: int,
+        memory_max_entry_size: int,
+        disk_max_size: int,
+        disk_max_entry_size: int,
+        ttl: float,
+        directory: Optional[str] = None,
+    ):
+        self.memory_max_entry_size = min(memory_max_entry_size, memory_max_size)
+        self.disk_max_entry_size = min(disk_max_entry_size, disk_max_size)
+        self.ttl = ttl
+        # Each worker gets its own directory so that workers never evict each other's files
+        self.directory = Path(tempfile.mkdtemp(prefix="content-cache-", dir=directory))
+        self.memory: LRUCache[str, CachedBlob] = LRUCache(memory_max_size, sizeof=lambda blob: blob.size)
+        self.disk: LRUCache[str, CachedBlob] = LRUCache(
+            disk_max_size, sizeof=lambda blob: blob.size, on_evict=self.remove_file
+        )
+        self.downloads: SingleFlight[str, CachedBlob] = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.uncacheable = 0
+
+    async def get(self, blob_client: BlobClient) -> CachedBlob:
+        name = blob_client.blob_name
+        cached_blob = self.memory.get(name) or self.disk.get(name)
+        if cached_blob and time.monotonic() - cached_blob.validated_at < self.ttl:
+            self.hits += 1
+            return cached_blob
+        return await self.downloads.do(name, lambda: self.fetch(blob_client, cached_blob))
+
+    async def fetch(self, blob_client: BlobClient, cached_blob: Optional[CachedBlob]) -> CachedBlob:
+        if cached_blob:
+            try:
+                properties = await blob_client.get_blob_properties(
+                    etag=cached_blob.etag, match_condition=MatchConditions.IfModified
+                )
+            except ResourceNotModifiedError:
+                self.revalidations += 1
+                self.hits += 1
+                cached_blob.validated_at = time.monotonic()
+                return cached_blob
+            self.remove(cached_blob.name)
+        else:
+            properties = await blob_client.get_blob_properties()
+
+        self.misses += 1
+        blob = CachedBlob.from_properties(properties)
+        if blob.size > max(self.memory_max_entry_size, self.disk_max_entry_size):
+            self.uncacheable += 1
+            return blob
+
+        downloader = await blob_client.download_blob(etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+        if blob.size <= self.memory_max_entry_size:
+            blob.data = b"".join([chunk async for chunk in downloader.chunks()])
+            self.memory.set(blob.name, blob)
+        else:
+            key = hashlib.sha256(f"{blob.name}:{blob.etag}".encode()).hexdigest()
+            path = self.directory / key
+            partial_path = self.directory / f"{key}.partial"
+            try:
+                with open(partial_path, "wb") as f:
+                    async for chunk in downloader.chunks():
+                        await asyncio.to_thread(f.write, chunk)
+                os.replace(partial_path, path)
+            finally:
+                if partial_path.exists():
+                    partial_path.unlink()
+            blob.path = path
+            self.disk.set(blob.name, blob)
+        return blob
+
+    async def open(self, blob: CachedBlob) -> Optional[IO[bytes]]:
+        """
+        Opens the file of a blob from the disk tier, or returns None if the file was removed since the blob was
+        returned by get, e.g. evicted by a concurrent miss or replaced by a new version. An open file stays readable
+        after it is removed, so a response that opened it can be sent in full.
+        """
+        if blob.path is None:
+            return None
+        try:
+            return await asyncio.to_thread(open, blob.path, "rb")
+        except FileNotFoundError:
+            return None
+
+    def remove(self, name: str):
+        self.memory.remove(name)
+        self.disk.remove(name)
+
+    def remove_file(self, name: str, blob: CachedBlob):
+        if blob.path:
+            try:
+                blob.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.memory.clear()
+        self.disk.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "uncacheable": self.uncacheable,
+            "coalesced": self.downloads.coalesced,
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats(),
+        }
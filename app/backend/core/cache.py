@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, Optional, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+def make_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A least-recently-used cache with an optional time to live, bounded by the total size of its entries.
+    Attributes:
+        max_size (int): The maximum total size of the entries. Each entry counts as 1 unless sizeof is given.
+        ttl (float): Seconds after which an entry expires, or None to keep entries until they are evicted.
+        sizeof (Callable): Returns the size of a value, e.g. its length in bytes.
+        on_evict (Callable): Called with the key and value of every entry that is evicted, expired or removed.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = None,
+        sizeof: Optional[Callable[[V], int]] = None,
+        on_evict: Optional[Callable[[K, V], None]] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.entries: OrderedDict[K, tuple[float, int, V]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            self.remove(key)
+            self.evictions += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, key: K, value: V):
+        self.remove(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        self.entries[key] = (time.monotonic(), size, value)
+        self.size += size
+        while self.size > self.max_size:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, key: K) -> Optional[V]:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        if self.on_evict:
+            self.on_evict(key, entry[2])
+        return entry[2]
+
+    def clear(self):
+        for key in list(self.entries):
+            self.remove(key)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Coalesces concurrent calls for the same key into a single execution whose result is shared by all callers.
+    A caller that is cancelled while waiting does not cancel the shared execution for the others.
+    """
+
+    def __init__(self):
+        self.calls: dict[K, asyncio.Future[V]] = {}
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    async def do(self, key: K, fn: Callable[[], Awaitable[V]]) -> V:
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self.calls[key] = call
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(call)
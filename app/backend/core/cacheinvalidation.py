@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+from .answercache import AnswerCache
+from .logstore import LogStore
+from .searchcache import SearchCache
+
+
+class CacheInvalidator:
+    """
+    Invalidates the search results and answers cached by every worker. Each worker has its own caches, so an
+    invalidation is recorded in the SQLite store that the workers share, and each worker reads the invalidations
+    recorded since it last looked every interval and applies them to its caches. The worker that records an
+    invalidation applies it before returning, the others within interval seconds.
+    Attributes:
+        log_store (LogStore): The store the invalidations are recorded in.
+        search_cache (Optional[SearchCache]): The search results cache of this worker, if enabled.
+        answer_cache (Optional[AnswerCache]): The answer cache of this worker, if enabled.
+        interval (float): Seconds between two reads of the recorded invalidations.
+    """
+
+    def __init__(
+        self,
+        log_store: LogStore,
+        search_cache: Optional[SearchCache],
+        answer_cache: Optional[AnswerCache],
+        interval: float = 1.0,
+    ):
+        self.log_store = log_store
+        self.search_cache = search_cache
+        self.answer_cache = answer_cache
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+        # The id of the last invalidation applied, invalidations from before the worker started have nothing to drop
+        self.last_id = 0
+        self.applied = 0
+
+    async def start(self):
+        self.last_id = await self.log_store.get_last_cache_invalidation()
+        self.task = asyncio.create_task(self.poll())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def invalidate(self, source: Optional[str] = None):
+        await self.log_store.add_cache_invalidation(source)
+        await self.apply_new_invalidations()
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.apply_new_invalidations()
+            except Exception:
+                logging.exception("Failed to read cache invalidations")
+
+    async def apply_new_invalidations(self):
+        for id, source in await self.log_store.get_cache_invalidations(self.last_id):
+            # Read by both the poll and an invalidation of this worker, which may overlap
+            if id <= self.last_id:
+                continue
+            if self.search_cache:
+                self.search_cache.invalidate(source)
+            if self.answer_cache:
+                self.answer_cache.clear()
+            self.last_id = id
+            self.applied += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {"applied": self.applied, "last_id": self.last_id}
@@ -0,0 +1,100 @@
+import asyncio
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Generic,
+    Optional,
+    TypeVar,
+)
+
+from .cache import SingleFlight
+
+T = TypeVar("T")
+
+
+class Broadcast(Generic[T]):
+    """
+    Reads an async iterator in a background task and buffers its items, so that any number of subscribers can each
+    iterate over all of them, including subscribers that join after the first items were read.
+    The task is cancelled when the last subscriber leaves before the iterator is exhausted, and on_done is called
+    once the iterator is exhausted, has failed or was cancelled.
+    """
+
+    def __init__(self, source: AsyncIterator[T], on_done: Optional[Callable[[], Any]] = None):
+        self.on_done = on_done
+        self.items: list[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task = asyncio.create_task(self.read(source))
+
+    async def read(self, source: AsyncIterator[T]):
+        try:
+            async for item in source:
+                self.items.append(item)
+                async with self.changed:
+                    self.changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            if self.on_done:
+                self.on_done()
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def subscribe(self) -> AsyncGenerator[T, None]:
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: position < len(self.items) or self.done)
+                if position < len(self.items):
+                    position += 1
+                    yield self.items[position - 1]
+                elif self.error:
+                    raise self.error
+                else:
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+
+class RequestCoalescer:
+    """
+    Registry of the requests being answered, keyed like the answer cache, so that identical concurrent requests share
+    one execution. Followers of a streamed answer receive every chunk of the leader's stream through a Broadcast.
+    """
+
+    def __init__(self):
+        self.calls: SingleFlight[str, Any] = SingleFlight()
+        self.streams: dict[str, Broadcast] = {}
+        self.coalesced_streams = 0
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        return await self.calls.do(key, fn)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[T]]) -> AsyncGenerator[T, None]:
+        broadcast = self.streams.get(key)
+        if broadcast is None or broadcast.done:
+            broadcast = Broadcast(fn(), on_done=lambda: self.streams.pop(key, None))
+            self.streams[key] = broadcast
+        else:
+            self.coalesced_streams += 1
+        async for item in broadcast.subscribe():
+            yield item
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "inflight": len(self.calls),
+            "inflight_streams": len(self.streams),
+            "coalesced": self.calls.coalesced,
+            "coalesced_streams": self.coalesced_streams,
+        }
@@ -0,0 +1,41 @@
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+
+from .cache import LRUCache, SingleFlight
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    A cache of query embeddings keyed by the embedding model and the whitespace-normalized text. Vectors are stored
+    as float32 arrays, a quarter of the memory of a list of Python floats, and the cache is bounded by their total
+    size in bytes. Concurrent misses for the same text share a single embedding request.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.embeddings: LRUCache[tuple[str, str], np.ndarray] = LRUCache(
+            max_size, ttl=ttl, sizeof=lambda vector: vector.nbytes
+        )
+        self.requests: SingleFlight[tuple[str, str], np.ndarray] = SingleFlight()
+
+    async def get(self, model: str, text: str, embed: Callable[[str], Awaitable[list[float]]]) -> list[float]:
+        """
+        Returns the embedding of text, calling embed with the normalized text if it is not cached.
+        """
+        key = (model, normalize_text(text))
+        vector = self.embeddings.get(key)
+        if vector is None:
+            vector = await self.requests.do(key, lambda: self.fetch(key, embed))
+        return vector.tolist()
+
+    async def fetch(self, key: tuple[str, str], embed: Callable[[str], Awaitable[list[float]]]) -> np.ndarray:
+        vector = np.array(await embed(key[1]), dtype=np.float32)
+        self.embeddings.set(key, vector)
+        return vector
+
+    def stats(self) -> dict[str, Any]:
+        return {**self.embeddings.stats(), "coalesced": self.requests.coalesced}
@@ -0,0 +1,47 @@
+import csv
+import io
+import json
+import zlib
+from typing import Any, AsyncIterator
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+async def logs_as_ndjson(chunks: AsyncIterator[list[dict[str, Any]]]) -> AsyncIterator[bytes]:
+    async for logs in chunks:
+        yield "".join(json.dumps(log, ensure_ascii=False) + "\n" for log in logs).encode()
+
+
+async def logs_as_csv(chunks: AsyncIterator[list[dict[str, Any]]], fields: list[str]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    async for logs in chunks:
+        writer.writerows(logs)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Without logs the export is just the header
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def gzipped(data: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # A streaming compressor with a gzip header, so each chunk is compressed as it is sent
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    async for chunk in data:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def export_logs_as(
+    format: str, chunks: AsyncIterator[list[dict[str, Any]]], fields: list[str], compress: bool = False
+) -> AsyncIterator[bytes]:
+    if format == "ndjson":
+        data = logs_as_ndjson(chunks)
+    elif format == "csv":
+        data = logs_as_csv(chunks, fields)
+    else:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    return gzipped(data) if compress else data
@@ -0,0 +1,459 @@
+import asyncio
+import base64
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+LOG_FIELDS = ["id", "uuid", "feedback", "comment", "timestamp", "thought_process"]
+# thought_process holds the whole prompt, so it is only returned when asked for
+DEFAULT_LOG_FIELDS = ["id", "uuid", "feedback", "comment", "timestamp"]
+# The rating of a chat in the UI, which the stats count. What the user wrote along with it is the comment.
+FEEDBACK_VALUES = ["good", "bad"]
+MAX_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 1000
+
+# Pages are read newest first with keyset pagination on (timestamp, id), and every filter has an index
+# ending in (timestamp, id), so that each page is a range scan of an index.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs
+    (id INTEGER PRIMARY KEY, uuid TEXT, feedback TEXT, timestamp NUMERIC, thought_process TEXT, comment TEXT);
+DROP INDEX IF EXISTS logs_uuid;
+CREATE INDEX IF NOT EXISTS logs_timestamp ON logs (timestamp, id);
+CREATE INDEX IF NOT EXISTS logs_uuid_timestamp ON logs (uuid, timestamp, id);
+CREATE INDEX IF NOT EXISTS logs_feedback_timestamp ON logs (feedback, timestamp, id);
+CREATE TABLE IF NOT EXISTS cache_invalidations (id INTEGER PRIMARY KEY, source TEXT, timestamp NUMERIC);
+"""
+
+# Counts of logs per feedback value in hourly and daily buckets of the (ms) timestamp, kept up to date by a trigger
+# in the transaction that inserts the logs, so that stats are read from a handful of rows instead of the whole log.
+# Only the values in FEEDBACK_VALUES are stored as feedback, so there are at most three rows per bucket, with a
+# missing feedback counted as ''.
+STATS_PERIODS = {"hour": 3600000, "day": 86400000}
+ROLLUP_SCHEMA = (
+    """
+CREATE TABLE IF NOT EXISTS logs_rollup
+    (period TEXT NOT NULL, bucket INTEGER NOT NULL, feedback TEXT NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (period, bucket, feedback)) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS logs_rollup_insert AFTER INSERT ON logs WHEN NEW.timestamp IS NOT NULL BEGIN
+"""
+    + "".join(
+        f"""    INSERT INTO logs_rollup VALUES
+        ('{period}', CAST(NEW.timestamp / {length} AS INTEGER) * {length}, IFNULL(NEW.feedback, ''), 1)
+        ON CONFLICT DO UPDATE SET count = count + 1;
+"""
+        for period, length in STATS_PERIODS.items()
+    )
+    + "END;\n"
+)
+REBUILD_ROLLUP = "DELETE FROM logs_rollup;\n" + "".join(
+    f"""INSERT INTO logs_rollup
+    SELECT '{period}', CAST(timestamp / {length} AS INTEGER) * {length} AS bucket, IFNULL(feedback, '') AS feedback,
+        COUNT(*)
+    FROM logs WHERE timestamp IS NOT NULL GROUP BY bucket, IFNULL(feedback, '');
+"""
+    for period, length in STATS_PERIODS.items()
+)
+# Before the comment had its own column, the UI sent the comment as the feedback and never sent the rating. Those
+# comments are moved to the comment column, and the logs are counted without a feedback since their rating is unknown.
+MOVE_COMMENTS = f"""UPDATE logs SET comment = NULLIF(feedback, ''), feedback = NULL
+    WHERE feedback NOT IN ({', '.join(f"'{value}'" for value in FEEDBACK_VALUES)});
+"""
+
+
+def encode_cursor(timestamp: Any, id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([timestamp, id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[Any, int]:
+    try:
+        timestamp, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(timestamp, (int, float)) or not isinstance(id, int):
+        raise ValueError("Invalid cursor")
+    return timestamp, id
+
+
+def check_fields(fields: list[str]):
+    if unknown_fields := set(fields) - set(LOG_FIELDS):
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+
+
+def filter_logs(
+    feedback: Optional[str], uuid: Optional[str], since: Optional[float], until: Optional[float]
+) -> tuple[list[str], list[Any]]:
+    conditions = []
+    params: list[Any] = []
+    if feedback is not None:
+        conditions.append("feedback = ?")
+        params.append(feedback)
+    if uuid is not None:
+        conditions.append("uuid = ?")
+        params.append(uuid)
+    if since is not None:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("timestamp < ?")
+        params.append(until)
+    return conditions, params
+
+
+# LogQueueFullError is raised when a log cannot be queued for writing because the queue stayed full
+class LogQueueFullError(Exception):
+    pass
+
+
+class LogStore:
+    """
+    The SQLite store behind the feedback log. The schema is created once when the store is opened, the database runs
+    in WAL mode, and each worker keeps one connection that is only used from a dedicated thread, so queries never
+    block the event loop that the chat streams share.
+    Added logs are queued and written behind by a background task, in one transaction per batch of up to batch_size
+    logs or every flush_interval seconds. When max_queue_size logs are waiting, adding a log waits up to
+    enqueue_timeout seconds for room before failing. Closing the store writes every queued log.
+    The store also records cache invalidations, which is how the workers that share the database learn of them.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 10000,
+        enqueue_timeout: float = 1.0,
+    ):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="logstore")
+        self.connection: Optional[sqlite3.Connection] = None
+        self.queue: Optional[asyncio.Queue[tuple]] = None
+        self.batch_ready: Optional[asyncio.Event] = None
+        self.closing = False
+        self.writer: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.rows_rejected = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.last_flush_delay_seconds = 0.0
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def open(self):
+        await self.run(self.connect)
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self.batch_ready = asyncio.Event()
+        self.writer = asyncio.create_task(self.write_queued_logs())
+
+    async def close(self):
+        if self.writer and self.batch_ready:
+            self.closing = True
+            self.batch_ready.set()
+            await self.writer
+        await self.run(self.disconnect)
+        self.executor.shutdown()
+
+    async def flush(self):
+        # Waits until every log queued so far has been written
+        if self.queue and self.batch_ready:
+            self.batch_ready.set()
+            await self.queue.join()
+
+    async def get_logs(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        feedback: Optional[str] = None,
+        uuid: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        fields: Optional[list[str]] = None,
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        """
+        Returns a page of logs, newest first, and the cursor of the next page or None if this is the last page.
+        The time range includes since and excludes until, both in the unit of the stored timestamps.
+        """
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        fields = fields or DEFAULT_LOG_FIELDS
+        check_fields(fields)
+        # The cursor is built from id and timestamp, so they are always returned
+        fields = ["id", "timestamp"] + [field for field in fields if field not in ("id", "timestamp")]
+        after = decode_cursor(cursor) if cursor else None
+        return await self.run(self.select_logs, limit, after, feedback, uuid, since, until, fields)
+
+    def export_logs(
+        self,
+        feedback: Optional[str] = None,
+        uuid: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        fields: Optional[list[str]] = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE,
+    ) -> AsyncIterator[list[dict[str, Any]]]:
+        """
+        Returns the matching logs, oldest first, in chunks of up to chunk_size logs. Each chunk is read with its own
+        range scan that continues after the last log of the previous chunk, so an export of any size only holds one
+        chunk in memory and does not keep a read transaction open while the chunks are sent.
+        The fields are checked here, before the first chunk is read.
+        """
+        fields = fields or LOG_FIELDS
+        check_fields(fields)
+        return self.iterate_logs(feedback, uuid, since, until, fields, chunk_size)
+
+    async def iterate_logs(
+        self,
+        feedback: Optional[str],
+        uuid: Optional[str],
+        since: Optional[float],
+        until: Optional[float],
+        fields: list[str],
+        chunk_size: int,
+    ) -> AsyncIterator[list[dict[str, Any]]]:
+        after = None
+        while True:
+            rows = await self.run(self.select_log_chunk, chunk_size, after, feedback, uuid, since, until, fields)
+            if not rows:
+                return
+            after = rows[-1][:2]
+            # The chunks are read with id and timestamp in front to continue from, which are only returned if asked for
+            yield [dict(zip(fields, row[2:])) for row in rows]
+            if len(rows) < chunk_size:
+                return
+
+    async def get_stats(
+        self, period: str = "day", since: Optional[float] = None, until: Optional[float] = None
+    ) -> list[dict[str, Any]]:
+        """
+        Returns the number of logs per feedback value in each hour or day that has logs, oldest first.
+        Buckets are selected by their start, so since and until should fall on a bucket boundary.
+        """
+        if period not in STATS_PERIODS:
+            raise ValueError(f"period must be one of {', '.join(STATS_PERIODS)}")
+        return await self.run(self.select_stats, period, since, until)
+
+    async def rebuild_stats(self):
+        await self.run(self.recompute_stats)
+
+    async def add_cache_invalidation(self, source: Optional[str]):
+        # Written right away rather than queued, so that the other workers can see it once this returns
+        await self.run(self.insert_cache_invalidation, source)
+
+    async def get_cache_invalidations(self, after: int) -> list[tuple[int, Optional[str]]]:
+        """
+        Returns the id and source of each cache invalidation recorded after the one with the id after, oldest first.
+        """
+        return await self.run(self.select_cache_invalidations, after)
+
+    async def get_last_cache_invalidation(self) -> int:
+        return await self.run(self.select_last_cache_invalidation)
+
+    async def get_log(self, id: int) -> Optional[dict[str, Any]]:
+        return await self.run(self.select_log, id)
+
+    async def add_log(
+        self,
+        uuid: Optional[str],
+        feedback: Optional[str],
+        timestamp: Any,
+        thought_process: Any,
+        comment: Optional[str] = None,
+    ):
+        assert self.queue and self.batch_ready
+        if feedback is not None and feedback not in FEEDBACK_VALUES:
+            raise ValueError(f"feedback must be one of {', '.join(FEEDBACK_VALUES)}")
+        # Rows without a timestamp could not be paged through, so they get the time they were added (in ms like the UI)
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        log = (uuid, feedback, timestamp, thought_process, comment, time.monotonic())
+        try:
+            self.queue.put_nowait(log)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(log), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.rows_rejected += 1
+                raise LogQueueFullError(f"{self.queue.qsize()} logs are waiting to be written")
+        if self.queue.qsize() >= self.batch_size:
+            self.batch_ready.set()
+
+    async def write_queued_logs(self):
+        assert self.queue and self.batch_ready
+        while not (self.closing and self.queue.empty()):
+            if self.queue.qsize() < self.batch_size and not self.closing:
+                try:
+                    await asyncio.wait_for(self.batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.batch_ready.clear()
+            batch: list[tuple] = []
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                await self.run(self.insert_logs, [log[:5] for log in batch])
+                self.rows_written += len(batch)
+            except Exception:
+                logging.exception("Failed to write %d logs", len(batch))
+                self.rows_failed += len(batch)
+            finished = time.monotonic()
+            self.batches += 1
+            self.last_flush_seconds = finished - started
+            self.max_flush_seconds = max(self.max_flush_seconds, self.last_flush_seconds)
+            self.last_flush_delay_seconds = finished - batch[0][5]
+            for _ in batch:
+                self.queue.task_done()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_queue_size": self.max_queue_size,
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "rows_rejected": self.rows_rejected,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "last_flush_delay_seconds": self.last_flush_delay_seconds,
+        }
+
+    # The methods below run on the store's thread
+
+    def connect(self):
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        is_new_rollup = not self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='logs_rollup'"
+        ).fetchone()
+        self.connection.executescript(ROLLUP_SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(logs)")]
+        if "comment" not in columns:
+            try:
+                self.connection.execute("ALTER TABLE logs ADD COLUMN comment TEXT")
+            except sqlite3.OperationalError:
+                # Added by another worker meanwhile, the rest of the migration can run twice
+                pass
+            self.connection.executescript(f"BEGIN IMMEDIATE;\n{MOVE_COMMENTS}{REBUILD_ROLLUP}COMMIT;")
+        # Logs written before the rollup existed are counted once, when it is created
+        elif is_new_rollup:
+            self.recompute_stats()
+
+    def disconnect(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def select_logs(
+        self,
+        limit: int,
+        after: Optional[tuple[Any, int]],
+        feedback: Optional[str],
+        uuid: Optional[str],
+        since: Optional[float],
+        until: Optional[float],
+        fields: list[str],
+    ) -> tuple[list[dict[str, Any]], Optional[str]]:
+        assert self.connection
+        conditions, params = filter_logs(feedback, uuid, since, until)
+        if after is not None:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(
+            f"SELECT {', '.join(fields)} FROM logs {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+            params + [limit + 1],
+        ).fetchall()
+        logs = [dict(zip(fields, row)) for row in rows[:limit]]
+        next_cursor = encode_cursor(logs[-1]["timestamp"], logs[-1]["id"]) if len(rows) > limit else None
+        return logs, next_cursor
+
+    def select_log_chunk(
+        self,
+        limit: int,
+        after: Optional[tuple[Any, int]],
+        feedback: Optional[str],
+        uuid: Optional[str],
+        since: Optional[float],
+        until: Optional[float],
+        fields: list[str],
+    ) -> list[tuple]:
+        assert self.connection
+        conditions, params = filter_logs(feedback, uuid, since, until)
+        if after is not None:
+            conditions.append("(timestamp, id) > (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.connection.execute(
+            f"SELECT timestamp, id, {', '.join(fields)} FROM logs {where} ORDER BY timestamp, id LIMIT ?",
+            params + [limit],
+        ).fetchall()
+
+    def select_stats(self, period: str, since: Optional[float], until: Optional[float]) -> list[dict[str, Any]]:
+        assert self.connection
+        conditions = ["period = ?"]
+        params: list[Any] = [period]
+        if since is not None:
+            conditions.append("bucket >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("bucket < ?")
+            params.append(until)
+        rows = self.connection.execute(
+            f"SELECT bucket, feedback, count FROM logs_rollup WHERE {' AND '.join(conditions)} ORDER BY bucket",
+            params,
+        ).fetchall()
+        stats: list[dict[str, Any]] = []
+        for bucket, feedback, count in rows:
+            if not stats or stats[-1]["timestamp"] != bucket:
+                stats.append({"timestamp": bucket, "total": 0, "feedback": {}})
+            stats[-1]["total"] += count
+            stats[-1]["feedback"][feedback] = count
+        return stats
+
+    def recompute_stats(self):
+        assert self.connection
+        self.connection.executescript(f"BEGIN;\n{REBUILD_ROLLUP}COMMIT;")
+
+    def select_log(self, id: int) -> Optional[dict[str, Any]]:
+        assert self.connection
+        row = self.connection.execute(f"SELECT {', '.join(LOG_FIELDS)} FROM logs WHERE id = ?", (id,)).fetchone()
+        return dict(zip(LOG_FIELDS, row)) if row else None
+
+    def insert_logs(self, logs: list[tuple]):
+        assert self.connection
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO logs (uuid, feedback, timestamp, thought_process, comment) VALUES (?, ?, ?, ?, ?)", logs
+            )
+
+    def insert_cache_invalidation(self, source: Optional[str]):
+        assert self.connection
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO cache_invalidations (source, timestamp) VALUES (?, ?)", (source, int(time.time() * 1000))
+            )
+
+    def select_cache_invalidations(self, after: int) -> list[tuple[int, Optional[str]]]:
+        assert self.connection
+        return self.connection.execute(
+            "SELECT id, source FROM cache_invalidations WHERE id > ? ORDER BY id", (after,)
+        ).fetchall()
+
+    def select_last_cache_invalidation(self) -> int:
+        assert self.connection
+        return self.connection.execute("SELECT IFNULL(MAX(id), 0) FROM cache_invalidations").fetchone()[0]
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Optional
+
+from .metrics import LOOP_LAG_SECONDS
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs its callbacks. A task sleeps for interval and records how much later than
+    that it wakes up, which is how long every other request of the worker waited too. A watchdog thread checks that
+    the task keeps waking up, and when the loop has been stuck for longer than threshold, logs the stack of the loop
+    thread while it is still stuck, which shows the blocking call, e.g. synchronous I/O or a long CPU-bound step.
+    Attributes:
+        interval (float): Seconds between two measurements.
+        threshold (float): Seconds of lag from which the loop counts as blocked.
+    """
+
+    def __init__(self, interval: float = 0.5, threshold: float = 0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.loop_thread_id = 0
+        self.last_tick = 0.0
+        # The tick whose stall was logged, so that a long stall is logged once
+        self.reported_tick = 0.0
+        self.measurements = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = asyncio.create_task(self.measure())
+        self.watchdog = threading.Thread(target=self.watch, name="loop-lag-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+        self.stop_event.set()
+        if self.watchdog:
+            self.watchdog.join()
+
+    async def measure(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_tick = time.monotonic()
+            self.record(max(0.0, self.last_tick - started - self.interval))
+
+    def record(self, lag: float):
+        LOOP_LAG_SECONDS.observe(lag)
+        self.measurements += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self.threshold:
+            self.blocked += 1
+
+    def watch(self):
+        while not self.stop_event.wait(self.threshold / 2):
+            last_tick = self.last_tick
+            lag = time.monotonic() - last_tick - self.interval
+            if lag <= self.threshold or last_tick == self.reported_tick:
+                continue
+            self.reported_tick = last_tick
+            if frame := sys._current_frames().get(self.loop_thread_id):
+                logging.warning(
+                    "Event loop blocked for %.3fs so far in:\n%s", lag, "".join(traceback.format_stack(frame))
+                )
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "measurements": self.measurements,
+            "mean_lag_seconds": self.total_lag / self.measurements if self.measurements else 0.0,
+            "max_lag_seconds": self.max_lag,
+            "blocked": self.blocked,
+        }
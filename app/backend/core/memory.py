@@ -0,0 +1,105 @@
+import gc
+import os
+import time
+import tracemalloc
+from typing import Any, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore[assignment]
+
+TRACEMALLOC_GROUPS = ["lineno", "traceback", "filename"]
+
+# Allocations made by tracemalloc itself and by the import machinery would otherwise top every diff
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    # In kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def gc_stats() -> dict[str, Any]:
+    return {
+        "counts": gc.get_count(),
+        "thresholds": gc.get_threshold(),
+        "generations": gc.get_stats(),
+        "tracked_objects": len(gc.get_objects()),
+        "uncollectable": len(gc.garbage),
+    }
+
+
+class MemorySnapshots:
+    """
+    Takes tracemalloc snapshots of a worker and diffs each with the one before, grouped by allocation site, so that
+    what keeps growing between two snapshots stands out. Tracing starts with the first snapshot and slows down every
+    allocation, so it should be stopped once done.
+    Attributes:
+        frames (int): The number of frames kept for each allocation, which only grouping by traceback uses.
+    """
+
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.previous_at = 0.0
+
+    def snapshot(self, group_by: str = "lineno", top: int = 20) -> dict[str, Any]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = None
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        now = time.monotonic()
+        if self.previous is None:
+            # With nothing to diff with, the largest allocation sites are returned
+            statistics = [
+                {"site": self.site(stat.traceback, group_by), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics(group_by)[:top]
+            ]
+        else:
+            statistics = [
+                {
+                    "site": self.site(stat.traceback, group_by),
+                    "size": stat.size,
+                    "size_diff": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self.previous, group_by)[:top]
+            ]
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "tracemalloc_bytes": tracemalloc.get_tracemalloc_memory(),
+            "seconds_since_previous": now - self.previous_at if self.previous else None,
+            "statistics": statistics,
+        }
+        self.previous = snapshot
+        self.previous_at = now
+        return result
+
+    def site(self, traceback: tracemalloc.Traceback, group_by: str) -> str:
+        if group_by == "traceback":
+            return "\n".join(traceback.format())
+        frame = traceback[0]
+        return frame.filename if group_by == "filename" else f"{frame.filename}:{frame.lineno}"
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
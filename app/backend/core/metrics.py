@@ -0,0 +1,53 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# From a cached lookup of a few milliseconds to a long streamed answer
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "app_stage_duration_seconds",
+    "Seconds spent in a stage of answering a request",
+    ["endpoint", "stage", "retrieval_mode"],
+    buckets=STAGE_BUCKETS,
+)
+REQUESTS = Counter("app_requests", "Requests answered", ["endpoint", "status"])
+TOKENS = Counter("app_openai_tokens", "Tokens used by OpenAI calls", ["endpoint", "stage", "kind"])
+LOOP_LAG_SECONDS = Histogram(
+    "app_event_loop_lag_seconds",
+    "Seconds the event loop of a worker ran a callback later than scheduled",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+@contextmanager
+def observe_stage(endpoint: str, stage: str, retrieval_mode: str = "") -> Iterator[None]:
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(endpoint, stage, retrieval_mode).observe(time.monotonic() - started)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Renders the metrics in the Prometheus text format. When PROMETHEUS_MULTIPROC_DIR is set, as it is by
+    gunicorn.conf.py, each worker writes its metrics to files in that directory and the metrics of all the workers are
+    rendered, whichever worker serves the scrape.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
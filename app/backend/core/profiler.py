@@ -0,0 +1,101 @@
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Any, Optional
+
+PROFILE_FORMATS = {"collapsed": "text/plain; charset=utf-8", "speedscope": "application/json"}
+
+# Often enough to catch a blocking call of a few milliseconds in a profile of a single request
+DEFAULT_INTERVAL = 0.005
+
+# Frames deeper than this are cut off at the root, which only the deepest recursions reach
+MAX_STACK_DEPTH = 256
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """
+    A stack-sampling profiler of one thread, usually the thread of the event loop of a worker. A background thread
+    records the stack of the sampled thread every interval, so the profiled code is not instrumented and runs at full
+    speed apart from the sampler taking the GIL briefly. While the loop waits for I/O the stack ends in the selector,
+    so the samples show the share of time the worker is busy as well as where it is busy.
+    Since all the requests of a worker share its event loop, the samples include every request handled meanwhile.
+    Attributes:
+        thread_id (int): The identifier of the thread to sample.
+        interval (float): Seconds between two samples.
+    """
+
+    def __init__(self, thread_id: int, interval: float = DEFAULT_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        # Each stack is a tuple of frame names, from the root to the running frame
+        self.samples: Counter[tuple[str, ...]] = Counter()
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.stopped_at = time.monotonic()
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            if frame := sys._current_frames().get(self.thread_id):
+                self.samples[self.stack(frame)] += 1
+
+    def stack(self, frame: Optional[FrameType]) -> tuple[str, ...]:
+        names: list[str] = []
+        while frame and len(names) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return tuple(reversed(names))
+
+    def collapsed(self) -> str:
+        # The format of Brendan Gregg's flamegraph.pl and of speedscope: the frames joined by ";" and the sample count
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.most_common())
+
+    def speedscope(self) -> dict[str, Any]:
+        # https://github.com/jlfwong/speedscope/wiki/Importing-from-custom-sources
+        frames: dict[str, int] = {}
+        samples = []
+        weights = []
+        for stack, count in self.samples.most_common():
+            samples.append([frames.setdefault(name, len(frames)) for name in stack])
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": name} for name in frames]},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"Thread {self.thread_id}",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+            "exporter": "sampling-profiler",
+        }
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "samples": sum(self.samples.values()),
+            "stacks": len(self.samples),
+            "seconds": (self.stopped_at or time.monotonic()) - self.started_at,
+        }
@@ -0,0 +1,24 @@
+import re
+
+
+def query_terms(text: str) -> list[str]:
+    return re.findall(r"\w+", text.casefold())
+
+
+def query_similarity(a: str, b: str) -> float:
+    # Jaccard similarity of the terms, so word order, case and punctuation don't matter
+    terms_a, terms_b = set(query_terms(a)), set(query_terms(b))
+    if not terms_a and not terms_b:
+        return 1.0
+    return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+
+def normalize_search_query(text: str) -> str:
+    """
+    Turns a question into a keyword search query following the rules of the chat query rewrite prompt: no text
+    inside [] or <<>>, no cited file names and no special characters.
+    """
+    text = re.sub(r"\[[^\]]*\]|<<[^>]*>>", " ", text)
+    text = re.sub(r"\S+\.(?:pdf|txt|docx?|xlsx?|pptx?|html?|md|csv|json)\b", " ", text, flags=re.IGNORECASE)
+    text = re.sub(r"[^\w\s'-]|_", " ", text)
+    return " ".join(word.strip("'-") for word in text.split() if word.strip("'-"))
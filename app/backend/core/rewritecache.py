@@ -0,0 +1,31 @@
+import hashlib
+import json
+from typing import Any, Optional
+
+from .cache import LRUCache
+
+
+class QueryRewriteCache:
+    """
+    A cache of the search queries generated from a conversation by the query rewrite step of the chat approach.
+    The rewrite runs at temperature 0, so the same prompt messages are rewritten into the same query, and the
+    messages (which hold the trimmed history and the new question) are hashed into the key.
+    Attributes:
+        max_entries (int): The maximum number of cached queries.
+        ttl (float): Seconds after which a cached query expires.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.queries: LRUCache[str, str] = LRUCache(max_entries, ttl=ttl)
+
+    def key(self, model: str, messages: list[dict[str, str]]) -> str:
+        return hashlib.sha256(json.dumps([model, messages], ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.queries.get(key)
+
+    def set(self, key: str, query: str):
+        self.queries.set(key, query)
+
+    def stats(self) -> dict[str, Any]:
+        return self.queries.stats()
@@ -0,0 +1,68 @@
+import hashlib
+import json
+from typing import Any, Optional
+
+import numpy as np
+
+from .cache import LRUCache
+
+
+class SearchCache:
+    """
+    A short-lived cache of search results, keyed by every argument of the search: the query text, the query vector,
+    the filter (which includes the security filter), top and the semantic ranker and caption options.
+    The cached results are the "sourcepage: content" strings the approaches build their prompts from, and the cache
+    is bounded by their total length in characters.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.results: LRUCache[str, list[str]] = LRUCache(
+            max_size, ttl=ttl, sizeof=lambda results: sum(len(result) for result in results)
+        )
+        self.semantic_hits = 0
+        self.invalidations = 0
+
+    def key(
+        self,
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        filter: Optional[str],
+        top: int,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        fields: tuple[str, str],
+    ) -> str:
+        key = hashlib.sha256(
+            json.dumps([query_text, filter, top, use_semantic_ranker, use_semantic_captions, fields]).encode()
+        )
+        # Vectors are hashed as the float32 bytes they are cached as by the embedding cache
+        if query_vector is not None:
+            key.update(np.asarray(query_vector, dtype=np.float32).tobytes())
+        return key.hexdigest()
+
+    def get(self, key: str, use_semantic_ranker: bool = False) -> Optional[list[str]]:
+        results = self.results.get(key)
+        if results is None:
+            return None
+        if use_semantic_ranker:
+            self.semantic_hits += 1
+        return list(results)
+
+    def set(self, key: str, results: list[str]):
+        self.results.set(key, list(results))
+
+    def invalidate(self, source: Optional[str] = None):
+        """
+        Drops the cached results that include a source page starting with source, e.g. the name of a re-indexed
+        file without its extension, or all cached results if no source is given.
+        """
+        self.invalidations += 1
+        if source is None:
+            self.results.clear()
+            return
+        for key, (_, _, results) in list(self.results.entries.items()):
+            if any(result.startswith(source) for result in results):
+                self.results.remove(key)
+
+    def stats(self) -> dict[str, Any]:
+        return {**self.results.stats(), "semantic_hits": self.semantic_hits, "invalidations": self.invalidations}
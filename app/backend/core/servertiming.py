@@ -0,0 +1,31 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class ServerTiming:
+    """
+    The durations of the stages of one request, in the shape of a Server-Timing header, e.g.
+    "rewrite;dur=812.4, embedding;dur=95.1", so that they show in the network panel of the browser's devtools.
+    A stage that runs more than once, e.g. an embedding for a speculative retrieval and one for the rewritten query,
+    adds up its durations.
+    """
+
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.monotonic() - started
+
+    def as_dict(self) -> dict[str, float]:
+        # In milliseconds, as in the header
+        return {name: round(seconds * 1000, 1) for name, seconds in self.durations.items()}
+
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={milliseconds}" for name, milliseconds in timings.items())
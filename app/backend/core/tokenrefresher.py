@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from azure.core.credentials import AccessToken
+from azure.core.credentials_async import AsyncTokenCredential
+
+from .cache import SingleFlight
+
+
+class TokenRefresher:
+    """
+    Keeps an access token fresh by refreshing it in a background task before it expires, so requests always find a
+    valid token instead of each acquiring one when it is about to expire. Should a request still find the token close
+    to expiry, e.g. because the background refresh failed, concurrent requests wait on a single refresh.
+    Attributes:
+        credential (AsyncTokenCredential): The credential to get tokens from.
+        scope (str): The scope to get tokens for.
+        refresh_margin (float): Seconds before expiry at which the background task refreshes the token.
+        min_validity (float): Tokens expiring within this many seconds are refreshed before being used by a request.
+        retry_interval (float): Seconds to wait before retrying a failed background refresh.
+        on_refresh (Callable): Called with every new token.
+    """
+
+    def __init__(
+        self,
+        credential: AsyncTokenCredential,
+        scope: str,
+        refresh_margin: float = 300,
+        min_validity: float = 60,
+        retry_interval: float = 10,
+        on_refresh: Optional[Callable[[AccessToken], None]] = None,
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.retry_interval = retry_interval
+        self.on_refresh = on_refresh
+        self.token: Optional[AccessToken] = None
+        self.refreshes: SingleFlight[str, AccessToken] = SingleFlight()
+        self.task: Optional[asyncio.Task] = None
+        self.refresh_count = 0
+        self.failures = 0
+        self.blocking_refreshes = 0
+        self.last_refresh_seconds = 0.0
+        self.max_refresh_seconds = 0.0
+        self.last_error: Optional[str] = None
+
+    async def start(self):
+        await self.refresh()
+        self.task = asyncio.create_task(self.refresh_in_background())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    def expires_in(self) -> float:
+        return self.token.expires_on - time.time() if self.token else 0
+
+    async def get_token(self) -> AccessToken:
+        if self.token and self.expires_in() >= self.min_validity:
+            return self.token
+        self.blocking_refreshes += 1
+        try:
+            return await self.refreshes.do(self.scope, self.refresh)
+        except Exception:
+            # A token that has not expired yet is still better than failing the request
+            if self.token and self.expires_in() > 0:
+                return self.token
+            raise
+
+    async def refresh(self) -> AccessToken:
+        started = time.monotonic()
+        try:
+            token = await self.credential.get_token(self.scope)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logging.exception("Failed to refresh the token for %s", self.scope)
+            raise
+        duration = time.monotonic() - started
+        self.refresh_count += 1
+        self.last_refresh_seconds = duration
+        self.max_refresh_seconds = max(self.max_refresh_seconds, duration)
+        self.last_error = None
+        self.token = token
+        if self.on_refresh:
+            self.on_refresh(token)
+        logging.info("Refreshed the token for %s in %.3fs, it expires in %ds", self.scope, duration, self.expires_in())
+        return token
+
+    async def refresh_in_background(self):
+        while True:
+            # Tokens valid for less than the margin are refreshed halfway through their lifetime instead
+            expires_in = self.expires_in()
+            await asyncio.sleep(max(expires_in - self.refresh_margin, expires_in / 2, 1))
+            while True:
+                try:
+                    await self.refreshes.do(self.scope, self.refresh)
+                    break
+                except Exception:
+                    await asyncio.sleep(self.retry_interval)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "expires_in_seconds": self.expires_in(),
+            "refreshes": self.refresh_count,
+            "failures": self.failures,
+            "blocking_refreshes": self.blocking_refreshes,
+            "coalesced": self.refreshes.coalesced,
+            "last_refresh_seconds": self.last_refresh_seconds,
+            "max_refresh_seconds": self.max_refresh_seconds,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,106 @@
+import json
+import logging
+from typing import Any, Optional
+
+import tiktoken
+
+from .cache import LRUCache
+from .modelhelper import get_oai_chatmodel_tiktok, num_tokens_from_messages
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    except (KeyError, ValueError):
+        # Embedding models and newer chat models share the encoding of gpt-3.5-turbo and gpt-4
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def count_prompt_tokens(messages: list[dict[str, str]], model: str) -> int:
+    return sum(num_tokens_from_messages(message, model) for message in messages)
+
+
+def count_completion_tokens(message: dict[str, Any], model: str) -> int:
+    # A function call is billed for its arguments rather than for a content
+    function_call = message.get("function_call") or {}
+    return count_tokens((message.get("content") or "") + (function_call.get("arguments") or ""), model)
+
+
+class TokenUsage:
+    """
+    The prompt and completion tokens that the OpenAI calls made for one request used, by stage, e.g. "rewrite",
+    "embedding" and "answer". The usage reported by OpenAI is used where there is one, and the tokens are counted
+    locally otherwise, e.g. for streamed completions, which report no usage.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, dict[str, int]] = {}
+
+    def add(self, stage: str, prompt_tokens: int, completion_tokens: int = 0):
+        usage = self.stages.setdefault(stage, {"prompt_tokens": 0, "completion_tokens": 0})
+        usage["prompt_tokens"] += prompt_tokens
+        usage["completion_tokens"] += completion_tokens
+
+    def set(self, stage: str, prompt_tokens: int, completion_tokens: int):
+        self.stages[stage] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+    def add_completion(self, stage: str, completion: dict[str, Any], messages: list[dict[str, str]], model: str):
+        if usage := completion.get("usage"):
+            self.add(stage, usage["prompt_tokens"], usage.get("completion_tokens", 0))
+        else:
+            message = completion["choices"][0]["message"]
+            self.add(stage, count_prompt_tokens(messages, model), count_completion_tokens(message, model))
+
+    def total(self, kind: str) -> int:
+        return sum(usage[kind] for usage in self.stages.values())
+
+    def as_dict(self) -> dict[str, Any]:
+        prompt_tokens = self.total("prompt_tokens")
+        completion_tokens = self.total("completion_tokens")
+        return {
+            "stages": {stage: dict(usage) for stage, usage in self.stages.items()},
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+
+class TokenUsageStats:
+    """
+    Totals of the tokens used per endpoint and per user, to find the requests and users that use up the quota.
+    The users are kept in a least-recently-used cache, so that the memory used does not grow with the number of users.
+    Attributes:
+        max_users (int): The maximum number of users whose totals are kept.
+        top_users (int): The number of users with the most tokens that user_stats returns.
+    """
+
+    def __init__(self, max_users: int = 10000, top_users: int = 10):
+        self.endpoints: dict[str, dict[str, int]] = {}
+        self.users: LRUCache[str, dict[str, int]] = LRUCache(max_users)
+        self.top_users = top_users
+
+    def add_to(self, totals: dict[str, int], usage: dict[str, Any]):
+        totals["requests"] = totals.get("requests", 0) + 1
+        for kind in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+            totals[kind] = totals.get(kind, 0) + usage[kind]
+
+    def record(self, endpoint: str, oid: Optional[str], usage: TokenUsage):
+        usage_dict = usage.as_dict()
+        self.add_to(self.endpoints.setdefault(endpoint, {}), usage_dict)
+        user = oid or "anonymous"
+        totals = self.users.get(user) or {}
+        self.add_to(totals, usage_dict)
+        self.users.set(user, totals)
+        logging.info("Token usage of %s for %s: %s", endpoint, user, json.dumps(usage_dict))
+
+    def stats(self) -> dict[str, Any]:
+        return {"endpoints": self.endpoints, "users": len(self.users)}
+
+    def user_stats(self) -> dict[str, Any]:
+        # The totals of the users with the most tokens, by object ID, which only admins should see
+        users = sorted(self.users.entries.items(), key=lambda entry: entry[1][2]["total_tokens"], reverse=True)
+        return {"top_users": {oid: totals for oid, (_, _, totals) in users[: self.top_users]}}
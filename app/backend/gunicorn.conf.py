@@ -1,7 +1,12 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
 
-max_requests = 1000
-max_requests_jitter = 50
+# Workers are restarted after this many requests, give or take the jitter, so that a worker that leaks memory does
+# not grow forever. Set GUNICORN_MAX_REQUESTS to 0 to keep workers, and their warm caches and connections, running.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "50"))
 log_file = "-"
 bind = "0.0.0.0"
 
@@ -11,3 +16,18 @@ timeout = 230
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# Each worker writes its Prometheus metrics to files in this directory, so that /metrics adds up those of all workers
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus_multiproc"))
+
+
+def on_starting(server):
+    # Files left by the workers of an earlier run would be added up with those of this one
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
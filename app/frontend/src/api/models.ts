@@ -33,6 +33,7 @@ export type ResponseMessage = {
 export type ResponseExtraArgs = {
     thoughts: string | null;
     data_points: string[];
+    timings?: Record<string, number>;
 }
 
 export type ResponseChoice = {
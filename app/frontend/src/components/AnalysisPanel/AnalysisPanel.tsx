@@ -24,6 +24,7 @@ export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeigh
     const isDisabledCitationTab: boolean = !activeCitation;
 
     const sanitizedThoughts = DOMPurify.sanitize(answer.choices[0].extra_args.thoughts!);
+    const timings = Object.entries(answer.choices[0].extra_args.timings ?? {});
 
     return (
         <Pivot
@@ -37,6 +38,15 @@ export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeigh
                 headerButtonProps={isDisabledThoughtProcessTab ? pivotItemDisabledStyle : undefined}
             >
                 <div className={styles.thoughtProcess} dangerouslySetInnerHTML={{ __html: sanitizedThoughts }}></div>
+                {timings.length > 0 && (
+                    <ul className={styles.timings}>
+                        {timings.map(([stage, duration]) => (
+                            <li key={stage}>
+                                {stage}: {duration} ms
+                            </li>
+                        ))}
+                    </ul>
+                )}
             </PivotItem>
             <PivotItem
                 itemKey={AnalysisPanelTabs.SupportingContentTab}
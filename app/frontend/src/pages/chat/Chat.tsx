@@ -381,7 +381,8 @@ const Chat = () => {
 			},
 			body: JSON.stringify({
 				uuid: sessionStorage.getItem('ajs_anonymous_id'),
-				feedback: data?.comment || '',
+				feedback: data.feedback,
+				comment: data?.comment || '',
 				timestamp: new Date().getTime(),
 				thought_process: lastAnswer[1].choices[0].extra_args.thoughts,
 			}),
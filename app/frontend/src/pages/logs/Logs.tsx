@@ -3,21 +3,45 @@ import Layout from '../../components/Layout/Layout';
 import styles from './Logs.module.css';
 
 interface Log {
+	id: number;
 	uuid: string;
-	feedback: string;
-	thought_process: string;
+	feedback: string | null;
+	comment: string | null;
+	thought_process?: string;
 	timestamp: number;
 }
 
+interface LogsPage {
+	logs: Log[];
+	next_cursor: string | null;
+}
+
 export function Component(): JSX.Element {
 	const [logs, setLogs] = useState<Log[]>([]);
 	const [log, setLog] = useState<Log | null>();
+	const [nextCursor, setNextCursor] = useState<string | null>(null);
+
+	const loadLogs = (cursor?: string) => {
+		const params = new URLSearchParams({ limit: '100' });
+		if (cursor) {
+			params.set('cursor', cursor);
+		}
+		fetch(`/logs?${params}`)
+			.then(res => res.json())
+			.then((data: LogsPage) => {
+				setLogs(logs => (cursor ? [...logs, ...data.logs] : data.logs));
+				setNextCursor(data.next_cursor);
+			});
+	};
 
-	useMemo(() => {
-		fetch('/logs')
+	// The list leaves out the thought process, so it is fetched when a log is opened
+	const openLog = (log: Log) => {
+		fetch(`/logs/${log.id}`)
 			.then(res => res.json())
-			.then(data => setLogs(data));
-	}, []);
+			.then(data => setLog(data));
+	};
+
+	useMemo(() => loadLogs(), []);
 
 	return (
 		<Layout>
@@ -25,18 +49,27 @@ export function Component(): JSX.Element {
 				<h1>Logs</h1>
 
 				<div className={styles.logs}>
-					{logs?.map((log, i) => (
+					{logs?.map(log => (
 						<div
-							key={i}
+							key={log.id}
 							className={styles.log}
-							onClick={() => setLog(log)}>
+							onClick={() => openLog(log)}>
 							<span>{log.uuid}</span>
 							<span>{log.feedback}</span>
+							<span>{log.comment}</span>
 							<span>{new Date(log.timestamp).toISOString()}</span>
 						</div>
 					))}
 				</div>
 
+				{nextCursor && (
+					<button
+						className={styles.loadMore}
+						onClick={() => loadLogs(nextCursor)}>
+						Load more
+					</button>
+				)}
+
 				{log && (
 					<div className={styles.modalWrapper}>
 						<div
@@ -47,7 +80,7 @@ export function Component(): JSX.Element {
 						<div className={styles.modal}>
 							<div
 								dangerouslySetInnerHTML={{
-									__html: log.thought_process,
+									__html: log.thought_process || '',
 								}}
 							/>
 						</div>
@@ -5,15 +5,24 @@ from collections import namedtuple
 from unittest import mock
 
 import aiohttp
+import azure.storage.blob.aio
 import azure.storage.filedatalake
 import azure.storage.filedatalake.aio
 import msal
 import openai
 import pytest
 import pytest_asyncio
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ResourceNotModifiedError,
+)
 from azure.search.documents.aio import SearchClient
+from azure.storage.blob import BlobProperties
 
 import app
+import core.servertiming
 from core.authentication import AuthenticationHelper
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
@@ -131,6 +140,56 @@ def mock_acs_search_filter(monkeypatch):
     monkeypatch.setattr(SearchClient, "search", mock_search)
 
 
+MOCK_BLOB_CONTENT = b"%PDF-1.7 whistleblower policy"
+MOCK_BLOB_ETAG = '"0x8DBC95A6F5F9A1B"'
+
+
+@pytest.fixture
+def mock_blob_container_client(monkeypatch):
+    class AsyncChunkIterator:
+        def __init__(self, data, chunk_size=8):
+            self.chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.chunks:
+                return self.chunks.pop(0)
+            raise StopAsyncIteration
+
+    class MockStorageStreamDownloader:
+        def __init__(self, data):
+            self.data = data
+
+        def chunks(self):
+            return AsyncChunkIterator(self.data)
+
+    downloads = []
+
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        if self.blob_name != "Benefit_Options-2.pdf":
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        if kwargs.get("match_condition") == MatchConditions.IfModified and kwargs.get("etag") == MOCK_BLOB_ETAG:
+            raise ResourceNotModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+        return BlobProperties(
+            name=self.blob_name,
+            **{"ETag": MOCK_BLOB_ETAG, "Content-Length": len(MOCK_BLOB_CONTENT), "Content-Type": "application/pdf"},
+        )
+
+    async def mock_download_blob(self, offset=None, length=None, **kwargs):
+        if kwargs.get("match_condition") == MatchConditions.IfNotModified and kwargs.get("etag") != MOCK_BLOB_ETAG:
+            raise ResourceModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+        downloads.append((self.blob_name, offset, length))
+        start = offset or 0
+        end = len(MOCK_BLOB_CONTENT) if length is None else start + length
+        return MockStorageStreamDownloader(MOCK_BLOB_CONTENT[start:end])
+
+    monkeypatch.setattr(azure.storage.blob.aio.BlobClient, "get_blob_properties", mock_get_blob_properties)
+    monkeypatch.setattr(azure.storage.blob.aio.BlobClient, "download_blob", mock_download_blob)
+    return argparse.Namespace(content=MOCK_BLOB_CONTENT, etag=MOCK_BLOB_ETAG, downloads=downloads)
+
+
 envs = [
     {
         "OPENAI_HOST": "openai",
@@ -161,7 +220,7 @@ auth_envs = [
 
 
 @pytest.fixture(params=envs, ids=["client0", "client1"])
-def mock_env(monkeypatch, request):
+def mock_env(monkeypatch, request, tmp_path):
     with mock.patch.dict(os.environ, clear=True):
         monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
         monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
@@ -169,6 +228,8 @@ def mock_env(monkeypatch, request):
         monkeypatch.setenv("AZURE_SEARCH_SERVICE", "test-search-service")
         monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
         monkeypatch.setenv("ALLOWED_ORIGIN", "https://frontend.com")
+        monkeypatch.setenv("OPENAI_POOL_WARMUP", "0")
+        monkeypatch.setenv("LOGS_DB_PATH", str(tmp_path / "app.db"))
         for key, value in request.param.items():
             monkeypatch.setenv(key, value)
         if os.getenv("AZURE_USE_AUTHENTICATION") is not None:
@@ -179,8 +240,22 @@ def mock_env(monkeypatch, request):
             yield
 
 
+@pytest.fixture
+def mock_server_timing(monkeypatch):
+    # The stages take no time, so that the timings in the snapshots do not change from run to run
+    monkeypatch.setattr(core.servertiming, "time", mock.Mock(**{"monotonic.return_value": 0.0}))
+
+
 @pytest_asyncio.fixture()
-async def client(monkeypatch, mock_env, mock_openai_chatcompletion, mock_openai_embedding, mock_acs_search, request):
+async def client(
+    monkeypatch,
+    mock_env,
+    mock_openai_chatcompletion,
+    mock_openai_embedding,
+    mock_acs_search,
+    mock_server_timing,
+    request,
+):
     quart_app = app.create_app()
 
     async with quart_app.test_app() as test_app:
@@ -197,13 +272,17 @@ async def auth_client(
     mock_confidential_client_success,
     mock_list_groups_success,
     mock_acs_search_filter,
+    mock_server_timing,
     request,
+    tmp_path,
 ):
     monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
     monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
     monkeypatch.setenv("AZURE_SEARCH_INDEX", "test-search-index")
     monkeypatch.setenv("AZURE_SEARCH_SERVICE", "test-search-service")
     monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
+    monkeypatch.setenv("OPENAI_POOL_WARMUP", "0")
+    monkeypatch.setenv("LOGS_DB_PATH", str(tmp_path / "app.db"))
     for key, value in request.param.items():
         monkeypatch.setenv(key, value)
 
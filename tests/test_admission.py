@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from core.admission import AdmissionController, AdmissionRejectedError
+
+
+@pytest.mark.asyncio
+async def test_admission_queues_beyond_concurrency():
+    admission = AdmissionController(2, max_queue_size=2, max_queue_time=1)
+    first = await admission.acquire()
+    await admission.acquire()
+    waiting = asyncio.create_task(admission.acquire())
+    await asyncio.sleep(0)
+    assert admission.stats()["queued"] == 1
+    assert not waiting.done()
+    admission.release(first)
+    await waiting
+    assert admission.stats()["inflight"] == 2
+    assert admission.stats()["queued"] == 0
+    assert admission.stats()["admitted"] == 3
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_when_queue_full():
+    admission = AdmissionController(1, max_queue_size=1, max_queue_time=1)
+    slot = await admission.acquire()
+    waiting = asyncio.create_task(admission.acquire())
+    await asyncio.sleep(0)
+    assert admission.saturated()
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await admission.acquire()
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.retry_after == 1
+    admission.release(slot)
+    admission.release(await waiting)
+    assert admission.stats()["rejected_queue_full"] == 1
+    assert admission.stats()["inflight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_after_queue_time():
+    admission = AdmissionController(1, max_queue_size=1, max_queue_time=0.01)
+    slot = await admission.acquire()
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await admission.acquire()
+    assert exc_info.value.status_code == 503
+    assert admission.stats()["rejected_timeout"] == 1
+    assert admission.stats()["queued"] == 0
+    admission.release(slot)
+    # The slot is free again once the request holding it is released
+    admission.release(await admission.acquire())
+
+
+@pytest.mark.asyncio
+async def test_admission_hold_releases_when_stream_ends():
+    async def events():
+        yield 1
+        yield 2
+
+    admission = AdmissionController(1, max_queue_size=0, max_queue_time=1)
+    slot = await admission.acquire()
+    assert [event async for event in admission.hold(slot, events())] == [1, 2]
+    assert admission.stats()["inflight"] == 0
+    assert not admission.saturated()
+
+
+@pytest.mark.asyncio
+async def test_admission_releases_a_slot_once():
+    admission = AdmissionController(1, max_queue_size=0, max_queue_time=1)
+    slot = await admission.acquire()
+
+    async def handler():
+        admission.release_when_done(slot)
+        await asyncio.sleep(10)
+
+    # A stream that never started leaves the slot to the end of the task that handled the request
+    task = asyncio.create_task(handler())
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0)
+    assert admission.stats()["inflight"] == 0
+    admission.release(slot)
+    assert admission.stats()["inflight"] == 0
+    assert not admission.slots.locked()
+
+
+@pytest.mark.asyncio
+async def test_admission_unlimited():
+    admission = AdmissionController(0, max_queue_size=0, max_queue_time=1)
+    for _ in range(100):
+        await admission.acquire()
+    assert admission.stats()["inflight"] == 100
+    assert not admission.saturated()
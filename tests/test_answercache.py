@@ -0,0 +1,41 @@
+from core.answercache import AnswerCache, normalize_question
+
+
+def test_normalize_question():
+    assert normalize_question("  What is  the\nDEDUCTIBLE? ") == "what is the deductible?"
+
+
+def test_answercache_key():
+    cache = AnswerCache(1000, ttl=60)
+    key = cache.key("chat", "What is covered?", [], {"top": 3}, "oids/any(g:search.in(g, 'OID_X'))")
+    assert key == cache.key("chat", "What is covered?", [], {"top": 3}, "oids/any(g:search.in(g, 'OID_X'))")
+    # Users with a different security filter never share answers
+    assert key != cache.key("chat", "What is covered?", [], {"top": 3}, "oids/any(g:search.in(g, 'OID_Y'))")
+    assert key != cache.key("chat", "What is covered?", [], {"top": 5}, "oids/any(g:search.in(g, 'OID_X'))")
+
+
+def test_answercache_set_and_get():
+    cache = AnswerCache(1000, ttl=60)
+    message = {"role": "assistant", "content": "Yes [info1.txt]"}
+    cache.set("a", message, {"data_points": ["info1.txt: yes"], "thoughts": ""}, "stop")
+    cache.set("b", message, {}, "length")
+    cache.set("c", message, {}, "content_filter")
+    assert cache.get("a") == {
+        "message": message,
+        "extra_args": {"data_points": ["info1.txt: yes"], "thoughts": ""},
+        "finish_reason": "stop",
+    }
+    assert cache.get("b") is None
+    assert cache.get("c") is None
+    assert cache.stats()["hit_rate"] == 1 / 3
+
+
+def test_answercache_as_completion_chunks():
+    cache = AnswerCache(1000, ttl=60)
+    cache.replay_chunk_size = 4
+    cache.set("a", {"role": "assistant", "content": "Yes, it is."}, {"thoughts": "t"}, "stop")
+    chunks = list(cache.as_completion_chunks(cache.get("a")))
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert chunks[0]["choices"][0]["extra_args"] == {"thoughts": "t"}
+    assert [chunk["choices"][0]["delta"].get("content") for chunk in chunks[1:]] == ["Yes,", " it ", "is.", None]
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
@@ -1,11 +1,25 @@
+import asyncio
+import gzip
 import json
 import os
+import sqlite3
+import time
 from unittest import mock
 
+import openai
 import pytest
 import quart.testing.app
+from azure.search.documents.aio import SearchClient
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from prometheus_client import REGISTRY
 
 import app
+from core import logstore, servertiming
+from core.admission import AdmissionController
+from core.blobcache import BlobCache
 
 
 @pytest.mark.asyncio
@@ -37,6 +51,107 @@ async def test_cors_allowed(client) -> None:
     assert "Access-Control-Allow-Origin" in response.headers
 
 
+@pytest.mark.asyncio
+async def test_content_file(client, mock_blob_container_client):
+    client.app.config[app.CONFIG_CONTENT_CACHE] = None
+    labels = {"endpoint": "/content", "stage": "blob_download", "retrieval_mode": ""}
+    downloads_timed = REGISTRY.get_sample_value("app_stage_duration_seconds_count", labels) or 0
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"] == mock_blob_container_client.etag
+    assert await response.get_data() == mock_blob_container_client.content
+    assert mock_blob_container_client.downloads == [("Benefit_Options-2.pdf", None, None)]
+    # The download is timed until the body was sent
+    assert REGISTRY.get_sample_value("app_stage_duration_seconds_count", labels) == downloads_timed + 1
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_found(client, mock_blob_container_client):
+    response = await client.get("/content/notfound.pdf")
+    assert response.status_code == 404
+    assert mock_blob_container_client.downloads == []
+
+
+@pytest.mark.asyncio
+async def test_content_file_range(client, mock_blob_container_client):
+    client.app.config[app.CONFIG_CONTENT_CACHE] = None
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": "bytes=9-20"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 9-20/{len(mock_blob_container_client.content)}"
+    assert await response.get_data() == mock_blob_container_client.content[9:21]
+    assert mock_blob_container_client.downloads == [("Benefit_Options-2.pdf", 9, 12)]
+
+
+@pytest.mark.asyncio
+async def test_content_file_suffix_range(client, mock_blob_container_client):
+    client.app.config[app.CONFIG_CONTENT_CACHE] = None
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": "bytes=-6"})
+    assert response.status_code == 206
+    assert await response.get_data() == mock_blob_container_client.content[-6:]
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_not_satisfiable(client, mock_blob_container_client):
+    client.app.config[app.CONFIG_CONTENT_CACHE] = None
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": "bytes=1000-"})
+    assert response.status_code == 416
+    assert mock_blob_container_client.downloads == []
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_modified(client, mock_blob_container_client):
+    client.app.config[app.CONFIG_CONTENT_CACHE] = None
+    response = await client.get(
+        "/content/Benefit_Options-2.pdf", headers={"If-None-Match": mock_blob_container_client.etag}
+    )
+    assert response.status_code == 304
+    assert await response.get_data() == b""
+    assert mock_blob_container_client.downloads == []
+
+
+@pytest.mark.asyncio
+async def test_content_file_cached(client, mock_blob_container_client):
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert response.status_code == 200
+    assert await response.get_data() == mock_blob_container_client.content
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": "bytes=-6"})
+    assert response.status_code == 206
+    assert response.headers["ETag"] == mock_blob_container_client.etag
+    assert await response.get_data() == mock_blob_container_client.content[-6:]
+    assert mock_blob_container_client.downloads == [("Benefit_Options-2.pdf", None, None)]
+
+    response = await client.get("/stats")
+    result = await response.get_json()
+    assert result["content_cache"]["hits"] == 1
+    assert result["content_cache"]["misses"] == 1
+    assert result["content_cache"]["memory"]["entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_content_file_cached_file_removed(client, mock_blob_container_client, tmp_path):
+    content_cache = BlobCache(0, 0, 1024 * 1024, 1024 * 1024, ttl=60, directory=str(tmp_path))
+    client.app.config[app.CONFIG_CONTENT_CACHE] = content_cache
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert await response.get_data() == mock_blob_container_client.content
+
+    # A file the cache removes between the lookup and the response, e.g. by evicting it, is streamed from storage
+    cache_get = content_cache.get
+
+    async def get_then_evict(blob_client):
+        blob = await cache_get(blob_client)
+        blob.path.unlink()
+        return blob
+
+    content_cache.get = get_then_evict
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert response.status_code == 200
+    assert await response.get_data() == mock_blob_container_client.content
+    assert len(mock_blob_container_client.downloads) == 2
+    content_cache.close()
+
+
 @pytest.mark.asyncio
 async def test_ask_request_must_be_json(client):
     response = await client.post("/ask")
@@ -255,6 +370,41 @@ async def test_chat_vector(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_stream_request_must_be_json(client):
+    response = await client.post("/ask_stream")
+    assert response.status_code == 415
+    result = await response.get_json()
+    assert result["error"] == "request must be json"
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_text(client, snapshot):
+    response = await client.post(
+        "/ask_stream",
+        json={"question": "What is the capital of France?", "overrides": {"retrieval_mode": "text"}},
+    )
+    assert response.status_code == 200
+    result = await response.get_data()
+    snapshot.assert_match(result, "result.jsonlines")
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_replays_cached_answer(client):
+    response = await client.post("/ask", json={"question": "What is the capital of France?"})
+    answer = (await response.get_json())["choices"][0]
+    response = await client.post("/ask_stream", json={"question": "What is the capital of France?"})
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    answer["extra_args"].pop("token_usage")
+    # A cached answer has no stages to time
+    assert answer["extra_args"].pop("timings")
+    assert events[0]["choices"][0]["extra_args"].pop("timings") == {}
+    assert events[0]["choices"][0]["extra_args"] == answer["extra_args"]
+    assert events[1]["choices"][0]["delta"]["content"] == answer["message"]["content"]
+    response = await client.get("/stats")
+    assert (await response.get_json())["answer_cache"]["hits"] == 1
+
+
 @pytest.mark.asyncio
 async def test_chat_stream_request_must_be_json(client):
     response = await client.post("/chat_stream")
@@ -301,6 +451,734 @@ async def test_chat_stream_text_filter(auth_client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_logs(client):
+    response = await client.get("/logs")
+    assert response.status_code == 200
+    assert await response.get_json() == {"logs": [], "next_cursor": None}
+
+    log = {
+        "uuid": "user-1",
+        "feedback": "good",
+        "comment": "Great answer",
+        "timestamp": 1697000000000,
+        "thought_process": "Searched",
+    }
+    response = await client.post("/logs/add", json=log)
+    assert response.status_code == 200
+    assert await response.get_data(as_text=True) == "log added successfully"
+    await client.app.config[app.CONFIG_LOG_STORE].flush()
+
+    response = await client.get("/logs")
+    assert await response.get_json() == {
+        "logs": [
+            {"id": 1, "uuid": "user-1", "feedback": "good", "comment": "Great answer", "timestamp": 1697000000000}
+        ],
+        "next_cursor": None,
+    }
+    response = await client.get("/logs/1")
+    assert await response.get_json() == {"id": 1, **log}
+    response = await client.get("/logs/2")
+    assert response.status_code == 404
+
+    response = await client.post("/logs/add", json={**log, "feedback": "Great answer"})
+    assert response.status_code == 400
+    assert (await response.get_json())["error"] == "feedback must be one of good, bad"
+
+
+@pytest.mark.asyncio
+async def test_logs_pagination(client):
+    for i in range(3):
+        await client.post("/logs/add", json={"uuid": f"user-{i}", "feedback": "good", "timestamp": 1697000000000 + i})
+    await client.app.config[app.CONFIG_LOG_STORE].flush()
+
+    response = await client.get("/logs?limit=2&fields=uuid,thought_process")
+    page = await response.get_json()
+    assert [log["uuid"] for log in page["logs"]] == ["user-2", "user-1"]
+    assert page["logs"][0]["thought_process"] is None
+    response = await client.get(f"/logs?limit=2&cursor={page['next_cursor']}")
+    page = await response.get_json()
+    assert [log["uuid"] for log in page["logs"]] == ["user-0"]
+    assert page["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_logs_invalid_parameters(client):
+    response = await client.get("/logs?cursor=notacursor")
+    assert response.status_code == 400
+    assert (await response.get_json())["error"] == "Invalid cursor"
+    response = await client.get("/logs?fields=password")
+    assert response.status_code == 400
+    response = await client.get("/logs?limit=0")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_logs_export(client):
+    for i in range(3):
+        await client.post(
+            "/logs/add",
+            json={"uuid": f"user-{i}", "feedback": "bad", "timestamp": 1697000000000 + i, "thought_process": 'a,"b"'},
+        )
+    await client.app.config[app.CONFIG_LOG_STORE].flush()
+
+    response = await client.get("/logs/export?since=1697000000001")
+    assert response.status_code == 200
+    assert response.content_type == "application/x-ndjson"
+    assert response.headers["Content-Disposition"] == "attachment; filename=logs.ndjson"
+    lines = (await response.get_data(as_text=True)).splitlines()
+    assert [json.loads(line)["uuid"] for line in lines] == ["user-1", "user-2"]
+
+    response = await client.get("/logs/export?format=csv&fields=uuid,thought_process")
+    assert await response.get_data(as_text=True) == (
+        'uuid,thought_process\r\nuser-0,"a,""b"""\r\nuser-1,"a,""b"""\r\nuser-2,"a,""b"""\r\n'
+    )
+
+    response = await client.get("/logs/export?format=csv&compress=gzip&until=0")
+    assert response.content_type == "application/gzip"
+    assert response.headers["Content-Disposition"] == "attachment; filename=logs.csv.gz"
+    assert gzip.decompress(await response.get_data()) == b"id,uuid,feedback,comment,timestamp,thought_process\r\n"
+
+
+@pytest.mark.asyncio
+async def test_logs_export_invalid_parameters(client):
+    response = await client.get("/logs/export?format=xml")
+    assert response.status_code == 400
+    response = await client.get("/logs/export?fields=password")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_logs_stats(client):
+    for feedback, comment in [("good", ""), ("good", "Great answer"), ("bad", "Wrong document")]:
+        await client.post(
+            "/logs/add",
+            json={"uuid": "user-1", "feedback": feedback, "comment": comment, "timestamp": 1697000000000},
+        )
+    await client.app.config[app.CONFIG_LOG_STORE].flush()
+
+    response = await client.get("/logs/stats")
+    assert response.status_code == 200
+    assert await response.get_json() == {
+        "period": "day",
+        "stats": [{"timestamp": 1696982400000, "total": 3, "feedback": {"bad": 1, "good": 2}}],
+    }
+    response = await client.get("/logs/stats?period=hour&since=1697000400000")
+    assert await response.get_json() == {"period": "hour", "stats": []}
+    response = await client.get("/logs/stats?period=week")
+    assert response.status_code == 400
+
+
+def test_rebuild_log_stats_command(monkeypatch, tmp_path):
+    conn = sqlite3.connect(tmp_path / "app.db")
+    conn.executescript(logstore.SCHEMA + logstore.ROLLUP_SCHEMA)
+    conn.execute("INSERT INTO logs (uuid, feedback, timestamp) VALUES ('user-1', 'good', 1697000000000)")
+    conn.execute("UPDATE logs_rollup SET count = 5")
+    conn.commit()
+
+    monkeypatch.setenv("LOGS_DB_PATH", str(tmp_path / "app.db"))
+    result = app.create_app().test_cli_runner().invoke(args=["rebuild-log-stats"])
+    assert result.exit_code == 0, result.output
+    assert conn.execute("SELECT period, count FROM logs_rollup ORDER BY period").fetchall() == [("day", 1), ("hour", 1)]
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_openai_token_refreshed_in_background(client):
+    response = await client.get("/stats")
+    token_stats = (await response.get_json())["openai_token"]
+    if openai.api_type != "azure_ad":
+        assert token_stats is None
+        return
+    assert openai.api_key == "mock_token"
+    # Requests find the token fresh and never wait for a refresh
+    await client.get("/logs")
+    response = await client.get("/stats")
+    token_stats = (await response.get_json())["openai_token"]
+    assert token_stats["refreshes"] == 1
+    assert token_stats["blocking_refreshes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_answer_cache(client, monkeypatch):
+    calls = []
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def counting_acreate(*args, **kwargs):
+        calls.append(kwargs.get("stream", False))
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", counting_acreate)
+
+    response = await client.post("/ask", json={"question": "What is the capital of France?"})
+    answer = await response.get_json()
+    assert answer["choices"][0]["extra_args"].pop("token_usage")["total_tokens"] > 0
+    assert answer["choices"][0]["extra_args"].pop("timings")
+    response = await client.post("/ask", json={"question": "  what is the capital of  France?"})
+    cached = (await response.get_json())["choices"][0]
+    assert cached["message"] == answer["choices"][0]["message"]
+    # A cached answer uses no tokens and takes no stages
+    assert cached["extra_args"].pop("token_usage")["total_tokens"] == 0
+    assert cached["extra_args"].pop("timings") == {}
+    assert "Server-Timing" not in response.headers
+    assert cached["extra_args"] == answer["choices"][0]["extra_args"]
+    assert len(calls) == 1
+    response = await client.post("/ask", json={"question": "What is the capital of France?", "overrides": {"top": 1}})
+    assert len(calls) == 2
+
+    # A streamed answer is replayed to both /chat and /chat_stream
+    history = [{"user": "What is the capital of France?"}]
+    response = await client.post("/chat_stream", json={"history": history})
+    streamed = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert len(calls) == 4
+    response = await client.post("/chat", json={"history": history})
+    result = await response.get_json()
+    assert result["choices"][0]["message"] == {"role": "assistant", "content": "The capital of France is Paris."}
+    assert result["choices"][0]["extra_args"].pop("token_usage")["total_tokens"] == 0
+    assert result["choices"][0]["extra_args"].pop("timings") == {}
+    assert streamed[0]["choices"][0]["extra_args"].pop("timings")
+    assert result["choices"][0]["extra_args"] == streamed[0]["choices"][0]["extra_args"]
+    response = await client.post("/chat_stream", json={"history": history})
+    replayed = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert replayed[0]["choices"][0]["extra_args"].pop("timings") == {}
+    assert replayed[0] == streamed[0]
+    assert "".join(event["choices"][0]["delta"].get("content", "") for event in replayed[1:]) == (
+        "The capital of France is Paris."
+    )
+    assert streamed[-1]["choices"][0]["extra_args"]["token_usage"]["total_tokens"] > 0
+    assert replayed[-1]["choices"][0]["extra_args"]["token_usage"]["total_tokens"] == 0
+    assert len(calls) == 4
+
+    response = await client.get("/stats")
+    answer_stats = (await response.get_json())["answer_cache"]
+    assert answer_stats["hits"] == 3
+    assert answer_stats["misses"] == 3
+    assert answer_stats["hit_rate"] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_request_coalescing(client, monkeypatch):
+    calls = []
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def slow_acreate(*args, **kwargs):
+        calls.append(kwargs.get("stream", False))
+        await asyncio.sleep(0.05)
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_acreate)
+
+    # Identical requests arriving together share one answer, before it is in the answer cache
+    responses = await asyncio.gather(
+        *[client.post("/ask", json={"question": "What is the capital of Italy?"}) for _ in range(3)]
+    )
+    answers = [await response.get_json() for response in responses]
+    assert all(answer == answers[0] for answer in answers)
+    assert calls == [False]
+
+    history = [{"user": "What is the capital of Italy?"}]
+    responses = await asyncio.gather(*[client.post("/chat_stream", json={"history": history}) for _ in range(3)])
+    streams = [await response.get_data(as_text=True) for response in responses]
+    assert all(stream == streams[0] for stream in streams)
+    assert len(streams[0].splitlines()) == 4
+    assert calls == [False, False, True]
+
+    response = await client.get("/stats")
+    stats = (await response.get_json())["request_coalescing"]
+    assert stats["coalesced"] == 2
+    assert stats["coalesced_streams"] == 2
+    assert stats["inflight"] == 0
+    assert stats["inflight_streams"] == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_control(client, monkeypatch):
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def slow_acreate(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_acreate)
+    admission = AdmissionController(1, 1, 0.05)
+    client.app.config[app.CONFIG_ADMISSION_CONTROLLER] = admission
+
+    async def post_when(ready, question):
+        while not ready():
+            await asyncio.sleep(0.001)
+        return await client.post("/ask", json={"question": question})
+
+    # The first request is answered, the second times out in the queue and the third finds the queue full
+    responses = await asyncio.gather(
+        post_when(lambda: True, "What is the capital of France?"),
+        post_when(lambda: admission.inflight == 1, "What is the capital of Spain?"),
+        post_when(lambda: admission.queued == 1, "What is the capital of Italy?"),
+    )
+    assert [response.status_code for response in responses] == [200, 503, 429]
+    assert responses[2].headers["Retry-After"] == "1"
+    assert (await responses[2].get_json()) == {"error": "too many requests waiting"}
+
+    # A streamed answer holds its slot until the stream ends
+    response = await client.post("/chat_stream", json={"history": [{"user": "What is the capital of Spain?"}]})
+    assert response.status_code == 200
+    await response.get_data()
+    response = await client.get("/load")
+    assert response.status_code == 200
+    load = await response.get_json()
+    assert load["inflight"] == 0
+    assert load["queued"] == 0
+    assert load["admitted"] == 2
+    assert load["rejected_queue_full"] == 1
+    assert load["rejected_timeout"] == 1
+
+
+async def disconnect_during(quart_app, path: str, request_json: dict, disconnect: asyncio.Event, send=None):
+    # Calls the app the way an ASGI server does, and disconnects once disconnect is set
+    body = json.dumps(request_json).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def ignore(message):
+        pass
+
+    await quart_app(scope, receive, send or ignore)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ["/chat_stream", "/ask_stream"])
+async def test_stream_disconnect_releases_admission(client, monkeypatch, path):
+    pipeline_started = asyncio.Event()
+
+    async def hanging_acreate(*args, **kwargs):
+        pipeline_started.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(openai.Embedding, "acreate", hanging_acreate)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", hanging_acreate)
+    admission = AdmissionController(1, 1, 0.05)
+    client.app.config[app.CONFIG_ADMISSION_CONTROLLER] = admission
+    request_json = {"history": [{"user": "What is the capital of France?"}], "question": "What is the capital?"}
+    await asyncio.wait_for(disconnect_during(client.app, path, request_json, pipeline_started), 5)
+    assert admission.inflight == 0
+    assert admission.admitted == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ["/chat_stream", "/ask_stream"])
+async def test_stream_dropped_before_body_releases_admission(client, path):
+    # The client disconnects while the headers are sent, so the body of the response is never iterated
+    disconnect = asyncio.Event()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            disconnect.set()
+            await asyncio.sleep(10)
+
+    admission = AdmissionController(1, 1, 0.05)
+    client.app.config[app.CONFIG_ADMISSION_CONTROLLER] = admission
+    request_json = {"history": [{"user": "What is the capital of France?"}], "question": "What is the capital?"}
+    await asyncio.wait_for(disconnect_during(client.app, path, request_json, disconnect, send), 5)
+    await asyncio.sleep(0)
+    assert admission.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_token_usage(client):
+    history = [{"user": "What is the capital of France?"}]
+    response = await client.post("/chat", json={"history": history})
+    usage = (await response.get_json())["choices"][0]["extra_args"]["token_usage"]
+    assert set(usage["stages"]) == {"rewrite", "embedding", "answer"}
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+    # The streamed answer is counted locally, and the query rewrite and embedding are found in the caches
+    response = await client.post("/chat_stream", json={"history": history, "overrides": {"temperature": 0.1}})
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    stream_usage = events[-1]["choices"][0]["extra_args"]["token_usage"]
+    assert set(stream_usage["stages"]) == {"answer"}
+    assert stream_usage["stages"]["answer"] == usage["stages"]["answer"]
+
+    response = await client.get("/stats")
+    stats = (await response.get_json())["token_usage"]
+    assert stats["endpoints"]["/chat"]["total_tokens"] == usage["total_tokens"]
+    assert stats["endpoints"]["/chat_stream"]["total_tokens"] == stream_usage["total_tokens"]
+    # The totals per user are only shown to admins
+    assert "top_users" not in stats
+    response = await client.get("/stats/token_usage/users")
+    assert response.status_code == 404
+    client.app.config[app.CONFIG_ADMIN_KEY] = "secret"
+    response = await client.get("/stats/token_usage/users", headers={"X-Admin-Key": "secret"})
+    assert (await response.get_json())["top_users"]["anonymous"]["requests"] == 2
+
+
+@pytest.mark.asyncio
+async def test_server_timing(client):
+    response = await client.post("/ask", json={"question": "What is the capital of France?"})
+    assert response.headers["Server-Timing"] == "embedding;dur=0.0, search;dur=0.0, answer;dur=0.0"
+    assert (await response.get_json())["choices"][0]["extra_args"]["timings"] == {
+        "embedding": 0.0,
+        "search": 0.0,
+        "answer": 0.0,
+    }
+    # The header of a stream reports the stages before the answer, as does its first event
+    history = [{"user": "What is the capital of France?"}]
+    response = await client.post("/chat_stream", json={"history": history})
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    timings = events[0]["choices"][0]["extra_args"]["timings"]
+    assert set(timings) == {"rewrite", "embedding", "search", "answer_setup"}
+    assert response.headers["Server-Timing"] == ", ".join(f"{name};dur={dur}" for name, dur in timings.items())
+
+
+@pytest.mark.asyncio
+async def test_metrics(client):
+    response = await client.post("/chat_stream", json={"history": [{"user": "What is the capital of Spain?"}]})
+    await response.get_data()
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    metrics = await response.get_data(as_text=True)
+    for stage in ["rewrite", "embedding", "search"]:
+        assert (
+            f'app_stage_duration_seconds_count{{endpoint="/chat",retrieval_mode="hybrid",stage="{stage}"}}' in metrics
+        )
+    for stage in ["answer", "first_token"]:
+        assert f'endpoint="/chat_stream",retrieval_mode="hybrid",stage="{stage}"' in metrics
+    assert 'app_requests_total{endpoint="/chat_stream",status="200"}' in metrics
+    assert 'app_openai_tokens_total{endpoint="/chat_stream",kind="completion_tokens",stage="answer"}' in metrics
+    assert "app_event_loop_lag_seconds_bucket" in metrics
+    response = await client.get("/stats")
+    assert (await response.get_json())["loop_lag"]["max_lag_seconds"] >= 0
+
+
+@pytest.fixture(scope="module")
+def span_exporter():
+    # The tracer provider can only be set once per process
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return exporter
+
+
+@pytest.mark.asyncio
+async def test_pipeline_spans(client, span_exporter):
+    span_exporter.clear()
+    history = [{"user": "What is the capital of Spain?"}]
+    response = await client.post("/chat", json={"history": history, "overrides": {"top": 2}})
+    assert response.status_code == 200
+    spans = {span.name: span for span in span_exporter.get_finished_spans()}
+    assert {"query_rewrite", "embed_query", "search", "build_prompt", "answer_completion"} <= set(spans)
+    assert spans["query_rewrite"].attributes["app.rewrite_method"] == "completion"
+    assert spans["query_rewrite"].attributes["app.prompt_tokens"] > 0
+    assert spans["embed_query"].attributes["app.cache_hit"] is False
+    assert spans["search"].attributes["app.top"] == 2
+    assert spans["search"].attributes["app.result_count"] == 1
+    assert spans["search"].attributes["app.retrieval_mode"] == "hybrid"
+    assert spans["answer_completion"].attributes["app.completion_tokens"] > 0
+    # The retrieval stages are children of the query rewrite's parent, not of one another
+    assert spans["search"].parent.span_id == spans["query_rewrite"].parent.span_id
+
+    span_exporter.clear()
+    response = await client.post("/chat_stream", json={"history": history, "overrides": {"top": 2, "temperature": 0.1}})
+    await response.get_data()
+    spans = {span.name: span for span in span_exporter.get_finished_spans()}
+    assert spans["query_rewrite"].attributes["app.cache_hit"] is True
+    assert spans["embed_query"].attributes["app.cache_hit"] is True
+    assert spans["search"].attributes["app.cache_hit"] is True
+    assert spans["stream_first_token"].end_time <= spans["answer_completion"].end_time
+    assert spans["answer_completion"].attributes["app.streaming"] is True
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache(client, monkeypatch):
+    calls = []
+    mock_acreate = openai.Embedding.acreate
+
+    async def counting_acreate(*args, **kwargs):
+        calls.append(kwargs["input"])
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.Embedding, "acreate", counting_acreate)
+
+    # Different overrides miss the answer cache, but embed the same question
+    for top in [1, 2]:
+        response = await client.post(
+            "/ask", json={"question": "What is the capital of France?", "overrides": {"top": top}}
+        )
+        assert response.status_code == 200
+    assert calls == ["What is the capital of France?"]
+    response = await client.get("/stats")
+    embedding_stats = (await response.get_json())["embedding_cache"]
+    assert embedding_stats["hits"] == 1
+    assert embedding_stats["size"] == 3 * 4
+
+
+@pytest.mark.asyncio
+async def test_search_cache(client, monkeypatch):
+    searches = []
+    mock_search = SearchClient.search
+
+    async def counting_search(*args, **kwargs):
+        searches.append(kwargs["filter"])
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", counting_search)
+
+    # A different temperature misses the answer cache, but runs the same search
+    for temperature in [0.1, 0.2]:
+        overrides = {"temperature": temperature, "semantic_ranker": True}
+        response = await client.post(
+            "/ask", json={"question": "What is the capital of France?", "overrides": overrides}
+        )
+        assert response.status_code == 200
+    assert len(searches) == 1
+    overrides = {"exclude_category": "x"}
+    await client.post("/ask", json={"question": "What is the capital of France?", "overrides": overrides})
+    assert searches == [None, "category ne 'x'"]
+    response = await client.get("/stats")
+    search_stats = (await response.get_json())["search_cache"]
+    assert search_stats["hits"] == 1
+    assert search_stats["semantic_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_invalidate_cache(client):
+    response = await client.post("/cache/invalidate")
+    assert response.status_code == 404
+
+    client.app.config[app.CONFIG_ADMIN_KEY] = "secret"
+    response = await client.post("/cache/invalidate", headers={"X-Admin-Key": "wrong"})
+    assert response.status_code == 403
+
+    await client.post("/ask", json={"question": "What is the capital of France?"})
+    response = await client.post(
+        "/cache/invalidate", headers={"X-Admin-Key": "secret"}, json={"source": "Benefit_Options"}
+    )
+    assert response.status_code == 200
+    response = await client.get("/stats")
+    stats = await response.get_json()
+    assert stats["search_cache"]["entries"] == 0
+    assert stats["search_cache"]["invalidations"] == 1
+    assert stats["answer_cache"]["entries"] == 0
+    assert stats["cache_invalidation"]["applied"] == 1
+
+
+@pytest.mark.asyncio
+async def test_debug_profile(client):
+    response = await client.get("/debug/profile?seconds=0.05")
+    assert response.status_code == 404
+
+    client.app.config[app.CONFIG_ADMIN_KEY] = "secret"
+    headers = {"X-Admin-Key": "secret"}
+    response = await client.get("/debug/profile?seconds=3600", headers=headers)
+    assert response.status_code == 400
+    response = await client.get("/debug/profile?seconds=0.05&format=pstats", headers=headers)
+    assert response.status_code == 400
+
+    # The loop of the worker is sampled while it waits for the profile to finish
+    response = await client.get("/debug/profile?seconds=0.05&interval_ms=1", headers=headers)
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    lines = (await response.get_data(as_text=True)).splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+    response = await client.get("/debug/profile?seconds=0.05&format=speedscope", headers=headers)
+    assert response.headers["Content-Disposition"] == "attachment; filename=profile.speedscope.json"
+    assert (await response.get_json())["profiles"][0]["type"] == "sampled"
+    assert client.app.config[app.CONFIG_PROFILER] is None
+
+
+@pytest.mark.asyncio
+async def test_chat_profile_header(client):
+    history = [{"user": "What is the capital of France?"}]
+    response = await client.post("/chat", json={"history": history}, headers={"X-Profile": "collapsed"})
+    assert response.status_code == 404
+
+    client.app.config[app.CONFIG_ADMIN_KEY] = "secret"
+    headers = {"X-Admin-Key": "secret", "X-Profile": "flamegraph"}
+    response = await client.post("/chat", json={"history": history}, headers=headers)
+    assert response.status_code == 400
+
+    headers["X-Profile"] = "speedscope"
+    response = await client.post("/chat", json={"history": history}, headers=headers)
+    assert response.status_code == 200
+    assert "profiles" in await response.get_json()
+    assert client.app.config[app.CONFIG_PROFILER] is None
+    # Without the header, the answer is returned as usual
+    response = await client.post("/chat", json={"history": history}, headers={"X-Admin-Key": "secret"})
+    assert "choices" in await response.get_json()
+
+
+@pytest.mark.asyncio
+async def test_debug_memory(client):
+    response = await client.get("/debug/memory")
+    assert response.status_code == 404
+
+    client.app.config[app.CONFIG_ADMIN_KEY] = "secret"
+    headers = {"X-Admin-Key": "secret"}
+    response = await client.get("/debug/memory?group_by=module", headers=headers)
+    assert response.status_code == 400
+    try:
+        response = await client.get("/debug/memory", headers=headers)
+        assert response.status_code == 200
+        memory = await response.get_json()
+        assert memory["rss_bytes"] > 0
+        assert memory["structures"]["answer_cache"] == {"entries": 0, "size": 0}
+        assert memory["tracemalloc"]["seconds_since_previous"] is None
+
+        await client.post("/ask", json={"question": "What is the capital of France?"})
+        response = await client.get("/debug/memory?top=3", headers=headers)
+        memory = await response.get_json()
+        assert memory["structures"]["answer_cache"]["entries"] == 1
+        assert len(memory["tracemalloc"]["statistics"]) == 3
+        assert "size_diff" in memory["tracemalloc"]["statistics"][0]
+    finally:
+        response = await client.delete("/debug/memory", headers=headers)
+    assert await response.get_json() == {"tracing": False}
+
+
+@pytest.mark.asyncio
+async def test_query_rewrite_cache(client, monkeypatch):
+    rewrites = []
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def recording_acreate(*args, **kwargs):
+        if "functions" in kwargs:
+            rewrites.append(kwargs["messages"][-1]["content"])
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", recording_acreate)
+
+    # A different temperature misses the answer cache, but rewrites the same conversation
+    for temperature in [0.1, 0.2]:
+        history = [{"user": "What is the capital of France?"}]
+        response = await client.post("/chat", json={"history": history, "overrides": {"temperature": temperature}})
+        assert response.status_code == 200
+    assert rewrites == ["Generate search query for: What is the capital of France?"]
+    response = await client.get("/stats")
+    assert (await response.get_json())["query_rewrite_cache"]["hits"] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "min_similarity, searched, wins",
+    [(0.5, "What is the capital of France?", 1), (0.8, "capital of France", 0)],
+)
+async def test_speculative_retrieval(client, monkeypatch, min_similarity, searched, wins):
+    search_texts = []
+    mock_search = SearchClient.search
+
+    async def recording_search(self, search_text, **kwargs):
+        search_texts.append(search_text)
+        return await mock_search(self, search_text, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", recording_search)
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    chat_approach.speculative_retrieval = True
+    chat_approach.speculation_min_similarity = min_similarity
+
+    # The rewrite turns the question into "capital of France", which shares half of its terms
+    response = await client.post("/chat", json={"history": [{"user": "What is the capital of France?"}]})
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["extra_args"]["thoughts"].startswith(f"Searched for:<br>{searched}<br>")
+    # A discarded speculation is cancelled, possibly before it reaches the search
+    assert search_texts[-1] == searched
+    if wins:
+        assert len(search_texts) == 1
+    response = await client.get("/stats")
+    assert (await response.get_json())["speculative_retrieval"] == {
+        "speculations": 1,
+        "wins": wins,
+        "wasted": 1 - wins,
+        "win_rate": wins,
+    }
+
+
+@pytest.mark.asyncio
+async def test_discarded_speculation_timed_separately(client, monkeypatch):
+    mock_search = SearchClient.search
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def slow_speculative_search(self, search_text, **kwargs):
+        # The speculation searches for the question as asked, and is still searching when it is discarded
+        if search_text == "What is the capital of France?":
+            await asyncio.sleep(10)
+        return await mock_search(self, search_text, **kwargs)
+
+    async def slow_rewrite(*args, **kwargs):
+        if "functions" in kwargs:
+            await asyncio.sleep(0.2)
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", slow_speculative_search)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_rewrite)
+    monkeypatch.setattr(servertiming, "time", time)
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    chat_approach.speculative_retrieval = True
+    chat_approach.speculation_min_similarity = 0.8
+    labels = {"endpoint": "/chat", "stage": "search", "retrieval_mode": "hybrid"}
+    speculative_labels = {**labels, "stage": "speculative_search"}
+    searches_timed = REGISTRY.get_sample_value("app_stage_duration_seconds_count", labels) or 0
+    speculations_timed = REGISTRY.get_sample_value("app_stage_duration_seconds_count", speculative_labels) or 0
+
+    response = await client.post("/chat", json={"history": [{"user": "What is the capital of France?"}]})
+    assert response.status_code == 200
+    timings = (await response.get_json())["choices"][0]["extra_args"]["timings"]
+    # The search of the rewritten query does not include the time the speculation spent searching during the rewrite
+    assert timings["search"] < 100
+    assert timings["speculative_search"] >= 150
+    assert REGISTRY.get_sample_value("app_stage_duration_seconds_count", labels) == searches_timed + 1
+    assert REGISTRY.get_sample_value("app_stage_duration_seconds_count", speculative_labels) == speculations_timed + 1
+
+
+@pytest.mark.asyncio
+async def test_query_rewrite_fast_path(client, monkeypatch):
+    rewrites = []
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def recording_acreate(*args, **kwargs):
+        if "functions" in kwargs:
+            rewrites.append(kwargs["messages"][-1]["content"])
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", recording_acreate)
+
+    overrides = {"rewrite_fast_path": True}
+    response = await client.post(
+        "/chat", json={"history": [{"user": "Is [info1.txt] dental+vision covered?"}], "overrides": overrides}
+    )
+    result = await response.get_json()
+    assert result["choices"][0]["extra_args"]["thoughts"].startswith("Searched for:<br>Is dental vision covered<br>")
+    assert rewrites == []
+    # Follow-up questions still need the conversation to be rewritten
+    history = [{"user": "Is dental covered?", "bot": "Yes."}, {"user": "And vision?"}]
+    response = await client.post("/chat", json={"history": history, "overrides": overrides})
+    assert rewrites == ["Generate search query for: And vision?"]
+
+    response = await client.get("/stats")
+    rewrite_stats = (await response.get_json())["query_rewrite"]
+    assert rewrite_stats["fast_path"]["count"] == 1
+    assert "cache" not in rewrite_stats
+    assert rewrite_stats["completion"]["count"] == 1
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def gen():
@@ -309,3 +1187,56 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.asyncio
+async def test_openai_session_shared(client, monkeypatch):
+    sessions = []
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def recording_acreate(*args, **kwargs):
+        sessions.append(openai.aiosession.get())
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", recording_acreate)
+
+    response = await client.post("/ask", json={"question": "What is the capital of France?"})
+    assert response.status_code == 200
+    response = await client.post("/chat", json={"history": [{"user": "What is the capital of France?"}]})
+    assert response.status_code == 200
+    response = await client.post("/chat_stream", json={"history": [{"user": "What is the capital of Spain?"}]})
+    assert response.status_code == 200
+    await response.get_data()
+
+    openai_session = client.app.config[app.CONFIG_OPENAI_SESSION]
+    assert len(sessions) == 5
+    assert all(session is openai_session for session in sessions)
+    assert not openai_session.closed
+
+
+@pytest.mark.asyncio
+async def test_warm_up_openai_session(caplog):
+    class MockResponse:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+        async def read(self):
+            return b""
+
+    class MockSession:
+        def __init__(self):
+            self.urls = []
+
+        def head(self, url):
+            self.urls.append(url)
+            if len(self.urls) > 2:
+                raise ConnectionError("connection refused")
+            return MockResponse()
+
+    session = MockSession()
+    await app.warm_up_openai_session(session, "https://test-openai-service.openai.azure.com", 3)
+    assert session.urls == ["https://test-openai-service.openai.azure.com"] * 3
+    assert "Failed to warm up 1 of 3 OpenAI connections" in caplog.text
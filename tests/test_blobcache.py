@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.storage.blob import BlobProperties
+
+from core.blobcache import BlobCache
+
+
+class MockDownloader:
+    def __init__(self, data):
+        self.data = data
+
+    async def chunks(self):
+        for i in range(0, len(self.data), 4):
+            yield self.data[i : i + 4]
+
+
+class MockBlobClient:
+    def __init__(self, blob_name, data, etag='"0x1"'):
+        self.blob_name = blob_name
+        self.data = data
+        self.etag = etag
+        self.property_requests = 0
+        self.downloads = 0
+
+    async def get_blob_properties(self, **kwargs):
+        self.property_requests += 1
+        await asyncio.sleep(0)
+        if kwargs.get("match_condition") == MatchConditions.IfModified and kwargs.get("etag") == self.etag:
+            raise ResourceNotModifiedError("Not modified")
+        return BlobProperties(
+            name=self.blob_name, **{"ETag": self.etag, "Content-Length": len(self.data), "Content-Type": "text/plain"}
+        )
+
+    async def download_blob(self, **kwargs):
+        assert kwargs["etag"] == self.etag
+        self.downloads += 1
+        return MockDownloader(self.data)
+
+
+@pytest.fixture
+def blob_cache(tmp_path):
+    blob_cache = BlobCache(
+        memory_max_size=16,
+        memory_max_entry_size=8,
+        disk_max_size=40,
+        disk_max_entry_size=32,
+        ttl=60,
+        directory=str(tmp_path),
+    )
+    yield blob_cache
+    blob_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_blobcache_memory_tier(blob_cache):
+    blob_client = MockBlobClient("small.txt", b"1234567")
+    blob = await blob_cache.get(blob_client)
+    assert blob.data == b"1234567"
+    assert blob.path is None
+    assert blob.content_type == "text/plain"
+    blob = await blob_cache.get(blob_client)
+    assert blob.data == b"1234567"
+    assert blob_client.downloads == 1
+    assert blob_client.property_requests == 1
+    assert blob_cache.stats()["hits"] == 1
+    assert blob_cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_blobcache_disk_tier_eviction(blob_cache):
+    first = await blob_cache.get(MockBlobClient("first.txt", b"a" * 20))
+    assert first.data is None
+    assert first.path.read_bytes() == b"a" * 20
+    second = await blob_cache.get(MockBlobClient("second.txt", b"b" * 20))
+    assert second.path.read_bytes() == b"b" * 20
+    await blob_cache.get(MockBlobClient("third.txt", b"c" * 20))
+    assert not first.path.exists()
+    assert blob_cache.stats()["disk"]["evictions"] == 1
+    assert blob_cache.stats()["disk"]["size"] == 40
+
+
+@pytest.mark.asyncio
+async def test_blobcache_uncacheable(blob_cache):
+    blob_client = MockBlobClient("large.txt", b"x" * 33)
+    blob = await blob_cache.get(blob_client)
+    assert not blob.is_cached
+    assert blob.size == 33
+    assert blob_client.downloads == 0
+    assert blob_cache.stats()["uncacheable"] == 1
+
+
+@pytest.mark.asyncio
+async def test_blobcache_revalidation(blob_cache):
+    blob_client = MockBlobClient("small.txt", b"1234567")
+    blob = await blob_cache.get(blob_client)
+
+    blob.validated_at -= 61
+    blob = await blob_cache.get(blob_client)
+    assert blob.data == b"1234567"
+    assert blob_client.downloads == 1
+    assert blob_cache.stats()["revalidations"] == 1
+
+    blob.validated_at -= 61
+    blob_client.data = b"7654321"
+    blob_client.etag = '"0x2"'
+    blob = await blob_cache.get(blob_client)
+    assert blob.data == b"7654321"
+    assert blob.etag == '"0x2"'
+    assert blob_client.downloads == 2
+
+
+@pytest.mark.asyncio
+async def test_blobcache_coalesces_concurrent_misses(blob_cache):
+    blob_client = MockBlobClient("small.txt", b"1234567")
+    blobs = await asyncio.gather(*[blob_cache.get(blob_client) for _ in range(5)])
+    assert all(blob is blobs[0] for blob in blobs)
+    assert blob_client.downloads == 1
+    assert blob_cache.stats()["coalesced"] == 4
+
+
+def test_blobcache_close(tmp_path):
+    blob_cache = BlobCache(16, 8, 40, 32, ttl=60, directory=str(tmp_path))
+    assert blob_cache.directory.parent == tmp_path
+    blob_cache.close()
+    assert not blob_cache.directory.exists()
+
+
+@pytest.mark.asyncio
+async def test_blobcache_open_file_survives_eviction(blob_cache):
+    first = await blob_cache.get(MockBlobClient("first.txt", b"a" * 20))
+    file = await blob_cache.open(first)
+    await blob_cache.get(MockBlobClient("second.txt", b"b" * 20))
+    await blob_cache.get(MockBlobClient("third.txt", b"c" * 20))
+    assert not first.path.exists()
+    # The file opened before the eviction can still be read in full, but it can no longer be opened
+    with file:
+        assert file.read() == b"a" * 20
+    assert await blob_cache.open(first) is None
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from core.cache import LRUCache, SingleFlight
+
+
+def test_lrucache_evicts_least_recently_used():
+    cache: LRUCache[str, int] = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"entries": 2, "size": 2, "max_size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_lrucache_sizeof():
+    evicted = []
+    cache: LRUCache[str, bytes] = LRUCache(10, sizeof=len, on_evict=lambda key, value: evicted.append(key))
+    cache.set("a", b"12345")
+    cache.set("b", b"1234")
+    cache.set("c", b"123")
+    assert evicted == ["a"]
+    assert cache.size == 7
+    cache.set("too-large", b"12345678901")
+    assert cache.get("too-large") is None
+    assert len(cache) == 2
+
+
+def test_lrucache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.cache.time.monotonic", lambda: now)
+    cache: LRUCache[str, int] = LRUCache(10, ttl=60)
+    cache.set("a", 1)
+    now += 30
+    assert cache.get("a") == 1
+    now += 31
+    assert cache.get("a") is None
+    assert cache.evictions == 1
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_singleflight_coalesces_concurrent_calls():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    results = await asyncio.gather(*[single_flight.do("key", fetch) for _ in range(5)])
+    assert results == [1, 1, 1, 1, 1]
+    assert single_flight.coalesced == 4
+    assert len(single_flight) == 0
+    assert await single_flight.do("key", fetch) == 2
+
+
+@pytest.mark.asyncio
+async def test_singleflight_shares_exceptions():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    results = await asyncio.gather(*[single_flight.do("key", fail) for _ in range(2)], return_exceptions=True)
+    assert [str(result) for result in results] == ["upstream failed", "upstream failed"]
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from core.answercache import AnswerCache
+from core.cacheinvalidation import CacheInvalidator
+from core.logstore import LogStore
+from core.searchcache import SearchCache
+
+
+@pytest.mark.asyncio
+async def test_cacheinvalidator_reaches_other_workers(tmp_path):
+    # Two workers with their own store connection and caches, sharing the database
+    workers = []
+    for _ in range(2):
+        log_store = LogStore(str(tmp_path / "app.db"))
+        await log_store.open()
+        search_cache = SearchCache(1000, ttl=60)
+        search_cache.set("a", ["Benefit_Options-2.pdf: a"])
+        search_cache.set("b", ["Handbook-3.pdf: b"])
+        answer_cache = AnswerCache(1000, ttl=60)
+        answer_cache.set("q", {"role": "assistant", "content": "a"}, {}, "stop")
+        invalidator = CacheInvalidator(log_store, search_cache, answer_cache, interval=0.01)
+        await invalidator.start()
+        workers.append((log_store, search_cache, answer_cache, invalidator))
+
+    try:
+        await workers[0][3].invalidate("Benefit_Options")
+        # Applied by the worker that recorded it before returning
+        assert workers[0][1].get("a") is None
+        assert workers[0][2].get("q") is None
+        await asyncio.sleep(0.1)
+        for _, search_cache, answer_cache, invalidator in workers:
+            assert search_cache.get("a") is None
+            assert search_cache.get("b") == ["Handbook-3.pdf: b"]
+            assert answer_cache.get("q") is None
+            assert invalidator.stats() == {"applied": 1, "last_id": 1}
+    finally:
+        for log_store, _, _, invalidator in workers:
+            invalidator.stop()
+            await log_store.close()
+
+
+@pytest.mark.asyncio
+async def test_cacheinvalidator_skips_earlier_invalidations(tmp_path):
+    log_store = LogStore(str(tmp_path / "app.db"))
+    await log_store.open()
+    await log_store.add_cache_invalidation(None)
+    search_cache = SearchCache(1000, ttl=60)
+    invalidator = CacheInvalidator(log_store, search_cache, None)
+    await invalidator.start()
+    search_cache.set("a", ["Benefit_Options-2.pdf: a"])
+    await invalidator.apply_new_invalidations()
+    assert search_cache.get("a") == ["Benefit_Options-2.pdf: a"]
+    invalidator.stop()
+    await log_store.close()
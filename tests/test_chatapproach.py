@@ -1,5 +1,9 @@
+import asyncio
+import gc
 import json
 
+import pytest
+
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 
 
@@ -100,3 +104,31 @@ def test_get_messages_from_history_truncated_longer():
         },
         {"role": "user", "content": "What does a Product Manager do?"},
     ]
+
+
+@pytest.mark.asyncio
+async def test_discarded_speculation_that_fails_is_retrieved():
+    chat_approach = ChatReadRetrieveReadApproach(None, "", "gpt-35-turbo", "gpt-35-turbo", "", "", "", "")
+
+    async def retrieval_failing_on_cancel():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            raise Exception("Search client failed to close")
+
+    speculation = asyncio.create_task(retrieval_failing_on_cancel())
+    await asyncio.sleep(0)
+    loop = asyncio.get_running_loop()
+    unhandled = []
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context["message"]))
+    try:
+        results = await chat_approach.use_speculation(speculation, "dental plan deductible", "Who is the CEO?")
+        assert results is None
+        await asyncio.sleep(0.01)
+        assert speculation.done() and not speculation.cancelled()
+        # The exception of a task nobody retrieved is reported when the task is garbage collected
+        del speculation
+        gc.collect()
+    finally:
+        loop.set_exception_handler(None)
+    assert unhandled == []
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from core.coalesce import Broadcast, RequestCoalescer
+
+
+async def count_to(n, calls, delay=0.01):
+    calls.append(n)
+    for i in range(n):
+        await asyncio.sleep(delay)
+        yield i
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+@pytest.mark.asyncio
+async def test_broadcast_replays_to_late_subscribers():
+    broadcast = Broadcast(count_to(3, []))
+    first = broadcast.subscribe()
+    assert await first.__anext__() == 0
+    # A subscriber joining after the first item still receives every item
+    assert await asyncio.gather(collect(first), collect(broadcast.subscribe())) == [[1, 2], [0, 1, 2]]
+    assert broadcast.done
+
+
+@pytest.mark.asyncio
+async def test_broadcast_raises_error_to_subscribers():
+    async def fail():
+        yield 1
+        raise RuntimeError("upstream failed")
+
+    broadcast = Broadcast(fail())
+    for _ in range(2):
+        events = broadcast.subscribe()
+        assert await events.__anext__() == 1
+        with pytest.raises(RuntimeError, match="upstream failed"):
+            await events.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_broadcast_cancelled_when_last_subscriber_leaves():
+    broadcast = Broadcast(count_to(100, []))
+    events = broadcast.subscribe()
+    await events.__anext__()
+    await events.aclose()
+    await asyncio.sleep(0)
+    assert broadcast.task.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_coalescer_runs_concurrent_calls_once():
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "Paris"
+
+    coalescer = RequestCoalescer()
+    assert await asyncio.gather(*[coalescer.run("key", answer) for _ in range(3)]) == ["Paris"] * 3
+    assert calls == [1]
+    assert coalescer.stats() == {"inflight": 0, "inflight_streams": 0, "coalesced": 2, "coalesced_streams": 0}
+
+
+@pytest.mark.asyncio
+async def test_coalescer_fans_out_streams():
+    calls: list[int] = []
+    coalescer = RequestCoalescer()
+    streams = [coalescer.stream("key", lambda: count_to(3, calls)) for _ in range(3)]
+    streams.append(coalescer.stream("other", lambda: count_to(2, calls)))
+    results = await asyncio.gather(*[collect(stream) for stream in streams])
+    assert results == [[0, 1, 2], [0, 1, 2], [0, 1, 2], [0, 1]]
+    assert calls == [3, 2]
+    assert coalescer.stats()["coalesced_streams"] == 2
+    assert coalescer.stats()["inflight_streams"] == 0
+
+    # A stream that has finished is not shared with later requests
+    assert await collect(coalescer.stream("key", lambda: count_to(1, calls))) == [0]
+    assert calls == [3, 2, 1]
@@ -0,0 +1,52 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from core.embeddingcache import EmbeddingCache
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_stores_float32():
+    calls = []
+
+    async def embed(text):
+        calls.append(text)
+        return [0.5, 0.25, 0.125]
+
+    cache = EmbeddingCache(1024, ttl=60)
+    assert await cache.get("ada", " health  plans\n", embed) == [0.5, 0.25, 0.125]
+    assert await cache.get("ada", "health plans", embed) == [0.5, 0.25, 0.125]
+    assert await cache.get("other-model", "health plans", embed) == [0.5, 0.25, 0.125]
+    assert calls == ["health plans", "health plans"]
+    vector = cache.embeddings.get(("ada", "health plans"))
+    assert vector.dtype == np.float32
+    assert cache.stats()["size"] == 2 * 3 * 4
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_bounded_by_bytes():
+    async def embed(text):
+        return [1.0] * 4
+
+    cache = EmbeddingCache(40, ttl=60)
+    for text in ["a", "b", "c"]:
+        await cache.get("ada", text, embed)
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_coalesces_concurrent_misses():
+    calls = []
+
+    async def embed(text):
+        calls.append(text)
+        await asyncio.sleep(0.01)
+        return [1.0]
+
+    cache = EmbeddingCache(1024, ttl=60)
+    vectors = await asyncio.gather(*[cache.get("ada", "question", embed) for _ in range(5)])
+    assert vectors == [[1.0]] * 5
+    assert calls == ["question"]
+    assert cache.stats()["coalesced"] == 4
@@ -0,0 +1,233 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+import pytest_asyncio
+
+from core.logstore import LogQueueFullError, LogStore
+
+
+@pytest_asyncio.fixture
+async def log_store(tmp_path):
+    log_store = LogStore(str(tmp_path / "app.db"))
+    await log_store.open()
+    yield log_store
+    await log_store.close()
+
+
+@pytest.mark.asyncio
+async def test_logstore_schema(log_store):
+    conn = sqlite3.connect(log_store.db_path)
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert {"logs_timestamp", "logs_uuid_timestamp", "logs_feedback_timestamp"} <= indexes
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_logstore_add_and_get(log_store):
+    await log_store.add_log("user-1", "good", 1697000000000, "thoughts", comment="Helpful")
+    await log_store.add_log("user-2", None, 1697000001000, None)
+    await log_store.flush()
+    assert await log_store.get_logs() == (
+        [
+            {"id": 2, "timestamp": 1697000001000, "uuid": "user-2", "feedback": None, "comment": None},
+            {"id": 1, "timestamp": 1697000000000, "uuid": "user-1", "feedback": "good", "comment": "Helpful"},
+        ],
+        None,
+    )
+    assert await log_store.get_log(1) == {
+        "id": 1,
+        "uuid": "user-1",
+        "feedback": "good",
+        "comment": "Helpful",
+        "timestamp": 1697000000000,
+        "thought_process": "thoughts",
+    }
+    assert await log_store.get_log(3) is None
+
+
+@pytest.mark.asyncio
+async def test_logstore_add_invalid_feedback(log_store):
+    with pytest.raises(ValueError, match="feedback must be one of good, bad"):
+        await log_store.add_log("user-1", "Great answer", 1697000000000, None)
+
+
+@pytest.mark.asyncio
+async def test_logstore_add_without_timestamp(log_store):
+    await log_store.add_log("user-1", "good", None, None)
+    await log_store.flush()
+    logs, _ = await log_store.get_logs()
+    assert logs[0]["timestamp"] > 1697000000000
+
+
+@pytest.mark.asyncio
+async def test_logstore_keyset_pagination(log_store):
+    # Two logs share a timestamp, so the page boundary has to fall back on the id
+    for i, timestamp in enumerate([100, 200, 200, 300, 400]):
+        await log_store.add_log(f"user-{i}", "good" if i % 2 else "bad", timestamp, f"thoughts-{i}")
+    await log_store.flush()
+
+    seen = []
+    cursor = None
+    while True:
+        logs, cursor = await log_store.get_logs(limit=2, cursor=cursor)
+        seen.extend((log["timestamp"], log["id"]) for log in logs)
+        if cursor is None:
+            break
+    assert seen == [(400, 5), (300, 4), (200, 3), (200, 2), (100, 1)]
+
+
+@pytest.mark.asyncio
+async def test_logstore_filters(log_store):
+    for i, timestamp in enumerate([100, 200, 300, 400]):
+        await log_store.add_log("user-a" if i < 2 else "user-b", "good" if i % 2 else "bad", timestamp, None)
+    await log_store.flush()
+
+    logs, _ = await log_store.get_logs(feedback="good")
+    assert [log["timestamp"] for log in logs] == [400, 200]
+    logs, _ = await log_store.get_logs(uuid="user-b")
+    assert [log["timestamp"] for log in logs] == [400, 300]
+    logs, _ = await log_store.get_logs(since=200, until=400)
+    assert [log["timestamp"] for log in logs] == [300, 200]
+    logs, _ = await log_store.get_logs(uuid="user-a", feedback="bad", fields=["feedback", "thought_process"])
+    assert logs == [{"id": 1, "timestamp": 100, "feedback": "bad", "thought_process": None}]
+
+
+@pytest.mark.asyncio
+async def test_logstore_invalid_parameters(log_store):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        await log_store.get_logs(cursor="bm90LWpzb24=")
+    with pytest.raises(ValueError, match="Unknown fields: password"):
+        await log_store.get_logs(fields=["uuid", "password"])
+    with pytest.raises(ValueError, match="limit must be between 1 and 500"):
+        await log_store.get_logs(limit=501)
+
+
+@pytest.mark.asyncio
+async def test_logstore_runs_off_the_event_loop(log_store):
+    thread_names = await log_store.run(lambda: threading.current_thread().name)
+    assert thread_names.startswith("logstore")
+    assert thread_names != threading.current_thread().name
+
+
+@pytest.mark.asyncio
+async def test_logstore_existing_database(tmp_path):
+    conn = sqlite3.connect(tmp_path / "app.db")
+    conn.execute(
+        "CREATE TABLE logs (id INTEGER PRIMARY KEY, uuid TEXT, feedback TEXT, timestamp NUMERIC, thought_process TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO logs (uuid, feedback, timestamp, thought_process) VALUES (?, ?, 1, 'x')",
+        [("old-1", "Great answer"), ("old-2", ""), ("old-3", "good")],
+    )
+    conn.commit()
+    conn.close()
+
+    log_store = LogStore(str(tmp_path / "app.db"))
+    await log_store.open()
+    logs, _ = await log_store.get_logs()
+    assert [(log["uuid"], log["feedback"], log["comment"]) for log in logs] == [
+        ("old-3", "good", None),
+        ("old-2", None, None),
+        ("old-1", None, "Great answer"),
+    ]
+    # Logs from before the rollup are counted when it is created, and comments that were stored as feedback are not
+    assert await log_store.get_stats() == [{"timestamp": 0, "total": 3, "feedback": {"": 2, "good": 1}}]
+    await log_store.close()
+
+
+@pytest.mark.asyncio
+async def test_logstore_writes_in_batches(tmp_path):
+    log_store = LogStore(str(tmp_path / "app.db"), batch_size=3, flush_interval=60)
+    await log_store.open()
+    for i in range(7):
+        await log_store.add_log(f"user-{i}", None, i, None)
+    # Two full batches are written right away, the rest waits for the flush interval
+    for _ in range(10):
+        await asyncio.sleep(0.01)
+        if log_store.rows_written == 6:
+            break
+    stats = log_store.stats()
+    assert stats["batches"] == 2
+    assert stats["rows_written"] == 6
+    assert stats["queue_depth"] == 1
+    await log_store.flush()
+    assert log_store.stats()["rows_written"] == 7
+    await log_store.close()
+
+
+@pytest.mark.asyncio
+async def test_logstore_rejects_when_queue_is_full(tmp_path):
+    log_store = LogStore(
+        str(tmp_path / "app.db"), batch_size=10, flush_interval=60, max_queue_size=2, enqueue_timeout=0
+    )
+    await log_store.open()
+    await log_store.add_log("user-1", None, 1, None)
+    await log_store.add_log("user-2", None, 2, None)
+    with pytest.raises(LogQueueFullError):
+        await log_store.add_log("user-3", None, 3, None)
+    assert log_store.stats()["rows_rejected"] == 1
+    await log_store.close()
+
+
+@pytest.mark.asyncio
+async def test_logstore_writes_queued_logs_on_close(tmp_path):
+    log_store = LogStore(str(tmp_path / "app.db"), batch_size=2, flush_interval=60)
+    await log_store.open()
+    for i in range(5):
+        await log_store.add_log(f"user-{i}", None, i, None)
+    await log_store.close()
+
+    conn = sqlite3.connect(tmp_path / "app.db")
+    assert conn.execute("SELECT COUNT(*) FROM logs").fetchone() == (5,)
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_logstore_export_logs(log_store):
+    for i, timestamp in enumerate([100, 200, 200, 300, 400]):
+        await log_store.add_log(f"user-{i}", "good", timestamp, None)
+    await log_store.flush()
+
+    chunks = [chunk async for chunk in log_store.export_logs(fields=["uuid"], chunk_size=2)]
+    assert chunks == [
+        [{"uuid": "user-0"}, {"uuid": "user-1"}],
+        [{"uuid": "user-2"}, {"uuid": "user-3"}],
+        [{"uuid": "user-4"}],
+    ]
+    chunks = [chunk async for chunk in log_store.export_logs(since=200, until=400, chunk_size=2)]
+    assert [[log["id"] for log in chunk] for chunk in chunks] == [[2, 3], [4]]
+    with pytest.raises(ValueError, match="Unknown fields: password"):
+        log_store.export_logs(fields=["password"])
+
+
+@pytest.mark.asyncio
+async def test_logstore_stats(log_store):
+    hour = 3600000
+    day = 24 * hour
+    for timestamp, feedback in [(day, "good"), (day + 1, "good"), (day + hour, None), (2 * day, "bad")]:
+        await log_store.add_log("user-1", feedback, timestamp, None)
+    await log_store.flush()
+
+    assert await log_store.get_stats("day") == [
+        {"timestamp": day, "total": 3, "feedback": {"": 1, "good": 2}},
+        {"timestamp": 2 * day, "total": 1, "feedback": {"bad": 1}},
+    ]
+    assert await log_store.get_stats("hour", since=day, until=2 * day) == [
+        {"timestamp": day, "total": 2, "feedback": {"good": 2}},
+        {"timestamp": day + hour, "total": 1, "feedback": {"": 1}},
+    ]
+    with pytest.raises(ValueError, match="period must be one of hour, day"):
+        await log_store.get_stats("week")
+
+
+@pytest.mark.asyncio
+async def test_logstore_rebuild_stats(log_store):
+    await log_store.add_log("user-1", "good", 100, None)
+    await log_store.flush()
+    await log_store.run(lambda: log_store.connection.execute("UPDATE logs SET feedback = 'bad'").connection.commit())
+    assert (await log_store.get_stats())[0]["feedback"] == {"good": 1}
+    await log_store.rebuild_stats()
+    assert (await log_store.get_stats())[0]["feedback"] == {"bad": 1}
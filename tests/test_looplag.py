@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from core.looplag import LoopLagMonitor
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_looplag_logs_the_stack_of_a_blocked_loop(caplog):
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        with caplog.at_level(logging.WARNING):
+            blocking_call()
+            await asyncio.sleep(0.05)
+    finally:
+        monitor.stop()
+    # The stall is logged once, with the call that blocked the loop
+    assert len(caplog.records) == 1
+    assert "Event loop blocked" in caplog.text
+    assert "in blocking_call" in caplog.text
+    stats = monitor.stats()
+    assert stats["blocked"] == 1
+    assert stats["max_lag_seconds"] >= 0.25
+    assert stats["measurements"] > 1
+
+
+@pytest.mark.asyncio
+async def test_looplag_idle_loop(caplog):
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.1)
+    monitor.start()
+    await asyncio.sleep(0.1)
+    monitor.stop()
+    assert monitor.stats()["blocked"] == 0
+    assert "Event loop blocked" not in caplog.text
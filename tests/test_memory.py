@@ -0,0 +1,40 @@
+import tracemalloc
+
+from core.memory import MemorySnapshots, gc_stats, rss_bytes
+
+
+def allocate() -> list[bytes]:
+    return [bytes(1000) for _ in range(1000)]
+
+
+def test_memory_snapshots_diff_by_allocation_site():
+    snapshots = MemorySnapshots()
+    try:
+        first = snapshots.snapshot()
+        assert tracemalloc.is_tracing()
+        assert first["seconds_since_previous"] is None
+        assert all("size_diff" not in stat for stat in first["statistics"])
+
+        kept = allocate()
+        second = snapshots.snapshot(top=5)
+        assert len(second["statistics"]) <= 5
+        # The list comprehension of allocate grew the most since the first snapshot
+        top = second["statistics"][0]
+        assert top["site"].startswith(__file__)
+        assert top["size_diff"] >= 1000 * 1000
+        assert top["count_diff"] >= 1000
+        assert second["seconds_since_previous"] >= 0
+
+        del kept
+        third = snapshots.snapshot(group_by="filename")
+        assert any(stat["site"] == __file__ and stat["size_diff"] < 0 for stat in third["statistics"])
+    finally:
+        snapshots.stop()
+    assert not tracemalloc.is_tracing()
+
+
+def test_memory_stats():
+    assert rss_bytes() > 0
+    stats = gc_stats()
+    assert len(stats["generations"]) == 3
+    assert stats["tracked_objects"] > 0
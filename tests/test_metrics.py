@@ -0,0 +1,27 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from core.metrics import observe_stage, render_metrics
+
+
+def test_observe_stage():
+    labels = {"endpoint": "/chat", "stage": "search", "retrieval_mode": "text"}
+    before = REGISTRY.get_sample_value("app_stage_duration_seconds_count", labels) or 0
+    with pytest.raises(RuntimeError):
+        # A stage that fails is still observed
+        with observe_stage("/chat", "search", "text"):
+            raise RuntimeError("search failed")
+    assert REGISTRY.get_sample_value("app_stage_duration_seconds_count", labels) == before + 1
+
+
+def test_render_metrics(monkeypatch, tmp_path):
+    with observe_stage("/ask", "embedding", "vectors"):
+        pass
+    data, content_type = render_metrics()
+    assert content_type.startswith("text/plain")
+    assert b'app_stage_duration_seconds_count{endpoint="/ask",retrieval_mode="vectors",stage="embedding"}' in data
+
+    # With gunicorn, the metrics are read from the files the workers write to
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    data, _ = render_metrics()
+    assert b"app_stage_duration_seconds" not in data
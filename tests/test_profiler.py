@@ -0,0 +1,53 @@
+import threading
+import time
+
+from core.profiler import SamplingProfiler
+
+
+def busy_loop(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler_samples_the_given_thread():
+    stop = threading.Event()
+    busy = threading.Thread(target=busy_loop, args=(stop,))
+    busy.start()
+    profiler = SamplingProfiler(busy.ident, interval=0.001)
+    profiler.start()
+    time.sleep(0.1)
+    profiler.stop()
+    stop.set()
+    busy.join()
+
+    assert profiler.stats()["samples"] > 0
+    # Every stack runs from the root of the thread to the busy loop
+    for stack in profiler.samples:
+        assert stack[0].startswith("_bootstrap (")
+        assert any(name.startswith("busy_loop (") for name in stack)
+    lines = profiler.collapsed().splitlines()
+    assert len(lines) == len(profiler.samples)
+    stack, count = lines[0].rsplit(" ", 1)
+    assert tuple(stack.split(";")) in profiler.samples
+    assert int(count) == profiler.samples.most_common(1)[0][1]
+
+
+def test_sampling_profiler_speedscope():
+    profiler = SamplingProfiler(0, interval=0.01)
+    profiler.samples[("main (app.py:1)", "run (app.py:5)")] = 3
+    profiler.samples[("main (app.py:1)", "wait (app.py:9)")] = 1
+    profile = profiler.speedscope()
+    assert profile["shared"]["frames"] == [
+        {"name": "main (app.py:1)"},
+        {"name": "run (app.py:5)"},
+        {"name": "wait (app.py:9)"},
+    ]
+    assert profile["profiles"][0]["samples"] == [[0, 1], [0, 2]]
+    assert profile["profiles"][0]["weights"] == [0.03, 0.01]
+    assert profile["profiles"][0]["endValue"] == 0.04
+    # A thread that does not exist is never sampled
+    profiler.samples.clear()
+    profiler.start()
+    time.sleep(0.05)
+    profiler.stop()
+    assert profiler.collapsed() == ""
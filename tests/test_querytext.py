@@ -0,0 +1,21 @@
+from core.querytext import normalize_search_query, query_similarity, query_terms
+
+
+def test_query_terms():
+    assert query_terms("What's covered by Northwind Health+?") == ["what", "s", "covered", "by", "northwind", "health"]
+
+
+def test_query_similarity():
+    assert query_similarity("Health plan cardio coverage", "cardio coverage, health plan") == 1.0
+    assert query_similarity("What is the capital of France?", "capital of France") == 0.5
+    assert query_similarity("dental", "vision") == 0.0
+    assert query_similarity("?", "") == 1.0
+
+
+def test_normalize_search_query():
+    assert normalize_search_query("Does my plan cover cardio?") == "Does my plan cover cardio"
+    assert normalize_search_query("What does info1.txt say about [info2.pdf] dental+vision?") == (
+        "What does say about dental vision"
+    )
+    assert normalize_search_query("<<Are there exclusions?>> What's the deductible?") == "What's the deductible"
+    assert normalize_search_query("???") == ""
@@ -0,0 +1,16 @@
+from core.rewritecache import QueryRewriteCache
+
+
+def test_rewritecache():
+    cache = QueryRewriteCache(2, ttl=60)
+    messages = [{"role": "system", "content": "Generate a query"}, {"role": "user", "content": "cardio?"}]
+    key = cache.key("gpt-35-turbo", messages)
+    assert key == cache.key("gpt-35-turbo", [dict(message) for message in messages])
+    assert key != cache.key("gpt-4", messages)
+    assert key != cache.key("gpt-35-turbo", messages + [{"role": "user", "content": "and dental?"}])
+    cache.set(key, "cardio coverage")
+    assert cache.get(key) == "cardio coverage"
+    cache.set("b", "b")
+    cache.set("c", "c")
+    assert cache.get(key) is None
+    assert cache.stats()["evictions"] == 1
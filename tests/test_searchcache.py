@@ -0,0 +1,37 @@
+from core.searchcache import SearchCache
+
+
+def test_searchcache_key():
+    cache = SearchCache(1000, ttl=60)
+    fields = ("sourcepage", "content")
+    key = cache.key("health plans", [0.1, 0.2], "category ne 'x'", 3, True, False, fields)
+    assert key == cache.key("health plans", [0.1, 0.2], "category ne 'x'", 3, True, False, fields)
+    assert key != cache.key("health plans", [0.1, 0.3], "category ne 'x'", 3, True, False, fields)
+    assert key != cache.key("health plans", None, "category ne 'x'", 3, True, False, fields)
+    assert key != cache.key("health plans", [0.1, 0.2], None, 3, True, False, fields)
+    assert key != cache.key("health plans", [0.1, 0.2], "category ne 'x'", 5, True, False, fields)
+    assert key != cache.key("health plans", [0.1, 0.2], "category ne 'x'", 3, False, False, fields)
+    assert key != cache.key("health plans", [0.1, 0.2], "category ne 'x'", 3, True, True, fields)
+
+
+def test_searchcache_bounded_by_characters():
+    cache = SearchCache(10, ttl=60)
+    cache.set("a", ["a.pdf: 1"])
+    cache.set("b", ["b.pdf: 1"])
+    assert cache.get("a") is None
+    assert cache.get("b") == ["b.pdf: 1"]
+
+
+def test_searchcache_invalidate():
+    cache = SearchCache(1000, ttl=60)
+    cache.set("a", ["Benefit_Options-2.pdf: a", "Handbook-1.pdf: b"])
+    cache.set("b", ["Handbook-3.pdf: c"])
+    cache.set("c", ["Perks-1.pdf: d"])
+    cache.invalidate("Benefit_Options")
+    assert cache.get("a") is None
+    assert cache.get("b", use_semantic_ranker=True) == ["Handbook-3.pdf: c"]
+    cache.invalidate()
+    assert cache.get("c") is None
+    stats = cache.stats()
+    assert stats["invalidations"] == 2
+    assert stats["semantic_hits"] == 1
@@ -0,0 +1,31 @@
+from unittest import mock
+
+import core.servertiming
+from core.servertiming import ServerTiming, server_timing_header
+
+
+def test_servertiming_adds_up_repeated_stages(monkeypatch):
+    clock = iter([0.0, 0.5, 1.0, 1.25, 2.0, 2.0125])
+    monkeypatch.setattr(core.servertiming, "time", mock.Mock(monotonic=lambda: next(clock)))
+    timing = ServerTiming()
+    with timing.measure("embedding"):
+        pass
+    with timing.measure("search"):
+        pass
+    with timing.measure("embedding"):
+        pass
+    assert timing.as_dict() == {"embedding": 512.5, "search": 250.0}
+    assert server_timing_header(timing.as_dict()) == "embedding;dur=512.5, search;dur=250.0"
+
+
+def test_servertiming_measures_failed_stages(monkeypatch):
+    clock = iter([0.0, 0.1])
+    monkeypatch.setattr(core.servertiming, "time", mock.Mock(monotonic=lambda: next(clock)))
+    timing = ServerTiming()
+    try:
+        with timing.measure("rewrite"):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert timing.as_dict() == {"rewrite": 100.0}
+    assert server_timing_header({}) == ""
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+from azure.core.credentials import AccessToken
+
+from core.tokenrefresher import TokenRefresher
+
+
+class MockCredential:
+    def __init__(self, lifetime: float):
+        self.lifetime = lifetime
+        self.calls = 0
+        self.fail = False
+
+    async def get_token(self, scope):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("no token")
+        return AccessToken(f"token-{self.calls}", int(time.time() + self.lifetime))
+
+
+@pytest.mark.asyncio
+async def test_tokenrefresher_start():
+    tokens = []
+    refresher = TokenRefresher(MockCredential(3600), "scope", on_refresh=lambda token: tokens.append(token.token))
+    await refresher.start()
+    assert (await refresher.get_token()).token == "token-1"
+    assert tokens == ["token-1"]
+    assert refresher.stats()["refreshes"] == 1
+    assert refresher.stats()["blocking_refreshes"] == 0
+    refresher.stop()
+
+
+@pytest.mark.asyncio
+async def test_tokenrefresher_refreshes_stale_token_once():
+    credential = MockCredential(30)
+    refresher = TokenRefresher(credential, "scope", min_validity=60)
+    await refresher.start()
+    # The token expires within min_validity, so concurrent requests share one refresh
+    tokens = await asyncio.gather(*[refresher.get_token() for _ in range(5)])
+    assert {token.token for token in tokens} == {"token-2"}
+    assert credential.calls == 2
+    assert refresher.stats()["coalesced"] == 4
+    refresher.stop()
+
+
+@pytest.mark.asyncio
+async def test_tokenrefresher_refreshes_in_background():
+    credential = MockCredential(2)
+    refresher = TokenRefresher(credential, "scope", refresh_margin=1.95, min_validity=0)
+    await refresher.start()
+    await asyncio.sleep(1.2)
+    assert credential.calls == 2
+    assert (await refresher.get_token()).token == "token-2"
+    refresher.stop()
+
+
+@pytest.mark.asyncio
+async def test_tokenrefresher_keeps_valid_token_on_failure():
+    credential = MockCredential(30)
+    refresher = TokenRefresher(credential, "scope", min_validity=60)
+    await refresher.start()
+    credential.fail = True
+    assert (await refresher.get_token()).token == "token-1"
+    assert refresher.stats()["failures"] == 1
+    assert refresher.stats()["last_error"] == "no token"
+    refresher.stop()
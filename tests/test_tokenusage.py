@@ -0,0 +1,58 @@
+from core.tokenusage import (
+    TokenUsage,
+    TokenUsageStats,
+    count_completion_tokens,
+    count_tokens,
+)
+
+
+def test_count_tokens():
+    assert count_tokens("Hello, how are you?", "gpt-35-turbo") == 6
+    # Embedding models are not chat models, but share their encoding
+    assert count_tokens("Hello, how are you?", "text-embedding-ada-002") == 6
+    assert count_completion_tokens(
+        {"role": "assistant", "function_call": {"name": "search_sources", "arguments": "Hello, how are you?"}},
+        "gpt-35-turbo",
+    ) == count_tokens("Hello, how are you?", "gpt-35-turbo")
+
+
+def test_tokenusage_add_completion():
+    messages = [{"role": "user", "content": "Hello, how are you?"}]
+    usage = TokenUsage()
+    usage.add_completion("rewrite", {"usage": {"prompt_tokens": 20, "completion_tokens": 5}}, messages, "gpt-35-turbo")
+    # Without a reported usage, the tokens are counted locally
+    completion = {"choices": [{"message": {"role": "assistant", "content": "Fine"}}]}
+    usage.add_completion("rewrite", completion, messages, "gpt-35-turbo")
+    usage.add("embedding", 4)
+    assert usage.as_dict() == {
+        "stages": {
+            "rewrite": {"prompt_tokens": 20 + 9, "completion_tokens": 5 + 1},
+            "embedding": {"prompt_tokens": 4, "completion_tokens": 0},
+        },
+        "prompt_tokens": 33,
+        "completion_tokens": 6,
+        "total_tokens": 39,
+    }
+    usage.set("rewrite", 1, 1)
+    assert usage.as_dict()["total_tokens"] == 6
+
+
+def test_tokenusagestats_aggregates_by_endpoint_and_user():
+    stats = TokenUsageStats(max_users=2, top_users=1)
+    for endpoint, oid, tokens in [("/chat", "a", 10), ("/chat_stream", "b", 30), ("/ask", None, 5), ("/chat", "b", 1)]:
+        usage = TokenUsage()
+        usage.add("answer", tokens)
+        stats.record(endpoint, oid, usage)
+    result = stats.stats()
+    assert result["endpoints"]["/chat"] == {
+        "requests": 2,
+        "prompt_tokens": 11,
+        "completion_tokens": 0,
+        "total_tokens": 11,
+    }
+    # The least recently active user was dropped
+    assert result["users"] == 2
+    assert "top_users" not in result
+    assert stats.user_stats()["top_users"] == {
+        "b": {"requests": 2, "prompt_tokens": 31, "completion_tokens": 0, "total_tokens": 31}
+    }